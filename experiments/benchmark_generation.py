@@ -0,0 +1,200 @@
+"""Offline throughput benchmark of the data generators.
+
+Starts `magicoder.mock_openai_server` in the background, runs `generate_data.py` and
+`http_generate_data.py` against it at several concurrency levels, and reports seeds/s,
+success yield and tail latency from the per-request metrics of each run.
+
+    python experiments/benchmark_generation.py --n_seeds 200 --concurrency_levels 4 16 64
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import cast
+
+from transformers import HfArgumentParser
+
+from magicoder.concurrency import percentile
+from magicoder.mock_openai_server import Args as ServerArgs
+from magicoder.mock_openai_server import MockOpenAIServer
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+
+
+@dataclass(frozen=True)
+class Args:
+    n_seeds: int = field(default=200)
+    concurrency_levels: list[int] = field(default_factory=lambda: [4, 16, 64])
+    generators: list[str] = field(
+        default_factory=lambda: ["generate_data", "http_generate_data"]
+    )
+    stream: bool = field(
+        default=True, metadata={"help": "Streaming for generate_data.py"}
+    )
+    ttft: float = field(default=0.2)
+    tokens_per_second: float = field(default=500.0)
+    error_429_rate: float = field(default=0.0)
+    error_5xx_rate: float = field(default=0.0)
+    truncation_rate: float = field(default=0.0)
+    malformed_rate: float = field(default=0.0)
+    output: str | None = field(
+        default=None, metadata={"help": "Write the report as JSON to this file"}
+    )
+
+
+@dataclass
+class BenchmarkResult:
+    generator: str
+    concurrency: int
+    n_seeds: int
+    n_succeeded: int
+    n_requests: int
+    wall_time: float
+    seeds_per_second: float
+    success_yield: float
+    latency_p50: float | None
+    latency_p95: float | None
+    latency_p99: float | None
+
+
+def write_corpus(path: Path, n_documents: int):
+    with path.open("w") as f:
+        for i in range(n_documents):
+            lines = [
+                f"def function_{i}_{j}(x):\n    return x * {j}\n" for j in range(10)
+            ]
+            f.write(json.dumps({"content": "".join(lines)}) + "\n")
+
+
+def summarize(
+    generator: str, concurrency: int, n_seeds: int, metrics_file: Path, wall_time: float
+) -> BenchmarkResult:
+    with metrics_file.open() as f:
+        requests = [json.loads(line) for line in f]
+    latencies = [r["latency"] for r in requests if r["latency"] is not None]
+    n_succeeded = sum(r["parse_outcome"] == "ok" for r in requests)
+    # 只统计请求阶段，排除进程启动和加载数据集的时间
+    if len(requests) > 0:
+        start = min(r["timestamp"] for r in requests)
+        end = max(r["timestamp"] + (r["latency"] or 0) for r in requests)
+        elapsed = max(end - start, 1e-9)
+    else:
+        elapsed = wall_time
+
+    def quantile(q: float) -> float | None:
+        return round(percentile(latencies, q), 3) if len(latencies) > 0 else None
+
+    return BenchmarkResult(
+        generator=generator,
+        concurrency=concurrency,
+        n_seeds=n_seeds,
+        n_succeeded=n_succeeded,
+        n_requests=len(requests),
+        wall_time=round(wall_time, 2),
+        seeds_per_second=round(n_succeeded / elapsed, 2),
+        success_yield=round(n_succeeded / n_seeds, 3),
+        latency_p50=quantile(50),
+        latency_p95=quantile(95),
+        latency_p99=quantile(99),
+    )
+
+
+def run_generator(
+    args: Args, generator: str, concurrency: int, workdir: Path, env: dict
+) -> BenchmarkResult:
+    metrics_file = workdir / f"metrics-{generator}-{concurrency}.jsonl"
+    command = [
+        sys.executable,
+        str(REPO_ROOT / "src" / "magicoder" / f"{generator}.py"),
+        "--dataset_name",
+        "corpus.json",
+        "--seed_code_start_index",
+        "0",
+        "--max_new_data",
+        str(args.n_seeds),
+        "--seed",
+        "976",
+        "--concurrency",
+        str(concurrency),
+        "--max_concurrency",
+        str(concurrency),
+        "--adaptive_concurrency",
+        "False",
+        "--stream",
+        str(args.stream and generator == "generate_data"),
+        "--metrics_file",
+        str(metrics_file),
+        "--tag",
+        f"bench-{generator}-{concurrency}",
+    ]
+    start = time.time()
+    subprocess.run(command, cwd=workdir, env=env, check=True, stdout=subprocess.DEVNULL)
+    return summarize(
+        generator, concurrency, args.n_seeds, metrics_file, time.time() - start
+    )
+
+
+def main():
+    args, *_ = cast(
+        tuple[Args, ...], HfArgumentParser(Args).parse_args_into_dataclasses()
+    )
+    server = MockOpenAIServer(
+        ServerArgs(
+            port=0,
+            ttft=args.ttft,
+            tokens_per_second=args.tokens_per_second,
+            error_429_rate=args.error_429_rate,
+            error_5xx_rate=args.error_5xx_rate,
+            truncation_rate=args.truncation_rate,
+            malformed_rate=args.malformed_rate,
+        )
+    ).start()
+    print(f"Mock server at {server.url}")
+
+    workdir = Path(tempfile.mkdtemp(prefix="magicoder-bench-"))
+    write_corpus(workdir / "corpus.json", args.n_seeds)
+    (workdir / "data").mkdir()
+    shutil.copy(REPO_ROOT / "data" / "prompt.txt", workdir / "data" / "prompt.txt")
+    env = dict(
+        os.environ,
+        OPENAI_BASE_URL=f"{server.url}/v1",
+        OPENAI_API_KEY="mock",
+        XIRANG_BASE_URL=f"{server.url}/v1/chat/completions",
+        XIRANG_API_KEY="mock",
+        MODEL_CODE="mock",
+        PYTHONPATH=os.pathsep.join(
+            [str(REPO_ROOT / "src"), os.environ.get("PYTHONPATH", "")]
+        ),
+    )
+
+    results: list[BenchmarkResult] = []
+    try:
+        for generator in args.generators:
+            for concurrency in args.concurrency_levels:
+                result = run_generator(args, generator, concurrency, workdir, env)
+                print(result)
+                results.append(result)
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir)
+
+    header = f"{'generator':<20}{'conc':>6}{'seeds/s':>10}{'yield':>8}{'p50':>8}{'p95':>8}{'p99':>8}"
+    print(header)
+    for r in results:
+        print(
+            f"{r.generator:<20}{r.concurrency:>6}{r.seeds_per_second:>10}"
+            f"{r.success_yield:>8}{str(r.latency_p50):>8}{str(r.latency_p95):>8}"
+            f"{str(r.latency_p99):>8}"
+        )
+    if args.output is not None:
+        Path(args.output).write_text(json.dumps([asdict(r) for r in results], indent=2))
+
+
+if __name__ == "__main__":
+    main()
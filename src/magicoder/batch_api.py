@@ -0,0 +1,222 @@
+"""服务商 Batch API 模式：构建批文件、提交、轮询、流式导入
+
+Batch 接口价格是实时接口的一半，而且不受 RPM 限制，适合不着急的大批量生成。原来的做法是
+几个一次性脚本：手写批文件、用随机数修补重复的 custom_id、事后再把种子对回去。这里把整个
+流程放进 `generate_data.py --mode batch`：
+
+    <output>.batches/
+        state.json                 # 各批次的文件、file id、batch id 和状态
+        round-00-batch-0000.jsonl  # 请求，每行 {"custom_id", "method", "url", "body"}
+
+custom_id 为 `<数据指纹>-<index>`，由数据指纹和种子位置唯一确定，导入结果时直接映射回种子，
+不依赖行的顺序。批文件按请求数和字节数切分。每次状态变化都先写入 state.json，进程中断后
+续跑会接着轮询已提交的批次，不会重复提交。
+"""
+
+import json
+import os
+import uuid
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, AsyncIterator, Iterable
+
+import openai
+
+from magicoder.concurrency import OVERLOAD_STATUS_CODES
+
+BATCH_URL = "/v1/chat/completions"
+# 不会再变化的批次状态
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+def custom_id_for(fingerprint: str, index: int) -> str:
+    return f"{fingerprint}-{index}"
+
+
+def index_from_custom_id(custom_id: str, fingerprint: str) -> int:
+    prefix, _, index = custom_id.rpartition("-")
+    assert prefix == fingerprint, f"custom_id {custom_id} is not from this run"
+    return int(index)
+
+
+def batch_dir_for(output_path: str | Path) -> Path:
+    """输出文件对应的批任务目录。"""
+    output_path = Path(output_path)
+    return output_path.with_name(output_path.name + ".batches")
+
+
+def batch_request(custom_id: str, body: dict) -> dict:
+    return dict(custom_id=custom_id, method="POST", url=BATCH_URL, body=body)
+
+
+def result_error_class(line: dict) -> str | None:
+    """结果行对应的错误类别，成功时为 None。"""
+    response = line.get("response") or {}
+    status_code = response.get("status_code")
+    if line.get("error") is None and status_code == 200:
+        return None
+    if status_code is not None and (
+        status_code in OVERLOAD_STATUS_CODES or status_code >= 500
+    ):
+        return "overload"
+    return "error"
+
+
+@dataclass
+class BatchState:
+    file: str
+    n_requests: int
+    input_file_id: str | None = field(default=None)
+    batch_id: str | None = field(default=None)
+    status: str = field(default="pending")
+    output_file_id: str | None = field(default=None)
+    error_file_id: str | None = field(default=None)
+    # 结果已全部写入输出
+    ingested: bool = field(default=False)
+
+
+class BatchJob:
+    """一个输出文件的所有批次，状态保存在 `<directory>/state.json`。
+
+    Args:
+        directory (str | Path): 批任务目录，已存在时读取其中的状态。
+        client (openai.AsyncOpenAI): 支持 Batch API 的客户端。
+        completion_window (str): 批次的完成时限。
+    """
+
+    def __init__(
+        self,
+        directory: str | Path,
+        client: openai.AsyncOpenAI,
+        completion_window: str = "24h",
+    ):
+        self.directory = Path(directory)
+        self.client = client
+        self.completion_window = completion_window
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.state_path = self.directory / "state.json"
+        self.round = 0
+        self.batches: list[BatchState] = []
+        if self.state_path.exists():
+            state = json.loads(self.state_path.read_text())
+            self.round = state["round"]
+            self.batches = [BatchState(**batch) for batch in state["batches"]]
+
+    def save(self):
+        tmp_path = self.state_path.with_name(f".state.{uuid.uuid4().hex}")
+        with tmp_path.open("w") as f:
+            json.dump(
+                dict(round=self.round, batches=[asdict(b) for b in self.batches]),
+                f,
+                indent=2,
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.state_path)
+
+    def pending(self) -> list[BatchState]:
+        """已构建但结果尚未导入的批次。"""
+        return [batch for batch in self.batches if not batch.ingested]
+
+    def prepare(
+        self, requests: Iterable[dict], max_requests: int, max_bytes: int
+    ) -> list[BatchState]:
+        """
+        把请求写成新一轮的批文件，每个文件不超过 `max_requests` 行和 `max_bytes` 字节。
+
+        Returns:
+            list[BatchState]: 新构建的批次。
+
+        """
+        assert len(self.pending()) == 0, "Previous batches are not ingested yet"
+        if len(self.batches) > 0:
+            self.round += 1
+        new_batches: list[BatchState] = []
+        lines: list[bytes] = []
+        n_bytes = 0
+
+        def write_file():
+            path = self.directory / (
+                f"round-{self.round:02d}-batch-{len(new_batches):04d}.jsonl"
+            )
+            with path.open("wb") as f:
+                f.writelines(lines)
+            new_batches.append(BatchState(file=path.name, n_requests=len(lines)))
+
+        for request in requests:
+            line = (json.dumps(request, ensure_ascii=False) + "\n").encode()
+            if len(lines) > 0 and (
+                len(lines) >= max_requests or n_bytes + len(line) > max_bytes
+            ):
+                write_file()
+                lines, n_bytes = [], 0
+            lines.append(line)
+            n_bytes += len(line)
+        if len(lines) > 0:
+            write_file()
+        self.batches.extend(new_batches)
+        self.save()
+        return new_batches
+
+    async def submit(self):
+        """上传并提交尚未提交的批次。"""
+        for batch in self.pending():
+            if batch.input_file_id is None:
+                uploaded = await self.client.files.create(
+                    file=self.directory / batch.file, purpose="batch"
+                )
+                batch.input_file_id = uploaded.id
+                self.save()
+            if batch.batch_id is None:
+                created = await self.client.batches.create(
+                    input_file_id=batch.input_file_id,
+                    endpoint=BATCH_URL,
+                    completion_window=self.completion_window,  # type: ignore[arg-type]
+                )
+                batch.batch_id = created.id
+                batch.status = created.status
+                self.save()
+                print(f"[batch] Submitted {batch.file} as {batch.batch_id}")
+
+    async def refresh(self) -> bool:
+        """更新未结束批次的状态，返回是否全部结束。"""
+        for batch in self.pending():
+            if batch.status in TERMINAL_STATUSES:
+                continue
+            assert batch.batch_id is not None, f"{batch.file} is not submitted"
+            remote = await self.client.batches.retrieve(batch.batch_id)
+            if remote.status != batch.status:
+                counts = remote.request_counts
+                print(
+                    f"[batch] {batch.batch_id}: {batch.status} -> {remote.status}",
+                    "" if counts is None else counts.model_dump(),
+                )
+            batch.status = remote.status
+            batch.output_file_id = remote.output_file_id
+            batch.error_file_id = remote.error_file_id
+        self.save()
+        return all(batch.status in TERMINAL_STATUSES for batch in self.pending())
+
+    async def results(self, batch: BatchState) -> AsyncIterator[dict]:
+        """流式读出一个已结束批次的结果行和错误行。"""
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id is None:
+                continue
+            async with self.client.files.with_streaming_response.content(
+                file_id
+            ) as response:
+                async for line in response.iter_lines():
+                    if line.strip() != "":
+                        yield json.loads(line)
+
+    def mark_ingested(self, batch: BatchState):
+        batch.ingested = True
+        self.save()
+
+    def summary(self) -> dict[str, Any]:
+        return dict(
+            round=self.round,
+            batches=len(self.batches),
+            requests=sum(batch.n_requests for batch in self.batches),
+            pending=len(self.pending()),
+        )
@@ -0,0 +1,216 @@
+"""按预算控制生成：累计 token 和花费，预测总花费和完成时间，到达上限时停止派发
+
+每个请求结束时记录 prompt、completion（含推理过程）和 reasoning token 数，以及可用的
+问题/解答对数，由此得到观察到的产出率（每千 token 多少条可用数据）：
+
+    预计总 token = 本次要生成的种子数 / 每 token 成功的种子数
+    预计总花费   = 预计总 token 按价格折算
+    预计剩余时间 = (预计总 token - 已用 token) / 每秒 token 吞吐
+
+花费或 token 数到达 `max_cost` / `max_tokens` 后，生成引擎不再派发新的种子，在途的请求正常
+结束并写出。没有派发的种子在日志里仍是 pending，之后用 `--continue_from` 续跑即可。
+
+`--plan_pilot N` 是只做规划的试跑：先用 N 个种子生成一个小样本，再按上面的方法推算整个
+种子范围需要的时间和花费，打印后退出。
+"""
+
+import time
+from dataclasses import dataclass
+from typing import Any
+
+from magicoder.telemetry import RequestMetrics
+
+
+@dataclass(frozen=True)
+class Pricing:
+    """每百万 token 的价格（美元），推理过程按 completion 计费。
+
+    `cached_prompt` 是命中服务商前缀缓存的 prompt token 的价格，None 表示与 `prompt` 相同。
+    """
+
+    prompt: float = 0.0
+    completion: float = 0.0
+    cached_prompt: float | None = None
+
+    def cost(
+        self, prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0
+    ) -> float:
+        cached_price = self.prompt if self.cached_prompt is None else self.cached_prompt
+        return (
+            (prompt_tokens - cached_tokens) * self.prompt
+            + cached_tokens * cached_price
+            + completion_tokens * self.completion
+        ) / 1e6
+
+
+def _format_seconds(seconds: float | None) -> str | None:
+    if seconds is None:
+        return None
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+class RunBudget:
+    """
+    Args:
+        pricing (Pricing): 用于折算花费的价格。
+        max_cost (float | None): 花费上限（美元），None 表示不限制。
+        max_tokens (int | None): token 总数（prompt + completion）上限，None 表示不限制。
+        report_interval (float): 打印进度和预测的最小间隔（秒）。
+    """
+
+    def __init__(
+        self,
+        pricing: Pricing,
+        max_cost: float | None = None,
+        max_tokens: int | None = None,
+        report_interval: float = 60.0,
+    ):
+        self.pricing = pricing
+        self.max_cost = max_cost
+        self.max_tokens = max_tokens
+        self.report_interval = report_interval
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.reasoning_tokens = 0
+        self.cached_tokens = 0
+        self.n_requests = 0
+        # 解析成功的请求数（种子数）和去重后可用的问题/解答对数
+        self.n_usable_seeds = 0
+        self.n_pairs = 0
+        # 本次运行要生成的种子数，各窗口开始时累加
+        self.n_target_seeds = 0
+        self.started = time.monotonic()
+        self._last_report = self.started
+        self._stop_reported = False
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    @property
+    def cost(self) -> float:
+        return self.pricing.cost(
+            self.prompt_tokens, self.completion_tokens, self.cached_tokens
+        )
+
+    def expect(self, n_seeds: int):
+        """登记一个窗口要生成的种子数，用于预测总花费和完成时间。"""
+        self.n_target_seeds += n_seeds
+
+    def record(self, metrics: RequestMetrics):
+        """每次请求结束时调用（生成引擎、批处理和本地生成），失败的请求同样计入 token。"""
+        self.prompt_tokens += metrics.prompt_tokens or 0
+        self.completion_tokens += metrics.completion_tokens or 0
+        self.reasoning_tokens += metrics.reasoning_tokens or 0
+        self.cached_tokens += metrics.cached_tokens or 0
+        self.n_requests += 1
+        if metrics.parse_outcome == "ok":
+            self.n_usable_seeds += 1
+            self.n_pairs += metrics.n_distinct_choices or 1
+        self.maybe_report()
+
+    def exhausted(self) -> str | None:
+        """到达上限时返回原因，否则返回 None。"""
+        if self.max_cost is not None and self.cost >= self.max_cost:
+            return f"cost ${self.cost:.2f} reached the budget ${self.max_cost:.2f}"
+        if self.max_tokens is not None and self.total_tokens >= self.max_tokens:
+            return f"{self.total_tokens} tokens reached the budget {self.max_tokens}"
+        return None
+
+    def should_stop(self) -> bool:
+        """是否应停止派发，第一次停止时打印原因。"""
+        if (reason := self.exhausted()) is None:
+            return False
+        if not self._stop_reported:
+            self._stop_reported = True
+            print(f"[budget] Stopping dispatch: {reason}. Pending seeds stay resumable")
+        return True
+
+    def projection(self, n_seeds: int | None = None) -> dict[str, Any]:
+        """
+        按观察到的产出率和吞吐预测生成 `n_seeds` 个种子（默认为登记的目标）的 token、花费和时间。
+        还没有成功的请求时预测值为 None。
+        """
+        if n_seeds is None:
+            n_seeds = self.n_target_seeds
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        projected_tokens: int | None = None
+        projected_cost: float | None = None
+        projected_seconds: float | None = None
+        eta_seconds: float | None = None
+        if self.n_usable_seeds > 0 and self.total_tokens > 0:
+            tokens_per_seed = self.total_tokens / self.n_usable_seeds
+            projected_tokens = round(tokens_per_seed * n_seeds)
+            # 按已用 token 的 prompt / completion 比例折算花费
+            projected_cost = self.cost / self.total_tokens * projected_tokens
+            tokens_per_second = self.total_tokens / elapsed
+            projected_seconds = projected_tokens / tokens_per_second
+            eta_seconds = max(projected_tokens - self.total_tokens, 0) / (
+                tokens_per_second
+            )
+        return dict(
+            seeds=n_seeds,
+            requests=self.n_requests,
+            usable_seeds=self.n_usable_seeds,
+            pairs=self.n_pairs,
+            tokens=dict(
+                prompt=self.prompt_tokens,
+                completion=self.completion_tokens,
+                reasoning=self.reasoning_tokens,
+                cached=self.cached_tokens,
+            ),
+            cost=round(self.cost, 4),
+            prompt_cache_hit_rate=(
+                round(self.cached_tokens / self.prompt_tokens, 3)
+                if self.prompt_tokens > 0
+                else None
+            ),
+            pairs_per_1k_tokens=(
+                round(1000 * self.n_pairs / self.total_tokens, 3)
+                if self.total_tokens > 0
+                else None
+            ),
+            projected_tokens=projected_tokens,
+            projected_cost=(
+                None if projected_cost is None else round(projected_cost, 4)
+            ),
+            projected_time=_format_seconds(projected_seconds),
+            eta=_format_seconds(eta_seconds),
+        )
+
+    def maybe_report(self):
+        now = time.monotonic()
+        if now - self._last_report < self.report_interval:
+            return
+        self._last_report = now
+        projection = self.projection()
+        limit = "" if self.max_cost is None else f" of ${self.max_cost:.2f}"
+        print(
+            f"[budget] ${projection['cost']:.2f}{limit} spent, "
+            f"{self.total_tokens} tokens "
+            f"({projection['prompt_cache_hit_rate']} prompt cache hits), "
+            f"{projection['pairs_per_1k_tokens']} pairs/1k tokens, "
+            f"projected ${projection['projected_cost']} for "
+            f"{projection['seeds']} seeds, ETA {projection['eta']}"
+        )
+
+
+_BUDGET: RunBudget | None = None
+
+
+def configure(
+    pricing: Pricing,
+    max_cost: float | None = None,
+    max_tokens: int | None = None,
+    report_interval: float = 60.0,
+) -> RunBudget:
+    """设置进程内共享的预算，所有窗口和分片一起计算。"""
+    global _BUDGET
+    _BUDGET = RunBudget(pricing, max_cost, max_tokens, report_interval)
+    return _BUDGET
+
+
+def get_budget() -> RunBudget | None:
+    return _BUDGET
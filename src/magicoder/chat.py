@@ -0,0 +1,170 @@
+"""统一不同接口返回的对话补全结果
+
+OpenAI SDK 返回的是对象（或流式 chunk），天翼云等 HTTP 接口返回的是字典。
+生成脚本只关心回复内容、推理过程、结束原因和 usage，这里把它们整理成同一种结构。
+"""
+
+import asyncio
+from dataclasses import dataclass, field
+from typing import Any
+
+from magicoder import hedging, telemetry
+from magicoder.stream_validator import SectionValidator, StreamAborted
+from magicoder.stream_watchdog import StreamStalled, StreamWatchdog
+
+
+def _get(obj: Any, key: str, default: Any = None) -> Any:
+    if obj is None:
+        return default
+    if isinstance(obj, dict):
+        return obj.get(key, default)
+    return getattr(obj, key, default)
+
+
+def usage_to_dict(usage: Any) -> dict | None:
+    if usage is None:
+        return None
+    if isinstance(usage, dict):
+        return usage
+    return usage.model_dump()
+
+
+@dataclass
+class ChatResult:
+    content: str
+    reasoning_content: str
+    finish_reason: str | None
+    usage: dict | None = field(default=None)
+    # 实际处理请求的接口名称，由路由器填写
+    endpoint: str | None = field(default=None)
+    # n > 1 时其余 choice 的结果（按 choice 的 index 排序），usage 只记在第一个上
+    other_choices: list["ChatResult"] = field(default_factory=list)
+
+    @property
+    def choices(self) -> list["ChatResult"]:
+        """所有 choice 的结果，第一个就是自身。"""
+        return [self, *self.other_choices]
+
+    @staticmethod
+    def from_response(response: Any) -> "ChatResult":
+        """从非流式响应（对象或字典）构造结果，第一个 choice 之外的放在 `other_choices`。"""
+        choices = sorted(
+            _get(response, "choices", []), key=lambda choice: _get(choice, "index", 0)
+        )
+        results = [
+            ChatResult(
+                content=_get(_get(choice, "message"), "content") or "",
+                reasoning_content=_get(_get(choice, "message"), "reasoning_content")
+                or "",
+                finish_reason=_get(choice, "finish_reason"),
+            )
+            for choice in choices
+        ]
+        result, *others = results
+        result.usage = usage_to_dict(_get(response, "usage"))
+        result.other_choices = others
+        return result
+
+
+async def close_stream(response) -> None:
+    """提前关闭流式响应，释放底层连接。"""
+    if hasattr(response, "aclose"):
+        await response.aclose()
+    elif hasattr(response, "close"):
+        await response.close()
+
+
+def _observe_partial_usage(usage: dict | None, n_chunks: int) -> None:
+    # 中途停下的流同样要付费；没有 usage 时按每个 chunk 一个 token 估计
+    if usage is not None:
+        telemetry.observe_usage(usage)
+    else:
+        telemetry.observe(completion_tokens=n_chunks)
+
+
+async def collect_stream(
+    response,
+    validator: SectionValidator | None = None,
+    watchdog: StreamWatchdog | None = None,
+) -> ChatResult:
+    """
+    聚合流式响应。
+
+    Args:
+        response: `stream=True` 时返回的异步 chunk 迭代器。
+        validator (SectionValidator | None): 逐段检查回复内容，回复已不可能被解析时
+            关闭流并抛出 `StreamAborted`。
+        watchdog (StreamWatchdog | None): 首 token、chunk 间隔和总时长的期限，
+            到期时关闭流并抛出带有部分输出的 `StreamStalled`。
+
+    Returns:
+        ChatResult: 回复内容、推理过程（r1 模型的 reasoning_content）、
+            最后一个 chunk 的 finish_reason 以及 usage（如果服务端返回了）。
+            n > 1 时按 chunk 中 choice 的 index 分别聚合，校验只看第一个 choice。
+
+    """
+    complete_response = ""
+    reasoning_content = ""
+    last_finish_reason = None
+    usage = None
+    # 收到的内容 chunk 数，服务端没有返回 usage 就中止时用来估计已经生成的 token 数
+    n_chunks = 0
+    # 第一个之外的 choice：index -> [回复内容, 推理过程, finish_reason]
+    others: dict[int, list] = {}
+    chunks = response if watchdog is None else watchdog.iterate(response)
+    try:
+        async for chunk in chunks:
+            if _get(chunk, "usage") is not None:
+                usage = usage_to_dict(_get(chunk, "usage"))
+            if len(_get(chunk, "choices") or []) == 0:
+                continue
+            choice = _get(chunk, "choices")[0]
+            delta = _get(choice, "delta")
+            if _get(delta, "reasoning_content") or _get(delta, "content"):
+                n_chunks += 1
+                telemetry.observe_first_token()
+                hedging.mark_first_token()
+                if watchdog is not None:
+                    watchdog.mark_first_token()
+            if (choice_index := _get(choice, "index", 0) or 0) > 0:
+                other = others.setdefault(choice_index, ["", "", None])
+                other[0] += _get(delta, "content") or ""
+                other[1] += _get(delta, "reasoning_content") or ""
+                other[2] = _get(choice, "finish_reason") or other[2]
+                continue
+            # 如果当前 chunk 包含 finish_reason，就记录下来（通常只有最后一个 chunk 会有）
+            if _get(choice, "finish_reason"):
+                last_finish_reason = _get(choice, "finish_reason")
+            # 处理推理过程文本
+            if _get(delta, "reasoning_content"):
+                reasoning_content += _get(delta, "reasoning_content")
+            # 处理回复内容
+            elif _get(delta, "content"):
+                complete_response += _get(delta, "content")
+                if validator is not None:
+                    validator.feed(_get(delta, "content"))
+    except StreamStalled as e:
+        # 保留已收到的部分输出和原因，便于排查；种子由生成引擎重新派发
+        e.partial_content = complete_response
+        e.partial_reasoning = reasoning_content
+        telemetry.observe(stalled=e.reason)
+        _observe_partial_usage(usage, n_chunks)
+        await close_stream(response)
+        raise
+    except (StreamAborted, asyncio.CancelledError):
+        # 中止或被取消（例如对冲请求中落后的一份）时关闭连接，服务端随之停止生成
+        _observe_partial_usage(usage, n_chunks)
+        await close_stream(response)
+        raise
+    return ChatResult(
+        content=complete_response,
+        reasoning_content=reasoning_content,
+        finish_reason=last_finish_reason,
+        usage=usage,
+        other_choices=[
+            ChatResult(
+                content=content, reasoning_content=reasoning, finish_reason=reason
+            )
+            for _, (content, reasoning, reason) in sorted(others.items())
+        ],
+    )
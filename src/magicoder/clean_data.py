@@ -34,8 +34,15 @@ class Args:
 def filter_same_seed_problem_solution(
     raw_data: list[dict],
 ) -> tuple[list[dict], list[dict]]:
+    """
+    过滤种子、问题或解答（忽略空白）重复的数据。
+
+    `--n_completions > 1` 生成的数据里，同一个种子请求的多个回复带有相同的 `index` 和不同的
+    `sub_index`，它们的种子本来就相同，不算重复种子；问题和解答仍然要求互不相同。
+    """
     chosen_data: list[dict] = []
-    seeds: set[str] = set()
+    # 种子 -> 第一条使用它的数据的 index
+    seeds: dict[str, int | None] = {}
     problems: set[str] = set()
     solutions: set[str] = set()
     rejected_data: list[dict] = []
@@ -43,15 +50,18 @@ def filter_same_seed_problem_solution(
         seed = remove_all_whitespaces(d["seed"])
         problem = remove_all_whitespaces(d["problem"])
         solution = remove_all_whitespaces(d["solution"])
-        if seed not in seeds and problem not in problems and solution not in solutions:
+        duplicate_seed = seed in seeds and not (
+            "sub_index" in d and seeds[seed] == d.get("index")
+        )
+        if not duplicate_seed and problem not in problems and solution not in solutions:
             chosen_data.append(d)
-            seeds.add(seed)
+            seeds.setdefault(seed, d.get("index"))
             problems.add(problem)
             solutions.add(solution)
         else:
             reason = (
                 "duplicate seeds"
-                if seed in seeds
+                if duplicate_seed
                 else "duplicate problems"
                 if problem in problems
                 else "duplicate solutions"
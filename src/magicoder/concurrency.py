@@ -0,0 +1,158 @@
+"""AIMD（加性增、乘性减）自适应并发控制
+
+服务端的可用容量一天之内会变化，固定的并发数要么浪费配额，要么不停地触发 429。
+控制器在成功率和延迟都健康时缓慢增加在途请求数（每完成约 `limit` 个请求加 1），
+一旦遇到 429、5xx、超时或延迟突增就把上限乘以 `decrease_factor`。
+"""
+
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from enum import Enum
+
+from magicoder.stream_validator import StreamAborted
+from magicoder.stream_watchdog import StreamStalled
+
+# 认为是服务端过载的 HTTP 状态码
+OVERLOAD_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+# 不同客户端的超时异常没有共同基类，按名字识别
+TIMEOUT_ERROR_NAMES = {
+    "TimeoutError",
+    "APITimeoutError",
+    "ReadTimeout",
+    "ConnectTimeout",
+    "Timeout",
+}
+
+
+class Outcome(Enum):
+    SUCCESS = "success"
+    # 429 / 5xx / 超时：说明并发太高，需要降低
+    OVERLOAD = "overload"
+    # 解析失败等与容量无关的错误
+    FAILURE = "failure"
+    # 流式回复已不可能被解析而被提前中止，与容量无关，立即重新派发
+    ABORTED = "aborted"
+
+
+def _status_code(error: BaseException) -> int | None:
+    # openai.APIStatusError 直接带 status_code；httpx / requests 的异常带 response
+    if isinstance(status_code := getattr(error, "status_code", None), int):
+        return status_code
+    response = getattr(error, "response", None)
+    if isinstance(status_code := getattr(response, "status_code", None), int):
+        return status_code
+    return None
+
+
+def classify_error(error: BaseException) -> Outcome:
+    """判断一个异常是否意味着服务端过载。"""
+    if isinstance(error, StreamAborted):
+        return Outcome.ABORTED
+    if isinstance(error, StreamStalled):
+        # 流卡住与超时相同，说明服务端过载
+        return Outcome.OVERLOAD
+    if type(error).__name__ in TIMEOUT_ERROR_NAMES:
+        return Outcome.OVERLOAD
+    if type(error).__name__ == "RateLimitError":
+        return Outcome.OVERLOAD
+    if (status_code := _status_code(error)) is not None:
+        if status_code in OVERLOAD_STATUS_CODES or status_code >= 500:
+            return Outcome.OVERLOAD
+    return Outcome.FAILURE
+
+
+def percentile(values: list[float], q: float) -> float:
+    """最近邻法计算分位数，q 取值 0~100。"""
+    assert len(values) > 0
+    ordered = sorted(values)
+    rank = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+@dataclass
+class AIMDController:
+    """按 AIMD 规则调整并发上限。
+
+    Args:
+        initial_limit (int): 初始并发数。
+        min_limit (int): 并发下限。
+        max_limit (int): 并发上限，通常由配额决定。
+        additive_increase (float): 每完成约 `limit` 个成功请求增加的并发数。
+        decrease_factor (float): 过载时并发上限乘以的系数。
+        latency_window (int): 每隔多少个成功请求计算一次 p95 延迟。
+        latency_spike_ratio (float): 窗口 p95 超过基线的多少倍视为延迟突增。
+        cooldown (float): 两次降低之间至少间隔的秒数，避免同一波 429 把并发连续砍到底。
+    """
+
+    initial_limit: int = 8
+    min_limit: int = 1
+    max_limit: int = 64
+    additive_increase: float = 1.0
+    decrease_factor: float = 0.5
+    latency_window: int = 20
+    latency_spike_ratio: float = 2.0
+    cooldown: float = 5.0
+
+    limit: float = field(init=False)
+    in_flight: int = field(init=False, default=0)
+    baseline_p95: float | None = field(init=False, default=None)
+    n_decreases: int = field(init=False, default=0)
+
+    def __post_init__(self):
+        assert 1 <= self.min_limit <= self.initial_limit <= self.max_limit
+        assert 0 < self.decrease_factor < 1
+        self.limit = float(self.initial_limit)
+        self._latencies: deque[float] = deque(maxlen=self.latency_window)
+        self._last_decrease = 0.0
+        self._changed = asyncio.Condition()
+
+    @property
+    def current_limit(self) -> int:
+        return max(self.min_limit, int(self.limit))
+
+    async def acquire(self) -> None:
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.in_flight < self.current_limit)
+            self.in_flight += 1
+
+    async def release(self, outcome: Outcome, latency: float) -> None:
+        self.in_flight -= 1
+        if outcome == Outcome.SUCCESS:
+            self._on_success(latency)
+        elif outcome == Outcome.OVERLOAD:
+            self._decrease()
+        async with self._changed:
+            self._changed.notify_all()
+
+    def _on_success(self, latency: float) -> None:
+        self._latencies.append(latency)
+        if len(self._latencies) == self.latency_window:
+            window_p95 = percentile(list(self._latencies), 95)
+            self._latencies.clear()
+            if (
+                self.baseline_p95 is not None
+                and window_p95 > self.latency_spike_ratio * self.baseline_p95
+            ):
+                self._decrease()
+                return
+            # 基线取健康窗口中较低的 p95，并允许缓慢上漂以适应回复变长
+            self.baseline_p95 = (
+                window_p95
+                if self.baseline_p95 is None
+                else min(1.05 * self.baseline_p95, window_p95)
+            )
+        self.limit = min(
+            float(self.max_limit), self.limit + self.additive_increase / self.limit
+        )
+
+    def _decrease(self) -> None:
+        now = time.monotonic()
+        new_limit = max(float(self.min_limit), self.limit * self.decrease_factor)
+        if now - self._last_decrease < self.cooldown or new_limit == self.limit:
+            return
+        self._last_decrease = now
+        self.limit = new_limit
+        self.n_decreases += 1
+        print(f"[concurrency] Overload detected, limit -> {self.current_limit}")
@@ -0,0 +1,223 @@
+"""失败种子的死信队列（dead-letter queue）和重试轮
+
+生成引擎用完重试次数后，失败的种子在日志里只留下一行 failed，原始回复随之丢失，一次运气不好
+的调用就等于永久少一条数据。这里把每次最终失败都以一行 JSON 追加到输出旁边的 `<output>.dead`：
+
+    {"index": 3, "raw_index": 17, "seed": "...", "error_class": "unparseable",
+     "error": "Exception: Failed to parse response.", "attempts": 3, "failures": 1,
+     "response": {"finish_reason": "stop", "content": "...", "reasoning_content": "..."},
+     "time": 1700000000.0}
+    {"index": 3, "resolved": true}                       # 之后生成成功
+
+同一个 index 以最后一条记录为准。主流程结束后，生成脚本按错误类别的 `RetryPolicy` 把死信里的
+种子重新派发（`--retry_passes`），成功后记为 resolved；其余的留在队列里供排查或下次续跑。
+重试生成的记录带有 `retry` 字段，写明第几轮重试、使用的温度和之前失败的尝试次数：
+
+    {"index": 3, ..., "retry": {"pass": 1, "temperature": 0.0, "failed_attempts": 3}}
+"""
+
+import json
+import os
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Sequence
+
+from magicoder.concurrency import Outcome, classify_error
+from magicoder.stream_validator import StreamAborted
+from magicoder.stream_watchdog import StreamStalled
+
+
+class GenerationError(Exception):
+    """回复无法使用，带有错误类别和原始回复，由生成引擎写入死信队列。
+
+    Args:
+        error_class (str): 错误类别，对应 `RETRY_POLICIES` 的键。
+        message (str): 错误信息。
+        response (dict | None): 原始回复（内容、推理过程、结束原因）。
+    """
+
+    def __init__(self, error_class: str, message: str, response: dict | None = None):
+        self.error_class = error_class
+        self.response = response
+        super().__init__(message)
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """
+    Args:
+        max_retries (int): 进入死信队列后最多再重试几轮，0 表示不重试。
+        temperature (float | None): 重试时使用的温度，None 表示沿用原来的温度。
+            温度为 0 时解析失败往往会原样重现，换一个温度才有机会得到不同的回复。
+    """
+
+    max_retries: int
+    temperature: float | None = field(default=None)
+
+
+RETRY_POLICIES: dict[str, RetryPolicy] = {
+    # 429 / 5xx / 超时 / 流卡住：与回复本身无关，原样重试
+    "overload": RetryPolicy(max_retries=3),
+    "stalled": RetryPolicy(max_retries=3),
+    # 回复被截断、无法解析、问题或解答为空、流式校验提前中止：沿用 `--temperature` 重试，
+    # 不悄悄混入采样的输出；需要换温度时在这里设置（r1 推荐 0.6）
+    "incomplete": RetryPolicy(max_retries=2),
+    "unparseable": RetryPolicy(max_retries=2),
+    "empty": RetryPolicy(max_retries=2),
+    "aborted": RetryPolicy(max_retries=2),
+    # 提示本身已经占满上下文，重试也不会成功
+    "no_room": RetryPolicy(max_retries=0),
+    "error": RetryPolicy(max_retries=1),
+}
+
+
+def error_class(error: BaseException) -> str:
+    """失败的类别，决定重试策略。"""
+    if isinstance(error, GenerationError):
+        return error.error_class
+    if isinstance(error, StreamAborted):
+        return "aborted"
+    if isinstance(error, StreamStalled):
+        return "stalled"
+    if classify_error(error) == Outcome.OVERLOAD:
+        return "overload"
+    return "error"
+
+
+def raw_response(error: BaseException) -> dict | None:
+    """尽量从异常中取出原始回复或错误响应体。"""
+    if isinstance(error, GenerationError):
+        return error.response
+    if isinstance(error, StreamStalled):
+        return dict(
+            content=error.partial_content, reasoning_content=error.partial_reasoning
+        )
+    # openai.APIStatusError 带有解析后的响应体
+    if (body := getattr(error, "body", None)) is not None:
+        return dict(body=body)
+    return None
+
+
+def with_retry_temperature(examples: Sequence[dict], temperature: float) -> list[dict]:
+    """在重试的种子上写明实际使用的温度（策略为 None 时即原来的温度），主流程的种子原样返回。"""
+    return [
+        (
+            dict(example, retry=dict(example["retry"], temperature=temperature))
+            if "retry" in example
+            else example
+        )
+        for example in examples
+    ]
+
+
+def dead_letter_path_for(output_path: str | Path) -> Path:
+    """输出文件对应的死信队列路径。"""
+    output_path = Path(output_path)
+    return output_path.with_name(output_path.name + ".dead")
+
+
+class DeadLetterStore:
+    """追加写入的死信队列，已存在时先重放其中的记录。
+
+    Args:
+        path (str | Path): 队列文件路径。
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.entries: dict[int, dict] = {}
+        if self.path.exists():
+            self._replay()
+        self._file = self.path.open("a")
+
+    def _replay(self):
+        with self.path.open("r") as f:
+            lines = f.readlines()
+        # 进程崩溃时最后一行可能只写了一半，丢掉即可
+        if len(lines) > 0 and not lines[-1].endswith("\n"):
+            lines.pop()
+            with self.path.open("w") as f:
+                f.writelines(lines)
+        for line in lines:
+            event = json.loads(line)
+            if event.get("resolved"):
+                self.entries.pop(event["index"], None)
+            else:
+                self.entries[event["index"]] = event
+
+    def _append(self, event: dict):
+        # 失败是少数，逐条 flush，不必等到 close
+        self._file.write(json.dumps(event, default=str) + "\n")
+        self._file.flush()
+
+    def add(self, example: dict, error: BaseException, attempts: int) -> dict:
+        """记录一个用完重试次数的种子。"""
+        index = example["index"]
+        previous = self.entries.get(index)
+        entry = dict(
+            index=index,
+            raw_index=example["raw_index"],
+            seed=example["seed"],
+            error_class=error_class(error),
+            error=f"{type(error).__name__}: {error}"[:500],
+            attempts=attempts,
+            # 第几次进入死信队列，与重试策略的 max_retries 比较
+            failures=1 if previous is None else previous["failures"] + 1,
+            response=raw_response(error),
+            time=time.time(),
+        )
+        self.entries[index] = entry
+        self._append(entry)
+        return entry
+
+    def resolve(self, index: int) -> bool:
+        """index 生成成功时调用，返回它是否曾在死信队列中。"""
+        if self.entries.pop(index, None) is None:
+            return False
+        self._append(dict(index=index, resolved=True))
+        return True
+
+    def retry_batches(
+        self, policies: dict[str, RetryPolicy] = RETRY_POLICIES
+    ) -> dict[float | None, list[dict]]:
+        """
+        按策略取出可以重试的种子。
+
+        Returns:
+            dict[float | None, list[dict]]: 重试温度（None 表示沿用）到待派发种子的映射，
+                种子包含 "index"、"raw_index"、"seed" 和 "retry"，按 index 排序。
+
+        """
+        batches: dict[float | None, list[dict]] = {}
+        for index in sorted(self.entries):
+            entry = self.entries[index]
+            policy = policies.get(entry["error_class"], policies["error"])
+            if entry["failures"] > policy.max_retries:
+                continue
+            batches.setdefault(policy.temperature, []).append(
+                dict(
+                    index=index,
+                    raw_index=entry["raw_index"],
+                    seed=entry["seed"],
+                    retry={
+                        "pass": entry["failures"],
+                        "temperature": policy.temperature,
+                        "failed_attempts": entry["attempts"],
+                    },
+                )
+            )
+        return batches
+
+    def counts(self) -> dict[str, int]:
+        """队列中各错误类别的种子数。"""
+        return dict(Counter(entry["error_class"] for entry in self.entries.values()))
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def close(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
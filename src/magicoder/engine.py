@@ -0,0 +1,379 @@
+"""基于 asyncio 的并发生成引擎
+
+同时保持多个请求在途，并通过重排缓冲区按 index 顺序写出结果，保证输出是确定的。
+`run_with_retries` 和 `FailureRecorder` 由所有生成方式（实时、Batch API、本地模型）共用：
+前者在主流程之后按死信队列的重试策略再派发几轮，后者把放弃的种子记入日志和死信队列。
+"""
+
+import asyncio
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Generic, Iterable, Sequence, TypeVar
+
+from tqdm.auto import tqdm
+
+from magicoder import telemetry
+from magicoder.budget import get_budget
+from magicoder.concurrency import AIMDController, Outcome, classify_error
+from magicoder.dead_letter import DeadLetterStore, GenerationError
+from magicoder.journal import GenerationJournal
+
+_T = TypeVar("_T")
+
+# 一个种子可以产生多条记录（n > 1 时每个 choice 一条）
+ProcessFunc = Callable[[dict], Awaitable[dict | list[dict] | None]]
+SinkFunc = Callable[[dict], None]
+# 一轮生成：重试温度（None 表示沿用原来的温度）到种子的映射 -> 本轮的统计
+PassFunc = Callable[[dict[float | None, Sequence[dict]]], Awaitable["EngineStats"]]
+
+
+class ReorderBuffer(Generic[_T]):
+    """把乱序完成的结果按派发顺序（position）重新排好再释放。
+
+    失败的位置用 None 占位，释放时直接跳过，不会阻塞后面的结果。
+    """
+
+    def __init__(self) -> None:
+        self.next_position = 0
+        self.pending: dict[int, _T | None] = {}
+
+    def push(self, position: int, item: _T | None) -> list[_T]:
+        assert position >= self.next_position, "position already released"
+        assert position not in self.pending, "duplicate position"
+        self.pending[position] = item
+        released: list[_T] = []
+        while self.next_position in self.pending:
+            ready = self.pending.pop(self.next_position)
+            if ready is not None:
+                released.append(ready)
+            self.next_position += 1
+        return released
+
+    def flush(self) -> list[_T]:
+        """按位置顺序释放剩下的所有结果，跳过空缺。派发提前停止、空缺永远不会补上时调用。"""
+        released = [
+            self.pending[position]
+            for position in sorted(self.pending)
+            if self.pending[position] is not None
+        ]
+        if len(self.pending) > 0:
+            self.next_position = max(self.pending) + 1
+        self.pending.clear()
+        return released  # type: ignore[return-value]
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+
+@dataclass
+class EngineStats:
+    n_dispatched: int = 0
+    n_succeeded: int = 0
+    n_failed: int = 0
+    n_retries: int = 0
+    n_aborted: int = 0
+    errors: dict[str, int] = field(default_factory=dict)
+
+    def add(self, other: "EngineStats") -> None:
+        """累加另一次运行的统计，用于分片生成。"""
+        self.n_dispatched += other.n_dispatched
+        self.n_succeeded += other.n_succeeded
+        self.n_failed += other.n_failed
+        self.n_retries += other.n_retries
+        self.n_aborted += other.n_aborted
+        for name, count in other.errors.items():
+            self.errors[name] = self.errors.get(name, 0) + count
+
+
+@dataclass
+class FailureRecorder:
+    """记录放弃的种子：日志标为 failed，连同原始回复写入死信队列，并计入统计。"""
+
+    stats: EngineStats
+    journal: GenerationJournal | None = None
+    dead_letters: DeadLetterStore | None = None
+
+    def __call__(self, example: dict, error: BaseException, attempt: int = 1) -> None:
+        index = example["index"]
+        error_name = type(error).__name__
+        reason = f"{error_name}: {error}"[:500]
+        self.stats.n_failed += 1
+        self.stats.errors[error_name] = self.stats.errors.get(error_name, 0) + 1
+        print(f"[error] index {index}: {reason}")
+        if self.journal is not None:
+            self.journal.mark_failed(index, reason)
+            # 以日志里的尝试次数为准，包括之前的运行
+            attempt = self.journal.status(index).attempts
+        if self.dead_letters is not None:
+            self.dead_letters.add(example, error, attempt)
+
+
+async def run_with_retries(
+    examples: Sequence[dict],
+    run_pass: PassFunc,
+    dead_letters: DeadLetterStore,
+    retry_passes: int,
+    cancel: asyncio.Event | None = None,
+) -> EngineStats:
+    """
+    先生成 `examples`，再按错误类别的重试策略（见 `magicoder.dead_letter.RETRY_POLICIES`，
+    可能换一个温度）把死信队列中的种子重新派发，最多 `retry_passes` 轮。
+
+    Args:
+        run_pass (PassFunc): 生成一轮，同一轮的种子按重试温度分组。
+        cancel (asyncio.Event | None): 设置后不再开始新的一轮。
+
+    Returns:
+        EngineStats: 各轮统计之和，失败数以死信队列中剩下的为准。
+
+    """
+    budget = get_budget()
+    stats = await run_pass({None: examples})
+    for retry_pass in range(1, retry_passes + 1):
+        if cancel is not None and cancel.is_set():
+            return stats
+        batches = dead_letters.retry_batches()
+        if len(batches) == 0 or (budget is not None and budget.should_stop()):
+            break
+        print(
+            f"[dead_letter] Retry pass {retry_pass}: "
+            f"{sum(map(len, batches.values()))} of {len(dead_letters)} seeds",
+            dead_letters.counts(),
+        )
+        stats.add(await run_pass(batches))
+    if retry_passes > 0:
+        # 重试轮里再次失败的种子之前已经计过一次，以队列中剩下的为准
+        stats.n_failed = len(dead_letters)
+    return stats
+
+
+@dataclass
+class GenerationEngine:
+    """并发执行 `process`，并把成功的结果按顺序交给 `sink`。
+
+    在途请求数由 `controller` 控制：不提供时并发固定为 `concurrency`；提供 AIMD 控制器时
+    并发会随 429、5xx 和延迟自动调整。遇到过载错误的请求会重新派发，最多 `max_attempts` 次；
+    流式校验提前中止的请求（`Outcome.ABORTED`）不等待，立即重新派发。配置了预算
+    （见 `magicoder.budget`）时，到达上限后不再派发新的数据，已派发但还在等待并发配额的
+    数据也不再发送。`run` 的 `cancel` 被设置时（例如分片的租约被别人接手），立即停止派发、
+    取消在途请求，之后不再写出任何结果。
+
+    Args:
+        concurrency (int): 固定并发数；使用 `controller` 时忽略。
+        controller (AIMDController | None): 自适应并发控制器。
+        reorder_window (int | None): 已派发但尚未写出的最大结果数，防止某个慢请求
+            让重排缓冲区无限增长。默认为最大并发数的 4 倍。
+        max_attempts (int): 每条数据最多尝试的次数（仅对过载错误和提前中止重试）。
+        retry_delay (float): 重试前等待的基础秒数，按指数增长并带随机抖动。
+        warmup (int): 先派发这么多条数据，等它们都完成后才开始并发派发其余的，
+            让服务端先为共同的提示前缀建立缓存（见 `magicoder.prompt_layout`）。
+    """
+
+    concurrency: int
+    controller: AIMDController | None = None
+    reorder_window: int | None = None
+    max_attempts: int = 3
+    retry_delay: float = 1.0
+    warmup: int = 0
+
+    def __post_init__(self):
+        assert self.concurrency > 0, "concurrency must be positive"
+        if self.controller is None:
+            self.controller = AIMDController(
+                initial_limit=self.concurrency,
+                min_limit=self.concurrency,
+                max_limit=self.concurrency,
+            )
+        if self.reorder_window is None:
+            self.reorder_window = 4 * self.controller.max_limit
+        assert self.reorder_window >= self.controller.max_limit
+        assert self.max_attempts >= 1
+
+    async def run(
+        self,
+        examples: Iterable[dict],
+        process: ProcessFunc,
+        sink: SinkFunc,
+        total: int | None = None,
+        journal: GenerationJournal | None = None,
+        dead_letters: DeadLetterStore | None = None,
+        cancel: asyncio.Event | None = None,
+        release_positions: Iterable[int] | None = None,
+    ) -> EngineStats:
+        """
+        Args:
+            examples (Iterable[dict]): 待生成的数据，每项都有 "index"。
+            process (ProcessFunc): 生成一条或多条数据，失败时抛出异常或返回 None（空列表）。
+            sink (SinkFunc): 按派发顺序接收成功的结果，同一个种子的多条记录连续交给 sink。
+            total (int | None): 数据总数，仅用于显示进度。
+            journal (GenerationJournal | None): 记录每个 index 的状态，结果交给 sink
+                之后才标记为 done；多条记录的种子在全部写出后才标记一次。
+            dead_letters (DeadLetterStore | None): 记录用完重试次数的种子及其原始回复，
+                之后生成成功时标记为 resolved。
+            cancel (asyncio.Event | None): 设置后停止派发并取消在途请求，已完成但还没有
+                写出的结果直接丢弃，日志和死信队列也不再更新。
+            release_positions (Iterable[int] | None): 与 `examples` 一一对应的写出位置，
+                派发顺序与输出顺序不同时提供（见 `magicoder.prompt_layout.group_by_prefix`），
+                默认按派发顺序写出。每条数据的派发顺序最多比写出位置晚 `reorder_window - 1`。
+        """
+        controller = self.controller
+        assert controller is not None and self.reorder_window is not None
+        stats = EngineStats()
+        buffer: ReorderBuffer[list[dict]] = ReorderBuffer()
+        # 重排窗口有空位时通知派发循环
+        window_changed = asyncio.Condition()
+        tasks: set[asyncio.Task] = set()
+        # 已经结束（成功、失败或放弃）的数据数，用于预热
+        n_finished = 0
+        progress = tqdm(total=total)
+        budget = get_budget()
+        record_failure = FailureRecorder(stats, journal, dead_letters)
+
+        def cancelled() -> bool:
+            return cancel is not None and cancel.is_set()
+
+        def finish(
+            metrics: telemetry.RequestMetrics, outcome: str, error: str | None = None
+        ):
+            telemetry.finish_request(metrics, outcome, error)
+            if budget is not None:
+                budget.record(metrics)
+
+        def write(released: list[list[dict]]):
+            for records in released:
+                for record in records:
+                    sink(record)
+                if journal is not None:
+                    journal.mark_done(records[0]["index"])
+                if dead_letters is not None:
+                    dead_letters.resolve(records[0]["index"])
+
+        async def run_one(position: int, example: dict):
+            nonlocal n_finished
+            index = example["index"]
+            records: list[dict] | None = None
+            for attempt in range(1, self.max_attempts + 1):
+                queued = time.monotonic()
+                await controller.acquire()
+                if cancelled():
+                    await controller.release(Outcome.ABORTED, 0.0)
+                    return
+                if budget is not None and budget.should_stop():
+                    # 等待配额期间预算已经用完：不再发送，日志里保持原状态，可以续跑
+                    await controller.release(Outcome.ABORTED, 0.0)
+                    break
+                if journal is not None:
+                    journal.mark_in_flight(index)
+                start = time.monotonic()
+                # 本次尝试的遥测记录，请求路径上的各层通过 contextvars 填写
+                metrics = telemetry.start_request(
+                    index=index, attempt=attempt, queue_wait=start - queued
+                )
+                try:
+                    result = await process(example)
+                    records = [result] if isinstance(result, dict) else result
+                except asyncio.CancelledError:
+                    # 被 `cancel` 取消：归还并发配额，不记日志和死信，种子留给接手的 worker
+                    await controller.release(Outcome.ABORTED, time.monotonic() - start)
+                    finish(metrics, Outcome.ABORTED.value, "cancelled")
+                    raise
+                except Exception as e:
+                    outcome = classify_error(e)
+                    await controller.release(outcome, time.monotonic() - start)
+                    reason = f"{type(e).__name__}: {e}"[:500]
+                    finish(metrics, outcome.value, reason)
+                    if cancelled():
+                        return
+                    if outcome == Outcome.ABORTED:
+                        stats.n_aborted += 1
+                    if (
+                        outcome in (Outcome.ABORTED, Outcome.OVERLOAD)
+                        and attempt < self.max_attempts
+                    ):
+                        if journal is not None:
+                            journal.mark_failed(index, reason)
+                        stats.n_retries += 1
+                        if outcome == Outcome.OVERLOAD:
+                            # 过载时控制器已经降低并发，稍等后重新派发
+                            delay = self.retry_delay * 2 ** (attempt - 1)
+                            await asyncio.sleep(delay * (1 + random.random()))
+                        continue
+                    record_failure(example, e, attempt)
+                else:
+                    latency = time.monotonic() - start
+                    if cancelled():
+                        await controller.release(Outcome.ABORTED, latency)
+                        finish(metrics, Outcome.ABORTED.value, "cancelled")
+                        return
+                    if not records:
+                        records = None
+                        await controller.release(Outcome.FAILURE, latency)
+                        finish(metrics, Outcome.FAILURE.value)
+                        record_failure(
+                            example, GenerationError("error", "no result"), attempt
+                        )
+                    else:
+                        await controller.release(Outcome.SUCCESS, latency)
+                        finish(metrics, Outcome.SUCCESS.value)
+                        stats.n_succeeded += 1
+                break
+            if cancelled():
+                return
+            write(buffer.push(position, records))
+            n_finished += 1
+            progress.update(1)
+            progress.set_postfix(concurrency=controller.current_limit)
+            async with window_changed:
+                window_changed.notify_all()
+
+        async def cancel_in_flight():
+            assert cancel is not None
+            await cancel.wait()
+            for task in list(tasks):
+                task.cancel()
+            async with window_changed:
+                window_changed.notify_all()
+
+        watcher = None if cancel is None else asyncio.create_task(cancel_in_flight())
+
+        positions = iter(release_positions) if release_positions is not None else None
+        for position, example in enumerate(examples):
+            release_position = position if positions is None else next(positions)
+            # 超出重排窗口的数据永远等不到派发，直接报错而不是卡住
+            assert position < release_position + self.reorder_window
+            async with window_changed:
+                await window_changed.wait_for(
+                    lambda: position - buffer.next_position < self.reorder_window
+                    or cancelled()
+                )
+            if position == self.warmup > 0:
+                async with window_changed:
+                    await window_changed.wait_for(
+                        lambda: n_finished >= self.warmup or cancelled()
+                    )
+            if cancelled():
+                print("[engine] Cancelled, stopping dispatch")
+                break
+            if budget is not None and budget.should_stop():
+                # 没有派发的数据在日志里仍是 pending，可以续跑
+                break
+            task = asyncio.create_task(run_one(release_position, example))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            stats.n_dispatched += 1
+
+        if tasks:
+            # 取消时在途的任务以 CancelledError 结束，其他异常照常抛出
+            for result in await asyncio.gather(*tasks, return_exceptions=True):
+                if isinstance(result, Exception):
+                    raise result
+        if watcher is not None:
+            watcher.cancel()
+        if not cancelled() and len(buffer) > 0:
+            # 按预算停止时，前缀分组里排在后面的种子可能已经派发完成，但它前面的位置
+            # 没有派发；已经付费的结果照常写出，空缺在日志里仍是 pending
+            write(buffer.flush())
+        progress.close()
+        assert cancelled() or len(buffer) == 0
+        return stats
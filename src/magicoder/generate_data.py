@@ -1,15 +1,40 @@
+import asyncio
+import dataclasses
+import functools
 import json
+import os
 import random
-import time
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import cast
+from typing import Any, Callable, Sequence, cast
 
 from datasets import Dataset, load_dataset
 from tqdm.auto import tqdm
 from transformers import HfArgumentParser
 
 import magicoder
+import magicoder.batch_api
+import magicoder.budget
+import magicoder.chat
+import magicoder.concurrency
+import magicoder.dead_letter
+import magicoder.engine
+import magicoder.generation_outputs
+import magicoder.hedging
+import magicoder.journal
+import magicoder.local_generation
+import magicoder.prompt_layout
+import magicoder.rate_limit
+import magicoder.response_cache
+import magicoder.router
+import magicoder.seed_dedup
+import magicoder.seed_filter
+import magicoder.seed_sampler
+import magicoder.sharding
+import magicoder.stream_validator
+import magicoder.stream_watchdog
+import magicoder.telemetry
+import magicoder.token_counter
 
 # DO NOT CHANGE THE FOLLOWING
 SYSTEM = "You are exceptionally skilled at crafting high-quality programming problems and offering precise solutions."
@@ -28,6 +53,28 @@ class Args:
     seed: int = field(default=random.randint(1, pow(2, 31) - 1))
 
     temperature: float = field(default=0.0)
+    prompt_layout: str = field(
+        default="template",
+        metadata={
+            "help": "template: the prompt as written; prefix: move the seed to the end "
+            "so every request shares a byte-identical prefix for provider prompt caches",
+            "choices": list(magicoder.prompt_layout.LAYOUTS),
+        },
+    )
+    cache_warmup: int = field(
+        default=1,
+        metadata={
+            "help": "With the prefix layout, requests that finish before full "
+            "concurrency starts, so the shared prefix is cached first"
+        },
+    )
+    n_completions: int = field(
+        default=1,
+        metadata={
+            "help": "Completions requested per seed in one call; each distinct choice "
+            "becomes a record with a `sub_index`"
+        },
+    )
     # todo model: str = field(default="gpt-3.5-turbo-1106")
     model: str = field(default="deepseek-r1")
     model_max_tokens: int = field(default=8192)
@@ -37,6 +84,25 @@ class Args:
     min_lines: int = field(default=1)
     max_lines: int = field(default=15)
     chunk_size: int = field(default=1000)
+    sampler: str = field(
+        default="shuffle",
+        metadata={
+            "help": "`shuffle` maps and shuffles the whole corpus; `permutation` "
+            "extracts seeds only for the requested window (different seeds, opt-in)",
+            "choices": list(magicoder.seed_sampler.SAMPLERS),
+        },
+    )
+    seed_filter: bool = field(
+        default=False,
+        metadata={
+            "help": "Reject blank, boilerplate, license, minified and generated seeds "
+            "before dispatch (see magicoder.seed_filter)"
+        },
+    )
+    seed_resamples: int = field(
+        default=3,
+        metadata={"help": "Times a rejected seed is re-extracted from its document"},
+    )
 
     dataset_name: str = field(default="bigcode/starcoderdata")
     # data_dir: str | None = field(default="python")
@@ -45,6 +111,202 @@ class Args:
     max_considered_data: int | None = field(default=100000)
 
     stream: bool = field(default=True)
+    stream_validation: bool = field(
+        default=True,
+        metadata={"help": "Abort streamed responses that can no longer be parsed"},
+    )
+    max_tokens_before_problem: int = field(
+        default=256,
+        metadata={"help": "Abort if [Problem Description] is not seen by then"},
+    )
+    max_tokens_before_solution: int | None = field(
+        default=None,
+        metadata={"help": "Abort if [Solution] is not seen by then (default: off)"},
+    )
+    first_token_timeout: float | None = field(
+        default=180.0,
+        metadata={"help": "Cancel a stream with no token after this many seconds"},
+    )
+    inter_chunk_timeout: float | None = field(
+        default=60.0,
+        metadata={"help": "Cancel a stream that stops sending chunks for this long"},
+    )
+    stream_timeout: float | None = field(
+        default=1200.0, metadata={"help": "Cancel a stream running longer than this"}
+    )
+    concurrency: int = field(
+        default=8, metadata={"help": "Number of requests kept in flight (initial)"}
+    )
+    adaptive_concurrency: bool = field(
+        default=True,
+        metadata={"help": "Adjust concurrency with AIMD on 429/5xx and latency"},
+    )
+    max_concurrency: int = field(default=64)
+    max_attempts: int = field(
+        default=3, metadata={"help": "Attempts per seed on 429/5xx/timeouts"}
+    )
+
+    rpm: int | None = field(
+        default=None, metadata={"help": "Requests-per-minute quota shared on this host"}
+    )
+    tpm: int | None = field(
+        default=None, metadata={"help": "Tokens-per-minute quota shared on this host"}
+    )
+    rate_limit_file: str | None = field(
+        default=None,
+        metadata={
+            "help": "State file of the shared rate limiter "
+            "(default: in /tmp, one per endpoint and API key)"
+        },
+    )
+    hedge: bool = field(
+        default=False,
+        metadata={
+            "help": "Send a duplicate of requests with no first token by the observed "
+            "quantile and keep the first good answer"
+        },
+    )
+    hedge_quantile: float = field(default=95.0)
+    hedge_budget: float = field(
+        default=0.05, metadata={"help": "Hedged requests as a fraction of all requests"}
+    )
+    endpoints_file: str | None = field(
+        default=None,
+        metadata={
+            "help": "JSON list of endpoints to route requests across (see magicoder.router)"
+        },
+    )
+    shard_dir: str | None = field(
+        default=None,
+        metadata={
+            "help": "Shared directory for lease-based sharded generation across workers"
+        },
+    )
+    shard_size: int = field(default=1000)
+    lease_ttl: float = field(
+        default=300.0,
+        metadata={"help": "Seconds before a shard of a silent worker is taken over"},
+    )
+    metrics_file: str | None = field(
+        default=None,
+        metadata={"help": "Append per-request metrics (JSON lines) to this file"},
+    )
+    prometheus_file: str | None = field(
+        default=None,
+        metadata={"help": "Periodically write Prometheus text-format metrics here"},
+    )
+    response_cache: str | None = field(
+        default=None,
+        metadata={"help": "SQLite file caching raw responses; hits are replayed"},
+    )
+    budget_usd: float = field(
+        default=0.0,
+        metadata={"help": "Stop dispatching once this much is spent (0: no limit)"},
+    )
+    budget_tokens: int = field(
+        default=0,
+        metadata={"help": "Stop dispatching after this many tokens (0: no limit)"},
+    )
+    price_prompt: float = field(
+        default=0.0, metadata={"help": "USD per 1M prompt tokens, for the budget"}
+    )
+    price_cached_prompt: float | None = field(
+        default=None,
+        metadata={
+            "help": "USD per 1M prompt tokens served from the provider's prefix cache "
+            "(default: the prompt price)"
+        },
+    )
+    price_completion: float = field(
+        default=0.0,
+        metadata={
+            "help": "USD per 1M completion tokens including reasoning, for the budget"
+        },
+    )
+    budget_report_interval: float = field(
+        default=60.0,
+        metadata={"help": "Seconds between spend / projection reports"},
+    )
+    plan_pilot: int = field(
+        default=0,
+        metadata={
+            "help": "Dry run: generate this many seeds as a pilot, then print the "
+            "projected tokens, cost and time for the whole seed range and exit"
+        },
+    )
+    seed_index: str | None = field(
+        default=None,
+        metadata={
+            "help": "SQLite index of dispatched seeds shared across runs and shards; "
+            "exact and near-duplicate seeds are skipped before any request is sent"
+        },
+    )
+    dedup_threshold: float = field(
+        default=0.85,
+        metadata={"help": "Estimated Jaccard similarity of near-duplicate seeds"},
+    )
+    mode: str = field(
+        default="online",
+        metadata={
+            "help": "online: real-time requests; batch: the provider's Batch API "
+            "(half price, no RPM limit, results within the completion window); "
+            "local: batched generation with the Hugging Face model at `model`"
+        },
+    )
+    batch_max_requests: int = field(
+        default=50000, metadata={"help": "Requests per batch file"}
+    )
+    batch_max_mb: int = field(default=100, metadata={"help": "Size of a batch file"})
+    batch_poll_interval: float = field(
+        default=60.0, metadata={"help": "Seconds between batch status checks"}
+    )
+    batch_completion_window: str = field(default="24h")
+    local_batch_size: int = field(
+        default=8, metadata={"help": "Prompts per batch in local mode"}
+    )
+    local_max_batch_tokens: int = field(
+        default=65536,
+        metadata={
+            "help": "Batch size x (longest prompt + max_new_tokens) limit in local mode"
+        },
+    )
+    local_dtype: str = field(
+        default="auto", metadata={"help": "Weight dtype in local mode, e.g. bfloat16"}
+    )
+    retry_passes: int = field(
+        default=1,
+        metadata={
+            "help": "Passes re-dispatching dead-lettered seeds after the main pass, "
+            "with per-error-class retry policies"
+        },
+    )
+    output_flush_records: int = field(
+        default=64, metadata={"help": "Records buffered before a group write"}
+    )
+    output_flush_interval: float = field(
+        default=1.0,
+        metadata={"help": "Seconds after which buffered records are written"},
+    )
+    output_fsync: str = field(
+        default="commit",
+        metadata={
+            "help": "fsync policy of the output: commit (before each journal fsync), "
+            "flush (after every group write) or never"
+        },
+    )
+    output_segment_mb: int = field(
+        default=0,
+        metadata={
+            "help": "Rotate the output into segments of this size (0: no rotation)"
+        },
+    )
+    reasoning_store: bool = field(
+        default=False,
+        metadata={
+            "help": "Write `reasoning_content` to a compressed side store next to the "
+            "output and keep only a `reasoning_ref` in each record"
+        },
+    )
 
     tag: str = field(
         default="",
@@ -53,6 +315,12 @@ class Args:
         },
     )
 
+    def dataset_fingerprint(self) -> str:
+        """语料的指纹，与 raw_index 一起标识种子来自哪个文档。"""
+        return magicoder.utils.compute_fingerprint(
+            self.dataset_name, self.data_dir, hash_length=8
+        )
+
     def fingerprint(self, prompt_template: str) -> str:
         """
         计算基于给定 prompt_template 的指纹值。
@@ -80,6 +348,18 @@ class Args:
             SYSTEM,
             ERROR_MARGIN,
         )
+        # 旧的 shuffle 采样不计入，保证此前生成的数据指纹不变
+        if self.sampler != "shuffle":
+            args += (self.sampler,)
+        # 预筛会重新提取不合格的种子，同样计入指纹
+        if self.seed_filter:
+            args += ("seed_filter", self.seed_resamples)
+        # 每个种子多个回复时输出的结构不同（带 sub_index），同样计入指纹
+        if self.n_completions > 1:
+            args += ("n_completions", self.n_completions)
+        # 布局改变了提示本身
+        if self.prompt_layout != "template":
+            args += ("prompt_layout", self.prompt_layout)
         return magicoder.utils.compute_fingerprint(*args, hash_length=5)
 
 
@@ -102,27 +382,43 @@ def map_dataset(examples: dict, indices: list[int], args: Args) -> dict:
     seed_snippets = [
         extract_seed_code(args, content) for content in examples["content"]
     ]
+    if (seed_filter := magicoder.seed_filter.get_seed_filter()) is not None:
+        # 不合格的种子在原文档中重新截取
+        # 这里只产出列，接受率在 `select_seeds` 里按选中的窗口统计
+        seed_snippets, rejections, resamples = seed_filter.refine(
+            seed_snippets, lambda i: extract_seed_code(args, examples["content"][i])
+        )
+        return {
+            "seed": seed_snippets,
+            "raw_index": indices,
+            "rejection": rejections,
+            "resamples": resamples,
+        }
     return {
         "seed": seed_snippets,
         "raw_index": indices,
     }
 
 
-def extract_seed_code(args: Args, document: str) -> str:
+def extract_seed_code(
+    args: Args, document: str, rng: random.Random | None = None
+) -> str:
     """
     从文档中提取种子代码。
     
     Args:
         args (Args): 参数对象，包含最小行数（min_lines）和最大行数（max_lines）等参数。
         document (str): 原始文档字符串。
+        rng (random.Random | None): 使用的随机数生成器，默认为全局的 `random`。
     
     Returns:
         str: 从文档中随机提取的一段代码字符串。
     
     """
     lines = document.splitlines(keepends=True)
-    start_index = random.choice(range(len(lines)))
-    n_lines_to_consider = random.randint(args.min_lines, args.max_lines)
+    generator = random if rng is None else rng
+    start_index = generator.choice(range(len(lines)))
+    n_lines_to_consider = generator.randint(args.min_lines, args.max_lines)
     code = "".join(lines[start_index : start_index + n_lines_to_consider])
     return code
 
@@ -156,6 +452,735 @@ def parse_problem_solution(response_text: str) -> tuple[str, str] | None:
     return problem, solution
 
 
+def build_request(example: dict, args: Args, prompt_template: str) -> dict:
+    """
+    为一条种子代码构造对话补全的请求参数，实时模式和 Batch 模式共用。
+
+    Args:
+        example (dict): 数据集中的一项，包含 "seed"、"raw_index" 和 "index"。
+        args (Args): 命令行参数。
+        prompt_template (str): 提示模板，包含 `{code}` 占位符。
+
+    Returns:
+        dict: messages、max_tokens、n 和 temperature。
+
+    Raises:
+        GenerationError: 提示已经占满上下文时抛出。
+
+    """
+    # 构造与OpenAI交互的消息，按布局决定种子在提示中的位置
+    messages = magicoder.prompt_layout.build_messages(
+        SYSTEM, prompt_template, example["seed"], args.prompt_layout
+    )
+
+    # 确保生成的内容在模型的上下文大小范围内
+    max_new_tokens = min(
+        args.max_new_tokens,
+        args.model_max_tokens
+        - magicoder.token_counter.count_message_tokens(messages, args.model)
+        # 误差裕量（例如，由于对话标记）
+        - ERROR_MARGIN,
+    )
+    if max_new_tokens <= 0:
+        raise magicoder.dead_letter.GenerationError(
+            "no_room", f"No room for new tokens: {max_new_tokens}"
+        )
+
+    return dict(
+        messages=messages,
+        max_tokens=max_new_tokens,
+        n=args.n_completions,
+        temperature=args.temperature,
+    )
+
+
+def build_record(
+    example: dict, result: magicoder.chat.ChatResult, sub_index: int | None = None
+) -> dict:
+    """
+    检查一个 choice 的回复并构造输出数据。
+
+    Args:
+        sub_index (int | None): choice 在回复中的位置，每个种子请求多个回复时写入输出。
+
+    Raises:
+        GenerationError: 生成未自然结束、无法解析或问题/解答为空时抛出，带有原始回复。
+
+    """
+    # 失败时连同原始回复一起写入死信队列
+    raw_response = dict(
+        finish_reason=result.finish_reason,
+        content=result.content,
+        reasoning_content=result.reasoning_content,
+    )
+    # 判断生成是否是自然结束（"stop"）还是因为截断或其他原因
+    if result.finish_reason != "stop":
+        magicoder.telemetry.observe(parse_outcome="incomplete")
+        raise magicoder.dead_letter.GenerationError(
+            "incomplete", f"Response incomplete: {result.finish_reason}", raw_response
+        )
+    parsing_result = parse_problem_solution(result.content)
+    if parsing_result is None:
+        magicoder.telemetry.observe(parse_outcome="unparseable")
+        raise magicoder.dead_letter.GenerationError(
+            "unparseable", "Failed to parse response.", raw_response
+        )
+    problem, solution = parsing_result
+    if len(problem) == 0 or len(solution) == 0:
+        magicoder.telemetry.observe(parse_outcome="empty")
+        raise magicoder.dead_letter.GenerationError(
+            "empty", "Empty problem or solution.", raw_response
+        )
+    magicoder.telemetry.observe(parse_outcome="ok")
+
+    # 获取大模型响应指纹
+    # 用阿里云调用deepseek r1的response没有指纹，所以这里生成一个随机数就可以
+    fingerprint = "counterfeit " + str(random.randint(0, pow(2, 31) - 1))
+
+    # 构造输出数据
+    # 在这个字典中，seed指的是“种子代码片段”
+    record = dict(
+        raw_index=example["raw_index"],
+        index=example["index"],
+        seed=example["seed"],
+        openai_fingerprint=fingerprint,
+        problem=problem,
+        solution=solution,
+        reasoning_content=result.reasoning_content,  # r1模型的推理过程
+    )
+    if sub_index is not None:
+        record["sub_index"] = sub_index
+    if "retry" in example:
+        # 死信重试生成的记录，见 magicoder.dead_letter
+        record["retry"] = example["retry"]
+    return record
+
+
+def _dedup_key(record: dict) -> tuple[str, str]:
+    # 只忽略空白的差异
+    return (" ".join(record["problem"].split()), " ".join(record["solution"].split()))
+
+
+def build_records(
+    example: dict, result: magicoder.chat.ChatResult, n_completions: int = 1
+) -> list[dict]:
+    """
+    检查回复中的每个 choice 并构造输出数据，实时模式和 Batch 模式共用。
+
+    `n_completions > 1` 时每个可用的 choice 一条记录，`sub_index` 为 choice 的位置（不随去重
+    变化，重跑时保持稳定）；问题和解答（忽略空白）与前面的 choice 相同的丢弃。
+
+    Raises:
+        GenerationError: 没有任何可用的 choice 时抛出第一个 choice 的错误。
+
+    """
+    if n_completions == 1:
+        return [build_record(example, result)]
+    records: list[dict] = []
+    seen: set[tuple[str, str]] = set()
+    first_error: magicoder.dead_letter.GenerationError | None = None
+    for sub_index, choice in enumerate(result.choices):
+        try:
+            record = build_record(example, choice, sub_index)
+        except magicoder.dead_letter.GenerationError as e:
+            first_error = first_error or e
+            continue
+        if (key := _dedup_key(record)) in seen:
+            continue
+        seen.add(key)
+        records.append(record)
+    if len(records) == 0:
+        assert first_error is not None
+        raise first_error
+    magicoder.telemetry.observe(
+        parse_outcome="ok",
+        n_choices=len(result.choices),
+        n_distinct_choices=len(records),
+    )
+    return records
+
+
+async def generate_one(
+    example: dict, args: Args, prompt_template: str, router: magicoder.router.Router
+) -> list[dict]:
+    """
+    为一条种子代码生成问题和解决方案。
+
+    Args:
+        example (dict): 数据集中的一项，包含 "seed"、"raw_index" 和 "index"。
+        args (Args): 命令行参数。
+        prompt_template (str): 提示模板，包含 `{code}` 占位符。
+        router (Router): 在一个或多个接口之间分配请求。
+
+    Returns:
+        list[dict]: 输出数据，`n_completions > 1` 时每个不重复的 choice 一条。
+
+    Raises:
+        Exception: API 调用失败、生成未自然结束或无法解析时抛出，由生成引擎记录，
+            用完重试次数后写入死信队列。
+
+    """
+    request = build_request(example, args, prompt_template)
+
+    # 边收流边检查段落标记，注定无法解析的回复提前中止，由生成引擎立即重新派发。
+    # 多个回复时一个 choice 不合格不代表其他的也不合格，不做提前中止
+    validator = (
+        magicoder.stream_validator.SectionValidator(
+            max_tokens_before_problem=args.max_tokens_before_problem,
+            max_tokens_before_solution=args.max_tokens_before_solution,
+        )
+        if args.stream and args.stream_validation and args.n_completions == 1
+        else None
+    )
+
+    # 由路由器选择接口；不在这里退避重试，429/5xx 交给生成引擎降低并发后重新派发
+    with magicoder.response_cache.track_keys() as cache_keys:
+        result = await router.complete(
+            validator=validator,
+            # 提问经常超时，用stream解决
+            stream=args.stream,
+            **request,
+        )
+    try:
+        return build_records(example, result, args.n_completions)
+    except magicoder.dead_letter.GenerationError:
+        # 不可用的回复不留在缓存里，否则死信重试只会回放同一个坏回复
+        magicoder.response_cache.evict(cache_keys)
+        raise
+
+
+def select_seeds(
+    args: Args, dataset: Dataset, start_index: int, end_index: int
+) -> Dataset:
+    """取出打乱后 [start_index, end_index) 的种子代码，包含 "seed"、"raw_index" 和 "index"。"""
+    seed_filter = magicoder.seed_filter.get_seed_filter()
+    if args.sampler == "shuffle":
+        # 对数据集进行映射处理
+        # map_fn = get_map_dataset(args)
+        dataset = dataset.map(
+            function=map_dataset,
+            fn_kwargs=dict(args=args),
+            with_indices=True,
+            batched=True,
+            batch_size=args.chunk_size,
+        )
+
+        # 打乱数据集
+        dataset = dataset.shuffle(seed=args.seed)
+
+        # 为每个数据项添加索引
+        dataset = dataset.map(lambda _, index: {"index": index}, with_indices=True)
+
+        # 因为这里的dataset已经是打乱了，所以这里虽然选择了一些数据，但是其实本质上是随机的
+        dataset = dataset.select(range(start_index, end_index))
+    else:
+        # 打乱后的位置在 O(1) 内映射到原始行，只为请求的窗口提取种子代码
+        dataset = magicoder.seed_sampler.select_window(
+            dataset,
+            seed=args.seed,
+            start_index=start_index,
+            end_index=end_index,
+            extract=functools.partial(extract_seed_code, args),
+            seed_filter=seed_filter,
+        )
+    if seed_filter is not None:
+        seed_filter.observe(dataset["rejection"], dataset["resamples"])
+    return dataset
+
+
+def skip_duplicate_seeds(
+    dataset: Dataset,
+    journal: magicoder.journal.GenerationJournal,
+    seed_index: magicoder.seed_dedup.SeedIndex,
+    source: str,
+) -> Dataset:
+    """
+    在派发前去掉与索引中已有种子重复的种子，并在日志中记为 skipped。
+
+    这里只查询不登记，种子写出之后才登记到索引中（见 `generate_window`）。
+    """
+    duplicates = seed_index.find_duplicates(
+        dataset["seed"], dataset["raw_index"], source
+    )
+    kept: list[int] = []
+    for position, (index, duplicate) in enumerate(zip(dataset["index"], duplicates)):
+        if duplicate is None:
+            kept.append(position)
+        else:
+            duplicate_source, raw_index = duplicate
+            journal.mark_skipped(
+                index, f"Duplicate seed of {duplicate_source}:{raw_index}"
+            )
+    if len(kept) < len(dataset):
+        print(f"[dedup] Skipped {len(dataset) - len(kept)} duplicate seeds")
+    return dataset.select(kept)
+
+
+def request_metrics(
+    example: dict, usage: Any, records: list[dict] | None = None
+) -> magicoder.telemetry.RequestMetrics:
+    """批处理和本地生成没有请求上下文，按 usage 和写出的记录补一条请求记录。"""
+    return magicoder.telemetry.RequestMetrics(
+        index=example["index"],
+        **magicoder.telemetry.usage_fields(usage),
+        parse_outcome=None if records is None else "ok",
+        n_distinct_choices=None if records is None else len(records),
+    )
+
+
+def with_temperature(args: Args, temperature: float | None) -> Args:
+    """重试轮使用的参数，temperature 为 None 时沿用原来的温度。"""
+    if temperature is None:
+        return args
+    return dataclasses.replace(args, temperature=temperature)
+
+
+async def generate_batch(
+    args: Args,
+    examples: list[dict],
+    path: Path,
+    prompt_template: str,
+    router: magicoder.router.Router,
+    write_record: Callable[[dict], None],
+    journal: magicoder.journal.GenerationJournal,
+    dead_letters: magicoder.dead_letter.DeadLetterStore,
+    cancel: asyncio.Event | None = None,
+) -> magicoder.engine.EngineStats:
+    """
+    用服务商的 Batch API 生成一个窗口：构建批文件、提交、轮询并流式导入结果，
+    之后按死信队列的重试策略再提交新一轮。
+
+    Args:
+        examples (list[dict]): 尚未完成的种子。
+        path (Path): 输出文件，批任务目录在它旁边，续跑时接着轮询已提交的批次。
+        router (Router): 使用其中第一个 "openai" 接口的客户端和模型。
+        cancel (asyncio.Event | None): 设置后不再导入结果、提交新批次，已提交的批次留给
+            接手的 worker 续跑。
+
+    Returns:
+        EngineStats: 本窗口的统计。
+
+    """
+    endpoint = next((e for e in router.endpoints if e.config.kind == "openai"), None)
+    assert endpoint is not None, "Batch mode needs an OpenAI-compatible endpoint"
+    job = magicoder.batch_api.BatchJob(
+        magicoder.batch_api.batch_dir_for(path),
+        endpoint.openai_client(),
+        completion_window=args.batch_completion_window,
+    )
+    fingerprint = args.fingerprint(prompt_template)
+    examples_by_index = {example["index"]: example for example in examples}
+    budget = magicoder.budget.get_budget()
+
+    def cancelled() -> bool:
+        return cancel is not None and cancel.is_set()
+
+    def ingest_line(line: dict, stats: magicoder.engine.EngineStats):
+        fail = magicoder.engine.FailureRecorder(stats, journal, dead_letters)
+        index = magicoder.batch_api.index_from_custom_id(line["custom_id"], fingerprint)
+        if journal.status(index).state == magicoder.journal.IndexState.DONE:
+            # 中断前已经导入过
+            return
+        example = examples_by_index[index]
+        try:
+            if (
+                error_class := magicoder.batch_api.result_error_class(line)
+            ) is not None:
+                raise magicoder.dead_letter.GenerationError(
+                    error_class,
+                    "Batch request failed: "
+                    + json.dumps(line.get("error") or line.get("response"))[:300],
+                    line.get("response") or line.get("error"),
+                )
+            result = magicoder.chat.ChatResult.from_response(line["response"]["body"])
+            magicoder.telemetry.observe_usage(result.usage)
+            records = build_records(example, result, args.n_completions)
+        except Exception as e:
+            if budget is not None:
+                budget.record(
+                    request_metrics(
+                        example,
+                        ((line.get("response") or {}).get("body") or {}).get("usage"),
+                    )
+                )
+            fail(example, e)
+        else:
+            if budget is not None:
+                budget.record(request_metrics(example, result.usage, records))
+            for record in records:
+                write_record(record)
+            journal.mark_done(index)
+            dead_letters.resolve(index)
+            stats.n_succeeded += 1
+
+    async def wait_and_ingest(stats: magicoder.engine.EngineStats):
+        fail = magicoder.engine.FailureRecorder(stats, journal, dead_letters)
+        await job.submit()
+        while not await job.refresh():
+            if cancelled():
+                return
+            await asyncio.sleep(args.batch_poll_interval)
+        for batch in job.pending():
+            async for line in job.results(batch):
+                if cancelled():
+                    return
+                ingest_line(line, stats)
+            # 批次过期或被取消时，没有返回结果的请求也计为失败，交给重试
+            with (job.directory / batch.file).open("r") as f:
+                for request in map(json.loads, f):
+                    index = magicoder.batch_api.index_from_custom_id(
+                        request["custom_id"], fingerprint
+                    )
+                    if journal.status(index).state in (
+                        magicoder.journal.IndexState.PENDING,
+                        magicoder.journal.IndexState.IN_FLIGHT,
+                    ):
+                        fail(
+                            examples_by_index[index],
+                            magicoder.dead_letter.GenerationError(
+                                "overload", f"No result from {batch.status} batch"
+                            ),
+                        )
+            job.mark_ingested(batch)
+
+    async def run_pass(
+        batches: dict[float | None, Sequence[dict]]
+    ) -> magicoder.engine.EngineStats:
+        # 同一轮不同温度的种子放在一起提交；已提交的批次无法中途停下，预算只能阻止提交新一轮
+        stats = magicoder.engine.EngineStats()
+        if cancelled():
+            return stats
+        fail = magicoder.engine.FailureRecorder(stats, journal, dead_letters)
+        requests: list[dict] = []
+        for temperature, pass_examples in batches.items():
+            pass_args = with_temperature(args, temperature)
+            pass_examples = magicoder.dead_letter.with_retry_temperature(
+                pass_examples, pass_args.temperature
+            )
+            for example in pass_examples:
+                examples_by_index[example["index"]] = example
+                try:
+                    body = build_request(example, pass_args, prompt_template)
+                except magicoder.dead_letter.GenerationError as e:
+                    fail(example, e)
+                    continue
+                journal.mark_in_flight(example["index"])
+                requests.append(
+                    magicoder.batch_api.batch_request(
+                        magicoder.batch_api.custom_id_for(
+                            fingerprint, example["index"]
+                        ),
+                        dict(model=endpoint.config.model, **body),
+                    )
+                )
+        if len(requests) > 0:
+            job.prepare(requests, args.batch_max_requests, args.batch_max_mb << 20)
+            stats.n_dispatched += len(requests)
+            await wait_and_ingest(stats)
+        return stats
+
+    resumed = magicoder.engine.EngineStats()
+    if len(job.pending()) > 0:
+        print("[batch] Resuming", job.summary())
+        await wait_and_ingest(resumed)
+    stats = await magicoder.engine.run_with_retries(
+        [
+            example
+            for example in examples
+            if journal.status(example["index"]).state
+            != magicoder.journal.IndexState.DONE
+        ],
+        run_pass,
+        dead_letters,
+        args.retry_passes,
+        cancel,
+    )
+    stats.add(resumed)
+    if args.retry_passes > 0:
+        # 恢复的批次同样计入，失败数仍以死信队列中剩下的为准
+        stats.n_failed = len(dead_letters)
+    print("[batch]", job.summary())
+    return stats
+
+
+async def generate_local(
+    args: Args,
+    examples: list[dict],
+    prompt_template: str,
+    write_record: Callable[[dict], None],
+    journal: magicoder.journal.GenerationJournal,
+    dead_letters: magicoder.dead_letter.DeadLetterStore,
+    cancel: asyncio.Event | None = None,
+) -> magicoder.engine.EngineStats:
+    """
+    用本地模型生成一轮：提示按长度分批，在线程里调用 `ModelContext.complete`，
+    结果经过与实时模式相同的解析、日志和死信队列。
+
+    Args:
+        examples (list[dict]): 本轮要生成的种子。
+        cancel (asyncio.Event | None): 设置后不再生成新的批次，正在生成的批次结果丢弃。
+
+    Returns:
+        EngineStats: 本轮的统计。
+
+    """
+    generator = magicoder.local_generation.get_local_generator()
+    assert (
+        generator is not None
+    ), "Local mode needs magicoder.local_generation.configure"
+    stats = magicoder.engine.EngineStats()
+    budget = magicoder.budget.get_budget()
+    fail = magicoder.engine.FailureRecorder(stats, journal, dead_letters)
+
+    requests: list[tuple[dict, dict]] = []
+    for example in examples:
+        try:
+            requests.append((example, build_request(example, args, prompt_template)))
+        except magicoder.dead_letter.GenerationError as e:
+            fail(example, e)
+    prompts = [generator.render(request["messages"]) for _, request in requests]
+    lengths = generator.prompt_lengths(prompts)
+    # 本地模型的上下文可能比 `model_max_tokens` 小，放不下的提示直接记为失败
+    max_context_size = generator.model_context.max_context_size
+    pending: list[tuple[dict, int]] = []
+    kept: list[int] = []
+    for position, (example, request) in enumerate(requests):
+        if lengths[position] + 1 >= max_context_size:
+            fail(
+                example,
+                magicoder.dead_letter.GenerationError(
+                    "no_room",
+                    f"Prompt of {lengths[position]} tokens does not fit "
+                    f"the context size {max_context_size}",
+                ),
+            )
+            continue
+        pending.append((example, request["max_tokens"]))
+        kept.append(position)
+    prompts = [prompts[position] for position in kept]
+    lengths = [lengths[position] for position in kept]
+
+    progress = tqdm(total=len(pending))
+    for batch in magicoder.local_generation.length_batches(
+        lengths, generator.batch_size, generator.max_batch_tokens, args.max_new_tokens
+    ):
+        if budget is not None and budget.should_stop():
+            # 没有派发的种子在日志里仍是 pending，可以续跑
+            break
+        if cancel is not None and cancel.is_set():
+            break
+        for position in batch:
+            journal.mark_in_flight(pending[position][0]["index"])
+        stats.n_dispatched += len(batch)
+        # 长度相近的提示在同一批里，用其中最小的生成长度，保证每个提示都不超过上下文
+        max_new_tokens = min(pending[position][1] for position in batch)
+        try:
+            results = await asyncio.to_thread(
+                generator.complete,
+                [prompts[position] for position in batch],
+                max_new_tokens,
+                args.temperature,
+            )
+        except Exception as e:
+            for position in batch:
+                fail(pending[position][0], e)
+            progress.update(len(batch))
+            continue
+        if cancel is not None and cancel.is_set():
+            break
+        for position, result in zip(batch, results):
+            example = pending[position][0]
+            try:
+                records = build_records(example, result, args.n_completions)
+            except Exception as e:
+                if budget is not None:
+                    budget.record(request_metrics(example, result.usage))
+                fail(example, e)
+                continue
+            if budget is not None:
+                budget.record(request_metrics(example, result.usage, records))
+            for record in records:
+                write_record(record)
+            journal.mark_done(example["index"])
+            dead_letters.resolve(example["index"])
+            stats.n_succeeded += 1
+        progress.update(len(batch))
+    progress.close()
+    return stats
+
+
+async def generate_window(
+    args: Args,
+    dataset: Dataset,
+    path: Path,
+    window: tuple[int, int],
+    prompt_template: str,
+    router: magicoder.router.Router,
+    engine: magicoder.engine.GenerationEngine,
+    cancel: asyncio.Event | None = None,
+) -> magicoder.engine.EngineStats:
+    """
+    为一个窗口生成数据，输出追加写入 `path`，并用同名日志记录每个 index 的状态。
+
+    Args:
+        dataset (Dataset): `select_seeds` 取出的窗口。
+        path (Path): 输出文件，已存在时只生成日志中尚未完成的 index。
+        window (tuple[int, int]): 窗口的 [start, end)。
+        cancel (asyncio.Event | None): 设置后（分片的租约被接手）立即停止生成，
+            丢弃还没写出的输出和日志，不再写入 `path` 旁边的任何文件。
+
+    Returns:
+        EngineStats: 本窗口的统计。
+
+    """
+    start_index, end_index = window
+    seed_index = magicoder.seed_dedup.get_seed_index()
+    source = args.dataset_fingerprint()
+    # 已写出、尚未登记到去重索引的种子
+    written_seeds: list[tuple[str, int]] = []
+
+    def register_seeds():
+        # 输出落盘之后才登记种子，失败的种子之后仍可以生成
+        if seed_index is not None and len(written_seeds) > 0:
+            seeds, raw_indices = zip(*written_seeds)
+            seed_index.add(seeds, raw_indices, source)
+            written_seeds.clear()
+
+    with magicoder.generation_outputs.open_outputs(
+        path, window, args, cancel, after_sync=register_seeds
+    ) as outputs:
+        journal, dead_letters = outputs.journal, outputs.dead_letters
+        # 只重新派发尚未完成的 index（包括之前失败的）
+        missing = journal.missing()
+        dataset = dataset.select([index - start_index for index in missing])
+        if magicoder.seed_filter.get_seed_filter() is not None:
+            dataset = magicoder.seed_sampler.skip_rejected_seeds(dataset, journal)
+        if seed_index is not None:
+            dataset = skip_duplicate_seeds(dataset, journal, seed_index, source)
+        print(f"{len(dataset)} of {end_index - start_index} seeds to generate")
+        if (budget := magicoder.budget.get_budget()) is not None:
+            budget.expect(len(dataset))
+
+        def write_record(data: dict):
+            if seed_index is not None:
+                written_seeds.append((data["seed"], data["raw_index"]))
+            outputs.write(data)
+
+        async def run_pass(
+            batches: dict[float | None, Sequence[dict]]
+        ) -> magicoder.engine.EngineStats:
+            stats = magicoder.engine.EngineStats()
+            for temperature, examples in batches.items():
+                pass_args = with_temperature(args, temperature)
+                examples = magicoder.dead_letter.with_retry_temperature(
+                    examples, pass_args.temperature
+                )
+                if args.mode == "local":
+                    stats.add(
+                        await generate_local(
+                            pass_args,
+                            list(examples),
+                            prompt_template,
+                            write_record,
+                            journal,
+                            dead_letters,
+                            cancel,
+                        )
+                    )
+                    continue
+                release_positions = None
+                if args.prompt_layout == "prefix":
+                    # 重排窗口内开头相同的种子相邻派发，共有的部分也能命中缓存；输出仍按 index 写出
+                    assert engine.reorder_window is not None
+                    grouped = magicoder.prompt_layout.group_by_prefix(
+                        list(examples), engine.reorder_window
+                    )
+                    release_positions = [position for position, _ in grouped]
+                    examples = [example for _, example in grouped]
+                stats.add(
+                    await engine.run(
+                        examples=iter(examples),
+                        process=functools.partial(
+                            generate_one,
+                            args=pass_args,
+                            prompt_template=prompt_template,
+                            router=router,
+                        ),
+                        sink=write_record,
+                        total=len(examples),
+                        journal=journal,
+                        dead_letters=dead_letters,
+                        cancel=cancel,
+                        release_positions=release_positions,
+                    )
+                )
+            return stats
+
+        if args.mode == "batch":
+            stats = await generate_batch(
+                args,
+                list(dataset),
+                path,
+                prompt_template,
+                router,
+                write_record,
+                journal,
+                dead_letters,
+                cancel,
+            )
+        else:
+            stats = await magicoder.engine.run_with_retries(
+                dataset, run_pass, dead_letters, args.retry_passes, cancel
+            )
+    return stats
+
+
+async def generate_shards(
+    args: Args,
+    dataset: Dataset,
+    coordinator: magicoder.sharding.ShardCoordinator,
+    prompt_template: str,
+    router: magicoder.router.Router,
+    engine: magicoder.engine.GenerationEngine,
+) -> magicoder.engine.EngineStats:
+    """不断认领分片并生成，直到没有可认领的分片。"""
+    stats = magicoder.engine.EngineStats()
+    budget = magicoder.budget.get_budget()
+    loop = asyncio.get_running_loop()
+    while (shard := coordinator.claim()) is not None:
+        print(f"[shard] {coordinator.worker_id} claimed {shard.name}")
+        # 租约被接手时由续约线程设置，立即取消本分片的生成，两个 worker 不会同时写一个分片
+        lost = asyncio.Event()
+        with coordinator.hold(
+            shard, on_lost=lambda: loop.call_soon_threadsafe(lost.set)
+        ) as keeper:
+            path = coordinator.segment_path(shard)
+            # 接手别人的分片时，先截掉对方崩溃时写了一半的最后一行
+            magicoder.sharding.repair_segment(path)
+            window = (shard.start, shard.end)
+            shard_stats = await generate_window(
+                args,
+                select_seeds(args, dataset, *window),
+                path,
+                window,
+                prompt_template,
+                router,
+                engine,
+                cancel=lost,
+            )
+            stats.add(shard_stats)
+            if keeper.lost:
+                # 分片已被别人接手，由对方负责完成；丢失租约前写出的 index 在合并时去重
+                continue
+            if budget is not None and budget.exhausted() is not None:
+                # 预算用完时分片可能没有生成完，只释放租约，由之后的 worker 续跑
+                break
+            coordinator.complete(
+                shard, succeeded=shard_stats.n_succeeded, failed=shard_stats.n_failed
+            )
+    return stats
+
+
 def main():
     # 解析命令行参数
     args, *_ = cast(
@@ -171,7 +1196,11 @@ def main():
     split = "train" # 不搞乱七八糟的，直接就是train
 
     # 断言OpenAI客户端不为空
-    assert magicoder.utils.OPENAI_CLIENT is not None
+    assert (
+        args.mode == "local"
+        or args.endpoints_file is not None
+        or magicoder.utils.OPENAI_ASYNC_CLIENT is not None
+    )
 
     # 加载数据集
     # dataset: Dataset = load_dataset(
@@ -189,51 +1218,87 @@ def main():
         num_proc=magicoder.utils.N_CORES,
     )
 
-    # 设置随机种子
-    random.seed(args.seed)
-    # 把args.seed输出到args.dataset_name相同文件夹下的data0_seed.jsonl文件中，其实这行代码也可以处理json
-    seed_save_file = args.dataset_name.replace(".json", "_seed.json")
-    with open(seed_save_file, "w") as f:
-        json.dump({"seed": args.seed}, f)
-    
-
-    # 对数据集进行映射处理
-    # map_fn = get_map_dataset(args)
-    dataset = dataset.map(
-        function=map_dataset,
-        fn_kwargs=dict(args=args),
-        with_indices=True,
-        batched=True,
-        batch_size=args.chunk_size,
+    # 配置与同一台机器上其他进程共享的 RPM/TPM 限流
+    magicoder.rate_limit.configure(
+        args.rpm,
+        args.tpm,
+        args.rate_limit_file,
+        endpoint=os.getenv("OPENAI_BASE_URL"),
+        api_key=os.getenv("OPENAI_API_KEY"),
     )
+    # 重跑时命中缓存的请求直接回放，不再重复付费
+    magicoder.response_cache.configure(args.response_cache)
+    # 已经派发过的种子（包括其他运行和分片）不再生成
+    magicoder.seed_dedup.configure(args.seed_index, args.dedup_threshold)
+    # 空行、许可证、压缩代码等种子在派发前筛掉或重新截取
+    seed_filter = magicoder.seed_filter.configure(args.seed_filter, args.seed_resamples)
+    # 逐请求的遥测，运行结束时打印延迟分位数和 token 产出
+    telemetry = magicoder.telemetry.configure(args.metrics_file, args.prometheus_file)
 
-    # 打乱数据集
-    dataset = dataset.shuffle(seed=args.seed)
+    assert args.mode in ("online", "batch", "local"), f"Unknown mode: {args.mode}"
+    assert args.n_completions >= 1, "n_completions must be positive"
+    assert (
+        args.mode != "local" or args.n_completions == 1
+    ), "Local mode generates one completion per seed"
+    assert (
+        args.plan_pilot == 0 or args.shard_dir is None
+    ), "Plan a pilot without --shard_dir"
 
-    # 为每个数据项添加索引
-    dataset = dataset.map(lambda _, index: {"index": index}, with_indices=True)
+    if args.mode == "local":
+        # 本地模式用 `model` 指定的检查点生成，进程内的所有窗口和分片共用一份权重
+        magicoder.local_generation.configure(
+            args.model,
+            batch_size=args.local_batch_size,
+            max_batch_tokens=args.local_max_batch_tokens,
+            dtype=args.local_dtype,
+        )
+
+    # 读取提示模板
+    prompt_template = Path("data/prompt.txt").read_text()
+    if args.prompt_layout == "prefix":
+        prefix = magicoder.prompt_layout.stable_prefix(
+            SYSTEM, prompt_template, args.prompt_layout
+        )
+        print(f"[prompt] Requests share a stable prefix of {len(prefix)} characters")
+    # 提前加载分词器，用于按上下文长度计算每个请求的 max_tokens
+    magicoder.token_counter.get_token_counter(args.model)
 
     # 确保每次运行都生成相同的数据，除非默认参数发生变化
     start_index = args.seed_code_start_index
     end_index = min(start_index + args.max_new_data, len(dataset))
-    # TODO 其实一个文件比如data0执行了好多次，所以seed文件的值被覆盖好多次了，那么数据不再正确
-    # 1️⃣ 读取原始 JSON 文件
-    with open(seed_save_file, "r") as f:
-        data = json.load(f)  # 加载为字典
-
-    # 2️⃣ 检查是否已有相同字段，若有则覆盖
-    data["start_index"] = start_index
-    data["end_index"] = end_index
 
-    # 3️⃣ 重新写入文件（覆盖写入）
-    with open(seed_save_file, "w") as f:
-        json.dump(data, f, indent=4, ensure_ascii=False)
-
-    # 因为这里的dataset已经是打乱了，所以这里虽然选择了一些数据，但是其实本质上是随机的
-    dataset = dataset.select(range(start_index, end_index))
+    coordinator: magicoder.sharding.ShardCoordinator | None = None
+    if args.shard_dir is not None:
+        # 第一个 worker 创建分片计划，之后的 worker 沿用计划里的 seed，保证各机器取到的种子一致
+        plan = magicoder.sharding.ShardCoordinator.init_plan(
+            args.shard_dir,
+            start=start_index,
+            end=end_index,
+            shard_size=args.shard_size,
+            seed=args.seed,
+            fingerprint=args.fingerprint(prompt_template),
+        )
+        args = dataclasses.replace(args, seed=plan["seed"])
+        assert (
+            plan["start"],
+            plan["end"],
+            plan["shard_size"],
+            plan["fingerprint"],
+        ) == (
+            start_index,
+            end_index,
+            args.shard_size,
+            args.fingerprint(prompt_template),
+        ), f"Arguments do not match the plan in {args.shard_dir}"
+        coordinator = magicoder.sharding.ShardCoordinator(
+            args.shard_dir, lease_ttl=args.lease_ttl
+        )
 
-    # 读取提示模板
-    prompt_template = Path("data/prompt.txt").read_text()
+    # 设置随机种子
+    random.seed(args.seed)
+    # 把args.seed输出到args.dataset_name相同文件夹下的data0_seed.jsonl文件中，其实这行代码也可以处理json
+    seed_save_file = args.dataset_name.replace(".json", "_seed.json")
+    magicoder.utils.record_seed(seed_save_file, args.seed, start_index, end_index)
 
     # 获取时间戳
     timestamp = magicoder.utils.timestamp()
@@ -242,17 +1307,28 @@ def main():
     data_fingerprint = args.fingerprint(prompt_template)
 
     # 检查是否从旧数据继续
-    if args.continue_from is not None:
+    window = (start_index, end_index)
+    if args.plan_pilot > 0:
+        # 试跑只生成范围开头的 N 个种子（采样器已经打乱），输出单独保存
+        window = (start_index, min(start_index + args.plan_pilot, end_index))
+        tag = "" if args.tag == "" else f"-{args.tag}"
+        path = Path(
+            f"pilot{tag}-{data_fingerprint}-{window[0]}_{window[1]}-{timestamp}.jsonl"
+        )
+        print("Planning from a pilot of", window[1] - window[0], "seeds in", path)
+    elif coordinator is not None:
+        print("Sharded generation in", args.shard_dir, coordinator.status())
+    elif args.continue_from is not None:
         assert data_fingerprint in args.continue_from, "Fingerprint mismatch"
         assert f"{start_index}_{end_index}" in args.continue_from, "Index mismatch"
-        old_path = Path(args.continue_from)
-        assert old_path.exists()
-        old_data = magicoder.utils.read_jsonl(old_path)
-        assert len(old_data) > 0
-        last_index = old_data[-1]["index"]
-        n_skipped = last_index - start_index + 1
-        print("Continuing from", old_path)
-        f_out = old_path.open("a")
+        path = Path(args.continue_from)
+        assert path.exists()
+        journal_path = magicoder.journal.journal_path_for(path)
+        if not journal_path.exists():
+            # 旧版本生成的文件没有日志，根据已有的输出补建一份
+            print("No journal found, rebuilding it from", path)
+            magicoder.journal.GenerationJournal.from_output(path, window).close()
+        print("Continuing from", path)
     else:
         # 生成新的输出路径
         tag = "" if args.tag == "" else f"-{args.tag}"
@@ -260,210 +1336,116 @@ def main():
             f"data{tag}-{data_fingerprint}-{start_index}_{end_index}-{timestamp}.jsonl"
         )
         assert not path.exists()
-        f_out = path.open("w")
         print("Saving to", path)
-        n_skipped = 0
 
-    # 遍历数据集，处理每个数据项
-    for index, example in enumerate(tqdm(dataset)):
-        if index < n_skipped:
-            continue
-        assert index + start_index == example["index"]
-        
-        time.sleep(random.randint(10, 30)) # 每次调用前建议等一下，不然怕被查
-
-        # 生成提示
-        prompt = prompt_template.format(code=example["seed"])
-
-        # 确保生成的内容在模型的上下文大小范围内
-        max_new_tokens = min(
-            args.max_new_tokens,
-            args.model_max_tokens
-            # TODO 偷懒不计算输入prompt的token
-            # - magicoder.utils.num_tokens_from_string(prompt, args.model)
-            # 误差裕量（例如，由于对话标记）
-            - ERROR_MARGIN,
+    # 一个或多个 OpenAI 兼容接口，按健康状况加权分配请求
+    # 开启对冲时，慢请求会再发一份，取先成功的那一份
+    hedger = (
+        magicoder.hedging.Hedger(quantile=args.hedge_quantile, budget=args.hedge_budget)
+        if args.hedge
+        else None
+    )
+    # 流卡住时取消并重新派发，一个卡住的连接不会让整个 worker 停下来；0 表示不限制
+    stream_deadlines = magicoder.stream_watchdog.StreamDeadlines(
+        first_token=args.first_token_timeout or None,
+        inter_chunk=args.inter_chunk_timeout or None,
+        total=args.stream_timeout or None,
+    )
+    router = (
+        magicoder.router.Router.from_file(
+            args.endpoints_file, hedger=hedger, stream_deadlines=stream_deadlines
         )
-        if max_new_tokens <= 0:
-            continue
+        if args.endpoints_file is not None
+        else magicoder.router.Router.from_env(
+            args.model, hedger=hedger, stream_deadlines=stream_deadlines
+        )
+    )
 
-        # 构造与OpenAI交互的消息
-        messages = [
-            {"role": "system", "content": SYSTEM},
-            {"role": "user", "content": prompt},
-        ]
-
-        openai_seed = args.seed + example["index"]
-
-        """ error_cnt = 0
-        # 生成响应
-        while error_cnt < args.max_retries:
-            response = magicoder.utils.chat_completions_with_backoff(
-                model=args.model,
-                messages=messages,
-                max_tokens=max_new_tokens,
-                n=1,
-                temperature=args.temperature,
-                # seed=openai_seed,  个人认为这里不需要seed，反而影响效果
-                # 提问经常超时，用stream解决
-                stream=args.stream,    
+    # 并发生成，结果按 index 顺序写出
+    engine = magicoder.engine.GenerationEngine(
+        concurrency=args.concurrency,
+        controller=(
+            magicoder.concurrency.AIMDController(
+                initial_limit=args.concurrency, max_limit=args.max_concurrency
             )
+            if args.adaptive_concurrency
+            else None
+        ),
+        max_attempts=args.max_attempts,
+        # 前缀布局下先让几个请求完成，服务端建立缓存后再放开并发，否则第一波请求全部未命中
+        warmup=args.cache_warmup if args.prompt_layout == "prefix" else 0,
+    )
 
-            # 推理过程
-            reasoning_content = ""
-            is_answering = False   # 判断是否结束思考过程并开始回复
-
-            if args.stream:
-                print("[Streaming]")
-                # 聚合流式响应的内容
-                complete_response = ""
-                for chunk in response:
-                    # 假设每个chunk中，chunk.choices[0].delta.content包含新生成的文本
-                    delta = chunk.choices[0].delta
-
-                    # 检查是否有reasoning_content属性
-                    if not hasattr(delta, 'reasoning_content'):
-                        continue
-
-                    # 处理空内容情况
-                    if not getattr(delta, 'reasoning_content', None) and not getattr(delta, 'content', None):
-                        continue
-
-                    # 处理开始回答的情况
-                    if not getattr(delta, 'reasoning_content', None) and not is_answering:
-                        # print("\n" + "=" * 20 + "完整回复" + "=" * 20 + "\n")
-                        is_answering = True
-
-                    # 处理思考过程
-                    if getattr(delta, 'reasoning_content', None):
-                        # print(delta.reasoning_content, end='', flush=True)
-                        reasoning_content += delta.reasoning_content
-                    # 处理回复内容
-                    elif getattr(delta, 'content', None):
-                        # print(delta.content, end='', flush=True)
-                        complete_response += delta.content
-
-                # 如果没有生成内容，则跳过该样本
-                if not complete_response:
-                    print("[Warning] No content received in streamed response.")
-                    continue
-
-                # 开启流式下，解析问题和解决方案
-                parsing_result = parse_problem_solution(complete_response)
-                if parsing_result is None:
-                    print("[Warning] Failed to parse response:", complete_response)
-                    continue
-
-            else:
-                # 检查响应是否完成
-                choice = response.choices[0]
-                if choice.finish_reason != "stop":
-                    print("[Warning] Response incomplete:", choice.finish_reason)
-                    continue
+    # 按价格累计花费，到达预算时停止派发；不设上限时也用于预测总花费和完成时间
+    budget = magicoder.budget.configure(
+        magicoder.budget.Pricing(
+            args.price_prompt, args.price_completion, args.price_cached_prompt
+        ),
+        max_cost=args.budget_usd or None,
+        max_tokens=args.budget_tokens or None,
+        report_interval=args.budget_report_interval,
+    )
 
-                # 解析问题和解决方案
-                parsing_result = parse_problem_solution(choice.message.content)
-            
-                if parsing_result is None:
-                    print("[Warning] Failed to parse response:", choice.message.content)
-                    continue """
-        
-        success = False
-        parsing_result = None
-        complete_response = ""
-        reasoning_content = ""
-        
+    async def run() -> magicoder.engine.EngineStats:
         try:
-            response = magicoder.utils.chat_completions_with_backoff(
-                model=args.model,
-                messages=messages,
-                max_tokens=max_new_tokens,
-                n=1,
-                temperature=args.temperature,
-                stream=args.stream,    
+            if coordinator is not None:
+                return await generate_shards(
+                    args, dataset, coordinator, prompt_template, router, engine
+                )
+            return await generate_window(
+                args,
+                select_seeds(args, dataset, *window),
+                path,
+                window,
+                prompt_template,
+                router,
+                engine,
             )
-        
-            if args.stream:
-                # print("[Streaming]")
-                # complete_response = ""
-                # reasoning_content = ""
-                is_answering = False   # 判断是否开始回答
-                last_finish_reason = None
-                # 遍历流式返回的每个 chunk
-                for chunk in response:    
-                    # 如果当前 chunk 包含 finish_reason，就记录下来（通常只有最后一个 chunk 会有）
-                    if getattr(chunk.choices[0], "finish_reason",None):
-                        last_finish_reason = chunk.choices[0].finish_reason
-                    
-                    delta = chunk.choices[0].delta
-                    # 处理推理过程文本
-                    if getattr(delta, 'reasoning_content',None):
-                        reasoning_content += delta.reasoning_content
-                    # 处理回复内容
-                    else:
-                        if getattr(delta, 'content',None):
-                            if is_answering == False:
-                                is_answering = True
-                            complete_response += delta.content
-                
-                # 判断生成是否是自然结束（"stop"）还是因为截断或其他原因
-                if last_finish_reason != "stop":
-                    raise Exception(f"Streaming ended with finish_reason: {last_finish_reason} (not natural stop)")
-                parsing_result = parse_problem_solution(complete_response)
-
-            else:
-                choice = response.choices[0]
-                if choice.finish_reason != "stop":
-                    raise Exception("Response incomplete: " + str(choice.finish_reason))
-                parsing_result = parse_problem_solution(choice.message.content)
-            
-            if parsing_result is None:
-                    raise Exception("Failed to parse streamed response.")
-            problem, solution = parsing_result
-            if len(problem) == 0 or len(solution) == 0:
-                print("[Warning] Empty problem or solution:", last_response_content)
-                continue
-            
-            # 如果执行到这里，说明API调用和解析都成功
-            success = True
-        except Exception as e:
-            print(f"[error] API call failed: {e}")
-            # 已经在每一次调用的时候随机等待一段时间了
-            continue
+        finally:
+            await router.aclose()
 
-        
+    stats = asyncio.run(run())
+    print(router.summary())
+    if hedger is not None:
+        print("[hedge]", hedger.summary())
+    if seed_filter is not None:
+        print("[seed_filter]", seed_filter.report())
+    print(
+        f"Done: {stats.n_succeeded} succeeded, {stats.n_failed} failed, "
+        f"{stats.n_aborted} streams aborted early",
+        stats.errors,
+    )
+    telemetry.close()
+    print(json.dumps(telemetry.summary(), indent=2))
 
-        if not success:
-            continue  # 跳过当前样本
-        
-        # 获取大模型响应指纹
-        # fingerprint = response.system_fingerprint
-        # 用阿里云调用deepseek r1的response没有指纹，所以这里生成一个随机数就可以
-        fingerprint = "counterfeit " + str(random.randint(0, pow(2,31)-1))
-        assert fingerprint is not None
-
-        # 构造输出数据
-        # 在这个字典中，seed指的是“种子代码片段”
-        data = dict(
-            raw_index=example["raw_index"],
-            index=example["index"],
-            seed=example["seed"],
-            openai_fingerprint=fingerprint,
-            problem=problem,
-            solution=solution,
-            reasoning_content=reasoning_content, # r1模型的推理过程
+    if args.plan_pilot > 0:
+        # 按试跑观察到的产出率和吞吐推算整个种子范围，吞吐与试跑的并发有关
+        print(f"[plan] Projection for seeds [{start_index}, {end_index}):")
+        print(json.dumps(budget.projection(end_index - start_index), indent=2))
+        return
+    print("[budget]", json.dumps(budget.projection()))
+    if (reason := budget.exhausted()) is not None:
+        resume = (
+            f"rerun with --shard_dir {args.shard_dir}"
+            if coordinator is not None
+            else f"--continue_from {path}"
+        )
+        print(
+            f"[budget] Stopped early: {reason}. Raise the budget and resume with",
+            resume,
         )
 
-        # print(reasoning_content)
-
-        # 打印问题和解决方案
-        # print("[Problem Description]", problem, sep="\n", end="\n\n")
-        # print("[Solution]", solution, sep="\n")
-
-        # 将数据写入文件
-        f_out.write(json.dumps(data) + "\n")
-        # 直接刷新进硬盘
-        f_out.flush()
+    if coordinator is not None:
+        if coordinator.all_done():
+            # 合并是确定且幂等的，最后完成的几个 worker 重复合并也没关系
+            tag = "" if args.tag == "" else f"-{args.tag}"
+            merged_path = Path(args.shard_dir) / (
+                f"data{tag}-{data_fingerprint}-{start_index}_{end_index}.jsonl"
+            )
+            n_written = coordinator.merge(merged_path)
+            print(f"Merged {n_written} records into {merged_path}")
+        else:
+            print("Shards still running elsewhere:", coordinator.status())
 
 
 if __name__ == "__main__":
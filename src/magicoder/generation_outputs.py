@@ -0,0 +1,119 @@
+"""一个窗口的输出文件及其旁路文件
+
+两个生成脚本写出的是同一组文件：
+
+    data-xxx.jsonl              # 成组写出的输出（见 `output_writer`）
+    data-xxx.jsonl.reasoning    # 推理过程的旁路存储（见 `reasoning_store`）
+    data-xxx.jsonl.journal      # 每个 index 的状态（见 `journal`）
+    data-xxx.jsonl.dead         # 用完重试次数的种子（见 `dead_letter`）
+
+`open_outputs` 按固定的顺序打开它们并连好落盘的先后关系：日志 fsync 之前先落盘推理过程，
+再落盘引用它的输出。退出时（包括出错时）按同样的顺序关闭；分片租约被接手时丢弃缓冲。
+"""
+
+import asyncio
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+from magicoder.dead_letter import DeadLetterStore, dead_letter_path_for
+from magicoder.journal import GenerationJournal, journal_path_for
+from magicoder.output_writer import OutputWriter
+from magicoder.reasoning_store import ReasoningStore, detach_reasoning, store_path_for
+
+
+class GenerationOutputs:
+    """
+    Args:
+        path (Path): 输出文件，已存在时追加写入。
+        window (tuple[int, int]): 窗口的 [start, end)。
+        args (Any): 生成脚本的参数，读取其中的 `output_flush_records`、
+            `output_flush_interval`、`output_fsync`、`output_segment_mb` 和 `reasoning_store`。
+        after_sync (Callable[[], None] | None): 输出落盘之后、日志 fsync 之前调用。
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        window: tuple[int, int],
+        args: Any,
+        after_sync: Callable[[], None] | None = None,
+    ):
+        self.path = path
+        self.after_sync = after_sync
+        # 成组写出，日志 fsync 之前先写出缓冲并落盘
+        self.writer = OutputWriter(
+            path,
+            flush_records=args.output_flush_records,
+            flush_interval=args.output_flush_interval,
+            fsync=args.output_fsync,
+            max_segment_bytes=(
+                args.output_segment_mb << 20 if args.output_segment_mb > 0 else None
+            ),
+        )
+        # 推理过程写到旁路存储，主文件里只保留引用
+        self.store = (
+            ReasoningStore(store_path_for(path)) if args.reasoning_store else None
+        )
+        # 日志 fsync 之前先把输出落盘，保证标为 done 的数据一定已经写入
+        self.journal = GenerationJournal(
+            journal_path_for(path), window=window, before_sync=self.sync_output
+        )
+        # 用完重试次数的种子连同原始回复记在这里，主流程结束后按策略再试
+        self.dead_letters = DeadLetterStore(dead_letter_path_for(path))
+
+    def sync_output(self):
+        # 先落盘推理过程，再落盘引用它的输出
+        if self.store is not None:
+            self.store.sync()
+        self.writer.sync()
+        if self.after_sync is not None:
+            self.after_sync()
+
+    def write(self, data: dict):
+        if self.store is not None:
+            data = detach_reasoning(data, self.store)
+        self.writer.write(data)
+
+    def close(self, discard: bool = False):
+        """关闭所有文件；discard 为 True 时缓冲里的输出和日志都不再写出。"""
+        try:
+            self.dead_letters.close()
+            if discard:
+                self.journal.discard()
+                self.writer.discard()
+            else:
+                self.journal.close()
+                self.writer.close()
+        finally:
+            if self.store is not None:
+                self.store.close()
+
+
+@contextmanager
+def open_outputs(
+    path: Path,
+    window: tuple[int, int],
+    args: Any,
+    cancel: asyncio.Event | None = None,
+    after_sync: Callable[[], None] | None = None,
+) -> Iterator[GenerationOutputs]:
+    """
+    打开一个窗口的输出，退出时关闭并打印日志和死信队列的统计。
+
+    Args:
+        cancel (asyncio.Event | None): 退出时已设置（分片的租约被接手）则丢弃缓冲，
+            文件已经归接手的 worker 所有。
+
+    """
+    outputs = GenerationOutputs(path, window, args, after_sync)
+    try:
+        yield outputs
+    finally:
+        outputs.close(discard=cancel is not None and cancel.is_set())
+    print(outputs.journal.counts())
+    if len(outputs.dead_letters) > 0:
+        print(
+            f"[dead_letter] {len(outputs.dead_letters)} seeds left in",
+            outputs.dead_letters.path,
+        )
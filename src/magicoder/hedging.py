@@ -0,0 +1,226 @@
+"""对冲请求（hedged requests），削减生成的长尾延迟
+
+少数 r1 请求要花中位数 10 倍的时间，一个分片什么时候结束往往由这几条决定。开启对冲后，
+如果一个请求到了观测到的 p95 还没有收到第一个 token（流式）或还没有完成（非流式），就再发
+一份相同的请求（优先发给另一个接口），取先成功的那一份，另一份立即取消并关闭连接。
+
+额外的花费由预算控制：对冲次数不超过请求数的 `budget`（默认 5%）。延迟样本不足
+`min_samples` 时不对冲。
+
+每一份请求记在自己的遥测记录上：先成功的一份并入引擎的记录，落后的一份作为 aborted 单独计入
+遥测和运行预算（见 `magicoder.budget`），它已经消耗的 token 同样要付费。被取消的一份到取消时
+为止的时间作为删失样本计入延迟样本（真实值只会更长），否则样本只来自胜出的一份，分位数偏低，
+对冲会越来越频繁。
+"""
+
+import asyncio
+import contextvars
+import time
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, TypeVar
+
+from magicoder import telemetry
+from magicoder.budget import get_budget
+from magicoder.concurrency import Outcome, classify_error, percentile
+
+T = TypeVar("T")
+
+
+@dataclass
+class _Progress:
+    started: float = field(default_factory=time.monotonic)
+    first_token: float | None = None
+    event: asyncio.Event = field(default_factory=asyncio.Event)
+    # 这一份请求的遥测记录，不在请求上下文中时为 None
+    metrics: telemetry.RequestMetrics | None = None
+
+
+# 请求路径上各层填写的字段，胜出的一份并入引擎的记录
+_COPIED_FIELDS = (
+    "endpoint",
+    "prompt_tokens",
+    "completion_tokens",
+    "reasoning_tokens",
+    "cached_tokens",
+    "finish_reason",
+    "stalled",
+)
+
+
+def _merge_metrics(
+    parent: telemetry.RequestMetrics, child: telemetry.RequestMetrics
+) -> None:
+    for name in _COPIED_FIELDS:
+        if (value := getattr(child, name)) is not None:
+            setattr(parent, name, value)
+    parent.retries += child.retries
+    if child.ttft is not None:
+        # 对冲的一份晚于引擎的记录开始，首 token 延迟从引擎开始计时
+        parent.ttft = child.started + child.ttft - parent.started
+
+
+_PROGRESS: contextvars.ContextVar[_Progress | None] = contextvars.ContextVar(
+    "magicoder_hedge_progress", default=None
+)
+
+
+def mark_first_token() -> None:
+    """流式聚合收到第一个 token 时调用，通知对冲器这份请求已经有进展。"""
+    if (progress := _PROGRESS.get()) is not None and progress.first_token is None:
+        progress.first_token = time.monotonic()
+        progress.event.set()
+
+
+class Hedger:
+    """
+    Args:
+        quantile (float): 等待多少分位的“首 token / 完成”时间后对冲。
+        budget (float): 对冲次数占请求数的上限。
+        min_samples (int): 至少有多少个延迟样本才开始对冲。
+        window (int): 只用最近多少个样本估计分位数。
+    """
+
+    def __init__(
+        self,
+        quantile: float = 95.0,
+        budget: float = 0.05,
+        min_samples: int = 50,
+        window: int = 1000,
+    ):
+        assert 0 < quantile < 100 and budget >= 0
+        self.quantile = quantile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.samples: deque[float] = deque(maxlen=window)
+        self.n_requests = 0
+        self.n_hedged = 0
+        self.wins: Counter[str] = Counter()
+
+    def threshold(self) -> float | None:
+        if len(self.samples) < self.min_samples:
+            return None
+        return percentile(list(self.samples), self.quantile)
+
+    def _can_hedge(self) -> bool:
+        return self.n_hedged + 1 <= self.budget * self.n_requests
+
+    def _start(
+        self,
+        attempt: Callable[[], Awaitable[T]],
+        parent: telemetry.RequestMetrics | None,
+    ) -> tuple[asyncio.Task, _Progress]:
+        progress = _Progress()
+
+        async def run() -> T:
+            # 每个 task 有自己的上下文，这里设置的进度和遥测记录只对这一份请求可见
+            _PROGRESS.set(progress)
+            if parent is not None:
+                progress.metrics = telemetry.start_request(
+                    index=parent.index, attempt=parent.attempt
+                )
+            result = await attempt()
+            end = progress.first_token or time.monotonic()
+            self.samples.append(end - progress.started)
+            return result
+
+        return asyncio.create_task(run()), progress
+
+    def _record_loser(
+        self,
+        task: asyncio.Task,
+        progress: _Progress,
+        parent: telemetry.RequestMetrics | None,
+    ) -> None:
+        if task.cancelled():
+            # 删失样本：被取消时还没有首 token 的，真实的等待时间至少这么长
+            end = progress.first_token or time.monotonic()
+            self.samples.append(end - progress.started)
+            outcome, reason = Outcome.ABORTED, "lost the hedge"
+        elif (error := task.exception()) is not None:
+            outcome, reason = classify_error(error), f"{type(error).__name__}: {error}"
+        else:
+            outcome, reason = Outcome.SUCCESS, "lost the hedge"
+        if (metrics := progress.metrics) is None:
+            return
+        if metrics.prompt_tokens is None and parent is not None:
+            # 两份是相同的请求，prompt 一样长
+            metrics.prompt_tokens = parent.prompt_tokens
+        telemetry.finish_request(metrics, outcome.value, reason[:500])
+        if (budget := get_budget()) is not None:
+            budget.record(metrics)
+
+    async def run(self, attempt: Callable[[], Awaitable[T]]) -> T:
+        """
+        发送一份请求，必要时对冲。
+
+        Args:
+            attempt (Callable[[], Awaitable[T]]): 每次调用发送一份新的请求。
+
+        Returns:
+            T: 先成功的那一份的结果；两份都失败时抛出主请求的异常。
+
+        """
+        self.n_requests += 1
+        parent = telemetry.current()
+        primary, progress = self._start(attempt, parent)
+        copies = {primary: ("primary", progress)}
+        pending = {primary}
+        errors: dict[str, BaseException] = {}
+        # 并入引擎记录的一份：先成功的，都失败（或被取消）时为主请求
+        winner = primary
+        try:
+            if (threshold := self.threshold()) is not None:
+                waiter = asyncio.create_task(progress.event.wait())
+                try:
+                    await asyncio.wait(
+                        {primary, waiter},
+                        timeout=threshold,
+                        return_when=asyncio.FIRST_COMPLETED,
+                    )
+                finally:
+                    waiter.cancel()
+                if (
+                    not primary.done()
+                    and not progress.event.is_set()
+                    and self._can_hedge()
+                ):
+                    self.n_hedged += 1
+                    hedge, hedge_progress = self._start(attempt, parent)
+                    copies[hedge] = ("hedge", hedge_progress)
+                    pending.add(hedge)
+                    telemetry.observe(hedged=True)
+            while len(pending) > 0:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    name = copies[task][0]
+                    if (error := task.exception()) is not None:
+                        errors[name] = error
+                        continue
+                    winner = task
+                    if len(copies) > 1:
+                        self.wins[name] += 1
+                        telemetry.observe(hedge_winner=name)
+                    return task.result()
+        finally:
+            # 取消落后的一份；流式聚合在取消时会关闭连接，服务端随之停止生成
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            if parent is not None and (metrics := copies[winner][1].metrics):
+                _merge_metrics(parent, metrics)
+            for task, (_, task_progress) in copies.items():
+                if task is not winner:
+                    self._record_loser(task, task_progress, parent)
+        raise errors.get("primary") or errors["hedge"]
+
+    def summary(self) -> dict:
+        threshold = self.threshold()
+        return dict(
+            requests=self.n_requests,
+            hedged=self.n_hedged,
+            wins=dict(self.wins),
+            threshold=None if threshold is None else round(threshold, 2),
+        )
@@ -0,0 +1,269 @@
+"""复用连接的 OpenAI 兼容 HTTP 客户端
+
+`requests.post` 每次调用都会新建连接并重新做 TLS 握手。这里的客户端维护一个长连接池，
+支持分别设置连接/读取超时，并提供基于 httpx 的异步版本（服务端支持时使用 HTTP/2）。
+异步版本还可以流式（SSE）读取回复，chunk 与 OpenAI 的格式相同，交给 `collect_stream` 聚合。
+"""
+
+import functools
+import json
+import os
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from magicoder import rate_limit, response_cache
+
+try:
+    import h2  # noqa: F401
+
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+@dataclass(frozen=True)
+class XirangConfig:
+    url: str
+    api_key: str
+    model_code: str
+
+    @staticmethod
+    def from_env() -> "XirangConfig":
+        url = os.getenv("XIRANG_BASE_URL")
+        api_key = os.getenv("XIRANG_API_KEY")
+        model_code = os.getenv("MODEL_CODE")
+        # 确保环境变量不为空
+        if not url or not api_key or not model_code:
+            raise ValueError(
+                "❌ 缺少环境变量，请检查 `XIRANG_BASE_URL`, `XIRANG_API_KEY`, `MODEL_CODE` 是否已设置"
+            )
+        return XirangConfig(url=url, api_key=api_key, model_code=model_code)
+
+    @property
+    def headers(self) -> dict[str, str]:
+        return {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}",
+        }
+
+
+def build_chat_payload(
+    model: str,
+    system_message: str,
+    user_message: str,
+    temperature: float = 0,
+    max_tokens: int = 4096,
+) -> dict[str, Any]:
+    return {
+        "messages": [
+            {"role": "system", "content": system_message},
+            {"role": "user", "content": user_message},
+        ],
+        "model": model,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+    }
+
+
+@dataclass
+class ChatHTTPClient:
+    """同步客户端，所有请求共用一个 `requests.Session` 连接池。
+
+    Args:
+        config (XirangConfig): 接口地址、密钥和模型代码。
+        connect_timeout (float): 建立连接的超时时间（秒）。
+        read_timeout (float): 等待响应的超时时间（秒），r1 模型思考时间较长，默认 10 分钟。
+        pool_size (int): 连接池中保持的最大连接数，应不小于并发数。
+    """
+
+    config: XirangConfig
+    connect_timeout: float = field(default=10.0)
+    read_timeout: float = field(default=600.0)
+    pool_size: int = field(default=64)
+
+    def __post_init__(self):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.pool_size, max_retries=0
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update(self.config.headers)
+
+    def post(self, payload: dict[str, Any]) -> dict:
+        response = self.session.post(
+            self.config.url,
+            json=payload,
+            timeout=(self.connect_timeout, self.read_timeout),
+        )
+        response.raise_for_status()  # 检查请求是否成功
+        return response.json()
+
+    def close(self) -> None:
+        self.session.close()
+
+
+@dataclass
+class AsyncChatHTTPClient:
+    """`ChatHTTPClient` 的异步版本，基于 `httpx.AsyncClient`。"""
+
+    config: XirangConfig
+    connect_timeout: float = field(default=10.0)
+    read_timeout: float = field(default=600.0)
+    pool_size: int = field(default=64)
+    http2: bool = field(default=HTTP2_AVAILABLE)
+
+    def __post_init__(self):
+        assert not self.http2 or HTTP2_AVAILABLE, "HTTP/2 requires `pip install h2`"
+        self.client = httpx.AsyncClient(
+            headers=self.config.headers,
+            http2=self.http2,
+            timeout=httpx.Timeout(
+                self.read_timeout, connect=self.connect_timeout, pool=None
+            ),
+            limits=httpx.Limits(
+                max_connections=self.pool_size,
+                max_keepalive_connections=self.pool_size,
+            ),
+        )
+
+    async def post(self, payload: dict[str, Any]) -> dict:
+        response = await self.client.post(self.config.url, json=payload)
+        response.raise_for_status()
+        return response.json()
+
+    async def stream(self, payload: dict[str, Any]) -> AsyncIterator[dict]:
+        """流式请求，逐个返回 SSE 中解析出的 chunk。提前关闭迭代器时连接随之关闭。"""
+        async with self.client.stream(
+            "POST", self.config.url, json=dict(payload, stream=True)
+        ) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line.removeprefix("data:").strip()
+                if data == "[DONE]":
+                    return
+                yield json.loads(data)
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+
+def _lookup_cache(payload: dict) -> tuple[str | None, dict | None]:
+    """返回 (缓存键, 缓存的响应)；未启用缓存时缓存键为 None。"""
+    cache = response_cache.get_response_cache()
+    if cache is None:
+        return None, None
+    # 与 SDK 路径使用同一组参数：n 和 stream 不同，响应的结构也不同
+    key = response_cache.request_key(payload)
+    return key, cache.get(key)
+
+
+def _store_cache(key: str | None, result: dict):
+    cache = response_cache.get_response_cache()
+    if key is not None and cache is not None:
+        cache.put(key, result)
+
+
+def post_with_cache(
+    client: ChatHTTPClient,
+    payload: dict[str, Any],
+    limiter: rate_limit.RateLimiter | None = None,
+) -> dict:
+    """先查响应缓存，未命中时按限流配额等待后再发送请求。"""
+    key, cached = _lookup_cache(payload)
+    if cached is not None:
+        return cached
+    reservation = rate_limit.reserve(
+        payload["messages"], payload.get("max_tokens"), limiter, n=payload.get("n")
+    )
+    try:
+        result = client.post(payload)
+    except Exception:
+        if reservation is not None:
+            reservation.cancel()
+        raise
+    if reservation is not None:
+        reservation.settle(result.get("usage"))
+    _store_cache(key, result)
+    return result
+
+
+async def apost_with_cache(
+    client: AsyncChatHTTPClient,
+    payload: dict[str, Any],
+    limiter: rate_limit.RateLimiter | None = None,
+) -> dict:
+    """`post_with_cache` 的异步版本。"""
+    key, cached = _lookup_cache(payload)
+    if cached is not None:
+        return cached
+    reservation = await rate_limit.async_reserve(
+        payload["messages"], payload.get("max_tokens"), limiter, n=payload.get("n")
+    )
+    try:
+        result = await client.post(payload)
+    except Exception:
+        if reservation is not None:
+            await reservation.async_cancel()
+        raise
+    if reservation is not None:
+        await reservation.async_settle(result.get("usage"))
+    _store_cache(key, result)
+    return result
+
+
+async def astream_with_limit(
+    client: AsyncChatHTTPClient,
+    payload: dict[str, Any],
+    limiter: rate_limit.RateLimiter | None = None,
+) -> AsyncIterator[dict]:
+    """
+    按限流配额等待后流式发送请求，流结束（或中途关闭）时按收到的 usage 结算，
+    没有收到 usage 时按估算值计费。流式响应不写入响应缓存。
+    """
+    reservation = await rate_limit.async_reserve(
+        payload["messages"], payload.get("max_tokens"), limiter, n=payload.get("n")
+    )
+    usage = None
+    try:
+        async for chunk in client.stream(payload):
+            if chunk.get("usage") is not None:
+                usage = chunk["usage"]
+            yield chunk
+    finally:
+        if reservation is not None:
+            await reservation.async_settle(usage)
+
+
+@functools.cache
+def get_http_client() -> ChatHTTPClient:
+    """进程内共享的同步客户端，环境变量只读取一次。"""
+    return ChatHTTPClient(XirangConfig.from_env())
+
+
+_ASYNC_CLIENT_OPTIONS: dict[str, Any] = {}
+_ASYNC_HTTP_CLIENT: AsyncChatHTTPClient | None = None
+
+
+def configure_async_http_client(**options: Any) -> None:
+    """设置下次创建异步客户端时使用的超时、连接池大小等参数。"""
+    global _ASYNC_HTTP_CLIENT
+    _ASYNC_CLIENT_OPTIONS.clear()
+    _ASYNC_CLIENT_OPTIONS.update(options)
+    _ASYNC_HTTP_CLIENT = None
+
+
+def get_async_http_client() -> AsyncChatHTTPClient:
+    """进程内共享的异步客户端。需要在事件循环内首次调用。"""
+    global _ASYNC_HTTP_CLIENT
+    if _ASYNC_HTTP_CLIENT is None:
+        _ASYNC_HTTP_CLIENT = AsyncChatHTTPClient(
+            XirangConfig.from_env(), **_ASYNC_CLIENT_OPTIONS
+        )
+    return _ASYNC_HTTP_CLIENT
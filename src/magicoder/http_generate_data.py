@@ -1,20 +1,32 @@
 """调用天翼云接口，以htpt形式请求deepseek r1
 """
 
+import asyncio
+import dataclasses
+import functools
 import json
-import random
-import time
 import os
+import random
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import cast
-import requests
+from typing import Sequence, cast
 
 from datasets import Dataset, load_dataset
-from tqdm.auto import tqdm
 from transformers import HfArgumentParser
 
 import magicoder
+import magicoder.concurrency
+import magicoder.dead_letter
+import magicoder.engine
+import magicoder.generation_outputs
+import magicoder.http_client
+import magicoder.journal
+import magicoder.rate_limit
+import magicoder.response_cache
+import magicoder.seed_filter
+import magicoder.seed_sampler
+import magicoder.telemetry
+import magicoder.token_counter
 
 # DO NOT CHANGE THE FOLLOWING
 SYSTEM = "You are exceptionally skilled at crafting high-quality programming problems and offering precise solutions."
@@ -42,6 +54,25 @@ class Args:
     min_lines: int = field(default=1)
     max_lines: int = field(default=15)
     chunk_size: int = field(default=1000)
+    sampler: str = field(
+        default="shuffle",
+        metadata={
+            "help": "`shuffle` maps and shuffles the whole corpus; `permutation` "
+            "extracts seeds only for the requested window (different seeds, opt-in)",
+            "choices": list(magicoder.seed_sampler.SAMPLERS),
+        },
+    )
+    seed_filter: bool = field(
+        default=False,
+        metadata={
+            "help": "Reject blank, boilerplate, license, minified and generated seeds "
+            "before dispatch (see magicoder.seed_filter)"
+        },
+    )
+    seed_resamples: int = field(
+        default=3,
+        metadata={"help": "Times a rejected seed is re-extracted from its document"},
+    )
 
     dataset_name: str = field(default="bigcode/starcoderdata")
     # data_dir: str | None = field(default="python")
@@ -50,6 +81,79 @@ class Args:
     max_considered_data: int | None = field(default=100000)
 
     stream: bool = field(default=False)
+    concurrency: int = field(
+        default=8, metadata={"help": "Number of requests kept in flight (initial)"}
+    )
+    adaptive_concurrency: bool = field(
+        default=True,
+        metadata={"help": "Adjust concurrency with AIMD on 429/5xx and latency"},
+    )
+    max_concurrency: int = field(default=64)
+    max_attempts: int = field(
+        default=3, metadata={"help": "Attempts per seed on 429/5xx/timeouts"}
+    )
+    connect_timeout: float = field(default=10.0)
+    read_timeout: float = field(default=600.0)
+
+    rpm: int | None = field(
+        default=None, metadata={"help": "Requests-per-minute quota shared on this host"}
+    )
+    tpm: int | None = field(
+        default=None, metadata={"help": "Tokens-per-minute quota shared on this host"}
+    )
+    rate_limit_file: str | None = field(
+        default=None,
+        metadata={
+            "help": "State file of the shared rate limiter "
+            "(default: in /tmp, one per endpoint and API key)"
+        },
+    )
+    metrics_file: str | None = field(
+        default=None,
+        metadata={"help": "Append per-request metrics (JSON lines) to this file"},
+    )
+    prometheus_file: str | None = field(
+        default=None,
+        metadata={"help": "Periodically write Prometheus text-format metrics here"},
+    )
+    response_cache: str | None = field(
+        default=None,
+        metadata={"help": "SQLite file caching raw responses; hits are replayed"},
+    )
+    retry_passes: int = field(
+        default=1,
+        metadata={
+            "help": "Passes re-dispatching dead-lettered seeds after the main pass, "
+            "with per-error-class retry policies"
+        },
+    )
+    output_flush_records: int = field(
+        default=64, metadata={"help": "Records buffered before a group write"}
+    )
+    output_flush_interval: float = field(
+        default=1.0,
+        metadata={"help": "Seconds after which buffered records are written"},
+    )
+    output_fsync: str = field(
+        default="commit",
+        metadata={
+            "help": "fsync policy of the output: commit (before each journal fsync), "
+            "flush (after every group write) or never"
+        },
+    )
+    output_segment_mb: int = field(
+        default=0,
+        metadata={
+            "help": "Rotate the output into segments of this size (0: no rotation)"
+        },
+    )
+    reasoning_store: bool = field(
+        default=False,
+        metadata={
+            "help": "Write `reasoning_content` to a compressed side store next to the "
+            "output and keep only a `reasoning_ref` in each record"
+        },
+    )
 
     tag: str = field(
         default="",
@@ -85,6 +189,12 @@ class Args:
             SYSTEM,
             ERROR_MARGIN,
         )
+        # 旧的 shuffle 采样不计入，保证此前生成的数据指纹不变
+        if self.sampler != "shuffle":
+            args += (self.sampler,)
+        # 预筛会重新提取不合格的种子，同样计入指纹
+        if self.seed_filter:
+            args += ("seed_filter", self.seed_resamples)
         return magicoder.utils.compute_fingerprint(*args, hash_length=5)
 
 
@@ -107,27 +217,43 @@ def map_dataset(examples: dict, indices: list[int], args: Args) -> dict:
     seed_snippets = [
         extract_seed_code(args, content) for content in examples["content"]
     ]
+    if (seed_filter := magicoder.seed_filter.get_seed_filter()) is not None:
+        # 不合格的种子在原文档中重新截取
+        # 这里只产出列，接受率在选出窗口之后统计
+        seed_snippets, rejections, resamples = seed_filter.refine(
+            seed_snippets, lambda i: extract_seed_code(args, examples["content"][i])
+        )
+        return {
+            "seed": seed_snippets,
+            "raw_index": indices,
+            "rejection": rejections,
+            "resamples": resamples,
+        }
     return {
         "seed": seed_snippets,
         "raw_index": indices,
     }
 
 
-def extract_seed_code(args: Args, document: str) -> str:
+def extract_seed_code(
+    args: Args, document: str, rng: random.Random | None = None
+) -> str:
     """
     从文档中提取种子代码。
     
     Args:
         args (Args): 参数对象，包含最小行数（min_lines）和最大行数（max_lines）等参数。
         document (str): 原始文档字符串。
+        rng (random.Random | None): 使用的随机数生成器，默认为全局的 `random`。
     
     Returns:
         str: 从文档中随机提取的一段代码字符串。
     
     """
     lines = document.splitlines(keepends=True)
-    start_index = random.choice(range(len(lines)))
-    n_lines_to_consider = random.randint(args.min_lines, args.max_lines)
+    generator = random if rng is None else rng
+    start_index = generator.choice(range(len(lines)))
+    n_lines_to_consider = generator.randint(args.min_lines, args.max_lines)
     code = "".join(lines[start_index : start_index + n_lines_to_consider])
     return code
 
@@ -161,45 +287,144 @@ def parse_problem_solution(response_text: str) -> tuple[str, str] | None:
     return problem, solution
 
 
-def send_chat_request(system_message, user_message):
+def send_chat_request(system_message, user_message, max_tokens: int = 4096):
     """
     发送对话请求到天翼云 DeepSeek-R1 API 并返回结果。
 
     :param system_message: 作为 system 角色的内容
     :param user_message: 作为 user 角色的内容
+    :param max_tokens: 最大生成 token 数
     :return: 返回 API 响应的 JSON 结果
     """
-    # 获取环境变量
-    url = os.getenv('XIRANG_BASE_URL')
-    api_key = os.getenv("XIRANG_API_KEY")
-    model_code = os.getenv("MODEL_CODE")
-
-    # 确保环境变量不为空
-    if not url or not api_key or not model_code:
-        raise ValueError("❌ 缺少环境变量，请检查 `XIRANG_BASE_URL`, `XIRANG_API_KEY`, `MODEL_CODE` 是否已设置")
-
-    # 设置请求头
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {api_key}'
-    }
+    # 共享的长连接客户端，环境变量只在第一次调用时读取
+    client = magicoder.http_client.get_http_client()
+    payload = magicoder.http_client.build_chat_payload(
+        client.config.model_code, system_message, user_message, max_tokens=max_tokens
+    )
 
-    # 请求数据
-    data = {
-        "messages": [
-            {"role": "system", "content": system_message},
-            {"role": "user", "content": user_message}
-        ],
-        "model": model_code,
-        "temperature": 0,
-        "max_tokens": 4096,
-    }
+    # 命中响应缓存时直接返回；否则按共享的 RPM/TPM 配额等待，代替原来每次调用前的随机等待
+    return magicoder.http_client.post_with_cache(client, payload)
+
+
+async def asend_chat_request(
+    system_message, user_message, max_tokens: int = 4096, temperature: float = 0
+):
+    """`send_chat_request` 的异步版本，供并发生成使用。"""
+    client = magicoder.http_client.get_async_http_client()
+    payload = magicoder.http_client.build_chat_payload(
+        client.config.model_code,
+        system_message,
+        user_message,
+        temperature=temperature,
+        max_tokens=max_tokens,
+    )
+    return await magicoder.http_client.apost_with_cache(client, payload)
 
-    response = requests.post(url=url, headers=headers, json=data)
-    response.raise_for_status()  # 检查请求是否成功
-    
-    # 获取 JSON 数据（字典格式）
-    return response.json()
+
+async def generate_one(example: dict, args: Args, prompt_template: str) -> dict:
+    """
+    为一条种子代码生成问题和解决方案。
+
+    Args:
+        example (dict): 数据集中的一项，包含 "seed"、"raw_index" 和 "index"。
+        args (Args): 命令行参数。
+        prompt_template (str): 提示模板，包含 `{code}` 占位符。
+
+    Returns:
+        dict: 输出数据。
+
+    Raises:
+        Exception: 请求失败、生成未自然结束或无法解析时抛出，由生成引擎记录，
+            用完重试次数后写入死信队列。
+
+    """
+    # 生成提示
+    prompt = prompt_template.format(code=example["seed"])
+
+    # 确保生成的内容在模型的上下文大小范围内
+    max_new_tokens = min(
+        args.max_new_tokens,
+        args.model_max_tokens
+        - magicoder.token_counter.count_message_tokens(
+            [{"content": SYSTEM}, {"content": prompt}], args.model
+        )
+        # 误差裕量（例如，由于对话标记）
+        - ERROR_MARGIN,
+    )
+    if max_new_tokens <= 0:
+        raise magicoder.dead_letter.GenerationError(
+            "no_room", f"No room for new tokens: {max_new_tokens}"
+        )
+
+    with magicoder.response_cache.track_keys() as cache_keys:
+        response = await asend_chat_request(
+            SYSTEM, prompt, max_tokens=max_new_tokens, temperature=args.temperature
+        )
+    try:
+        return build_record(example, response)
+    except magicoder.dead_letter.GenerationError:
+        # 不可用的回复不留在缓存里，否则死信重试只会回放同一个坏回复
+        magicoder.response_cache.evict(cache_keys)
+        raise
+
+
+def build_record(example: dict, response: dict) -> dict:
+    """
+    检查回复并构造输出数据。
+
+    Raises:
+        GenerationError: 生成未自然结束、无法解析或问题/解答为空时抛出，带有原始回复。
+
+    """
+    choice = response.get("choices", [])[0]
+    magicoder.telemetry.observe(finish_reason=choice.get("finish_reason"))
+    magicoder.telemetry.observe_usage(response.get("usage"))
+    message = choice.get("message", {})
+    # 失败时连同原始回复一起写入死信队列
+    raw_response = dict(
+        finish_reason=choice.get("finish_reason"),
+        content=message.get("content") or "",
+        reasoning_content=message.get("reasoning_content") or "",
+    )
+    if choice.get("finish_reason") != "stop":
+        magicoder.telemetry.observe(parse_outcome="incomplete")
+        raise magicoder.dead_letter.GenerationError(
+            "incomplete",
+            "Response incomplete: " + str(choice.get("finish_reason")),
+            raw_response,
+        )
+    parsing_result = parse_problem_solution(message.get("content") or "")
+    if parsing_result is None:
+        magicoder.telemetry.observe(parse_outcome="unparseable")
+        raise magicoder.dead_letter.GenerationError(
+            "unparseable", "Failed to parse response.", raw_response
+        )
+    problem, solution = parsing_result
+    if len(problem) == 0 or len(solution) == 0:
+        magicoder.telemetry.observe(parse_outcome="empty")
+        raise magicoder.dead_letter.GenerationError(
+            "empty", "Empty problem or solution.", raw_response
+        )
+    magicoder.telemetry.observe(parse_outcome="ok")
+
+    # 天翼云调用deepseek r1的response没有指纹，所以这里生成一个随机数就可以
+    fingerprint = "counterfeit " + str(random.randint(0, pow(2, 31) - 1))
+
+    # 构造输出数据
+    # 在这个字典中，seed指的是“种子代码片段”
+    record = dict(
+        raw_index=example["raw_index"],
+        index=example["index"],
+        seed=example["seed"],
+        openai_fingerprint=fingerprint,
+        problem=problem,
+        solution=solution,
+        reasoning_content=message.get("reasoning_content") or "",  # r1模型的推理过程
+    )
+    if "retry" in example:
+        # 死信重试生成的记录，见 magicoder.dead_letter
+        record["retry"] = example["retry"]
+    return record
 
 
 def main():
@@ -232,51 +457,75 @@ def main():
         num_proc=magicoder.utils.N_CORES,
     )
 
+    # 配置与同一台机器上其他进程共享的 RPM/TPM 限流
+    magicoder.rate_limit.configure(
+        args.rpm,
+        args.tpm,
+        args.rate_limit_file,
+        endpoint=os.getenv("XIRANG_BASE_URL"),
+        api_key=os.getenv("XIRANG_API_KEY"),
+    )
+    # 重跑时命中缓存的请求直接回放，不再重复付费
+    magicoder.response_cache.configure(args.response_cache)
+    # 逐请求的遥测，运行结束时打印延迟分位数和 token 产出
+    telemetry = magicoder.telemetry.configure(args.metrics_file, args.prometheus_file)
+    # 流式输出暂不支持，r1 的推理过程在非流式响应的 reasoning_content 里
+    assert not args.stream, "Streaming is not supported by the HTTP generator"
+    magicoder.http_client.configure_async_http_client(
+        connect_timeout=args.connect_timeout,
+        read_timeout=args.read_timeout,
+        pool_size=max(64, args.max_concurrency),
+    )
+
     # 设置随机种子
     random.seed(args.seed)
     # 把args.seed输出到args.dataset_name相同文件夹下的data0_seed.jsonl文件中，其实这行代码也可以处理json
     seed_save_file = args.dataset_name.replace(".json", "_seed.json")
-    with open(seed_save_file, "w") as f:
-        json.dump({"seed": args.seed}, f)
-    
-
-    # 对数据集进行映射处理
-    # map_fn = get_map_dataset(args)
-    dataset = dataset.map(
-        function=map_dataset,
-        fn_kwargs=dict(args=args),
-        with_indices=True,
-        batched=True,
-        batch_size=args.chunk_size,
-    )
-
-    # 打乱数据集
-    dataset = dataset.shuffle(seed=args.seed)
-
-    # 为每个数据项添加索引
-    dataset = dataset.map(lambda _, index: {"index": index}, with_indices=True)
 
     # 确保每次运行都生成相同的数据，除非默认参数发生变化
     start_index = args.seed_code_start_index
     end_index = min(start_index + args.max_new_data, len(dataset))
-    # TODO 其实一个文件比如data0执行了好多次，所以seed文件的值被覆盖好多次了，那么数据不再正确
-    # 1️⃣ 读取原始 JSON 文件
-    with open(seed_save_file, "r") as f:
-        data = json.load(f)  # 加载为字典
+    # 按窗口记录 seed，多次运行同一个数据文件时不会互相覆盖
+    magicoder.utils.record_seed(seed_save_file, args.seed, start_index, end_index)
+
+    # 空行、许可证、压缩代码等种子在派发前筛掉或重新截取
+    seed_filter = magicoder.seed_filter.configure(args.seed_filter, args.seed_resamples)
+    if args.sampler == "shuffle":
+        # 对数据集进行映射处理
+        # map_fn = get_map_dataset(args)
+        dataset = dataset.map(
+            function=map_dataset,
+            fn_kwargs=dict(args=args),
+            with_indices=True,
+            batched=True,
+            batch_size=args.chunk_size,
+        )
 
-    # 2️⃣ 检查是否已有相同字段，若有则覆盖
-    data["start_index"] = start_index
-    data["end_index"] = end_index
+        # 打乱数据集
+        dataset = dataset.shuffle(seed=args.seed)
 
-    # 3️⃣ 重新写入文件（覆盖写入）
-    with open(seed_save_file, "w") as f:
-        json.dump(data, f, indent=4, ensure_ascii=False)
+        # 为每个数据项添加索引
+        dataset = dataset.map(lambda _, index: {"index": index}, with_indices=True)
 
-    # 因为这里的dataset已经是打乱了，所以这里虽然选择了一些数据，但是其实本质上是随机的
-    dataset = dataset.select(range(start_index, end_index))
+        # 因为这里的dataset已经是打乱了，所以这里虽然选择了一些数据，但是其实本质上是随机的
+        dataset = dataset.select(range(start_index, end_index))
+    else:
+        # 打乱后的位置在 O(1) 内映射到原始行，只为请求的窗口提取种子代码
+        dataset = magicoder.seed_sampler.select_window(
+            dataset,
+            seed=args.seed,
+            start_index=start_index,
+            end_index=end_index,
+            extract=functools.partial(extract_seed_code, args),
+            seed_filter=seed_filter,
+        )
+    if seed_filter is not None:
+        seed_filter.observe(dataset["rejection"], dataset["resamples"])
 
     # 读取提示模板
     prompt_template = Path("data/prompt.txt").read_text()
+    # 提前加载分词器，用于按上下文长度计算每个请求的 max_tokens
+    magicoder.token_counter.get_token_counter(args.model)
 
     # 获取时间戳
     timestamp = magicoder.utils.timestamp()
@@ -285,17 +534,18 @@ def main():
     data_fingerprint = args.fingerprint(prompt_template)
 
     # 检查是否从旧数据继续
+    window = (start_index, end_index)
     if args.continue_from is not None:
         assert data_fingerprint in args.continue_from, "Fingerprint mismatch"
         assert f"{start_index}_{end_index}" in args.continue_from, "Index mismatch"
-        old_path = Path(args.continue_from)
-        assert old_path.exists()
-        old_data = magicoder.utils.read_jsonl(old_path)
-        assert len(old_data) > 0
-        last_index = old_data[-1]["index"]
-        n_skipped = last_index - start_index + 1
-        print("Continuing from", old_path)
-        f_out = old_path.open("a")
+        path = Path(args.continue_from)
+        assert path.exists()
+        journal_path = magicoder.journal.journal_path_for(path)
+        if not journal_path.exists():
+            # 旧版本生成的文件没有日志，根据已有的输出补建一份
+            print("No journal found, rebuilding it from", path)
+            magicoder.journal.GenerationJournal.from_output(path, window).close()
+        print("Continuing from", path)
     else:
         # 生成新的输出路径
         tag = "" if args.tag == "" else f"-{args.tag}"
@@ -303,138 +553,76 @@ def main():
             f"data{tag}-{data_fingerprint}-{start_index}_{end_index}-{timestamp}.jsonl"
         )
         assert not path.exists()
-        f_out = path.open("w")
         print("Saving to", path)
-        n_skipped = 0
 
-    # 遍历数据集，处理每个数据项
-    for index, example in enumerate(tqdm(dataset)):
-        if index < n_skipped:
-            continue
-        assert index + start_index == example["index"]
-        
-        time.sleep(random.randint(10, 30)) # 每次调用前建议等一下，不然怕被查
-
-        # 生成提示
-        prompt = prompt_template.format(code=example["seed"])
-
-        # 确保生成的内容在模型的上下文大小范围内
-        max_new_tokens = min(
-            args.max_new_tokens,
-            args.model_max_tokens
-            # TODO 偷懒不计算输入prompt的token
-            # - magicoder.utils.num_tokens_from_string(prompt, args.model)
-            # 误差裕量（例如，由于对话标记）
-            - ERROR_MARGIN,
-        )
-        if max_new_tokens <= 0:
-            continue
-
-        # 构造与OpenAI交互的消息
-        # messages = [
-        #     {"role": "system", "content": SYSTEM},
-        #     {"role": "user", "content": prompt},
-        # ]
-
-        openai_seed = args.seed + example["index"]
-           
-        success = False
-        parsing_result = None
-        complete_response = ""
-        reasoning_content = ""
-        
-        try:
-            # 一切最简，能跑通就行
-            response = send_chat_request(SYSTEM,prompt)
-        
-            if args.stream: # 参数默认为False
-                # print("[Streaming]")
-                # complete_response = ""
-                # reasoning_content = ""
-                is_answering = False   # 判断是否开始回答
-                last_finish_reason = None
-                # 遍历流式返回的每个 chunk
-                for chunk in response:    
-                    # 如果当前 chunk 包含 finish_reason，就记录下来（通常只有最后一个 chunk 会有）
-                    if getattr(chunk.choices[0], "finish_reason",None):
-                        last_finish_reason = chunk.choices[0].finish_reason
-                    
-                    delta = chunk.choices[0].delta
-                    # 处理推理过程文本
-                    if getattr(delta, 'reasoning_content',None):
-                        reasoning_content += delta.reasoning_content
-                    # 处理回复内容
-                    else:
-                        if getattr(delta, 'content',None):
-                            if is_answering == False:
-                                is_answering = True
-                            complete_response += delta.content
-                
-                # 判断生成是否是自然结束（"stop"）还是因为截断或其他原因
-                if last_finish_reason != "stop":
-                    raise Exception(f"Streaming ended with finish_reason: {last_finish_reason} (not natural stop)")
-                parsing_result = parse_problem_solution(complete_response)
-
-            else:
-                choice = response.get("choices", [])[0]  # 使用 .get() 方法访问 'choices'，如果没有则返回空列表
-                if choice.get("finish_reason") != "stop":  # 通过字典的 get 方法访问 'finish_reason'
-                    raise Exception("Response incomplete: " + str(choice.get("finish_reason")))
-
-                parsing_result = parse_problem_solution(choice.get("message", {}).get("content", ""))  # 安全访问 'message.content'
-                reasoning_content = choice.get("message", {}).get("content", "")  # 获取 'content' 内容
-
-                # choice = response.choices[0]
-                # if choice.finish_reason != "stop":
-                #     raise Exception("Response incomplete: " + str(choice.finish_reason))
-                # parsing_result = parse_problem_solution(choice.message.content)
-                # reasoning_content = response.choice[0].reasoning_content
-            
-            if parsing_result is None:
-                    raise Exception("Failed to parse streamed response.")
-            problem, solution = parsing_result
-            if len(problem) == 0 or len(solution) == 0:
-                # print("[Warning] Empty problem or solution:", last_response_content)
-                continue
-            
-            # 如果执行到这里，说明API调用和解析都成功
-            success = True
-        except Exception as e:
-            print(f"[error] API call failed: {e}")
-            raise e  # 原来这里捕获异常的时候没有正常输出错误所在的位置
-            # 已经在每一次调用的时候随机等待一段时间了
-            continue
-
-        if not success:
-            continue  # 跳过当前样本
-        
-        # 获取大模型响应指纹
-        # fingerprint = response.system_fingerprint
-        # 用阿里云调用deepseek r1的response没有指纹，所以这里生成一个随机数就可以
-        fingerprint = "counterfeit " + str(random.randint(0, pow(2,31)-1))
-        assert fingerprint is not None
-
-        # 构造输出数据
-        # 在这个字典中，seed指的是“种子代码片段”
-        data = dict(
-            raw_index=example["raw_index"],
-            index=example["index"],
-            seed=example["seed"],
-            openai_fingerprint=fingerprint,
-            problem=problem,
-            solution=solution,
-            reasoning_content=reasoning_content, # r1模型的推理过程
-        )
-
-        # print(reasoning_content)
-
-        # 打印问题和解决方案
-        # print("[Problem Description]", problem, sep="\n", end="\n\n")
-        # print("[Solution]", solution, sep="\n")
-
-        # 将数据写入文件
-        f_out.write(json.dumps(data) + "\n")
-        # 直接刷新进硬盘
-        f_out.flush()
+    # 输出、推理过程存储、日志和死信队列与 generate_data 相同，退出时（包括出错时）关闭
+    with magicoder.generation_outputs.open_outputs(path, window, args) as outputs:
+        journal, dead_letters = outputs.journal, outputs.dead_letters
+        # 只重新派发尚未完成的 index（包括之前失败的）
+        missing = journal.missing()
+        dataset = dataset.select([index - start_index for index in missing])
+        if seed_filter is not None:
+            dataset = magicoder.seed_sampler.skip_rejected_seeds(dataset, journal)
+        print(f"{len(dataset)} of {end_index - start_index} seeds to generate")
+
+        async def run() -> magicoder.engine.EngineStats:
+            engine = magicoder.engine.GenerationEngine(
+                concurrency=args.concurrency,
+                controller=(
+                    magicoder.concurrency.AIMDController(
+                        initial_limit=args.concurrency, max_limit=args.max_concurrency
+                    )
+                    if args.adaptive_concurrency
+                    else None
+                ),
+                max_attempts=args.max_attempts,
+            )
+
+            async def run_pass(batches: dict[float | None, Sequence[dict]]):
+                stats = magicoder.engine.EngineStats()
+                for temperature, examples in batches.items():
+                    pass_args = (
+                        args
+                        if temperature is None
+                        else dataclasses.replace(args, temperature=temperature)
+                    )
+                    examples = magicoder.dead_letter.with_retry_temperature(
+                        examples, pass_args.temperature
+                    )
+                    stats.add(
+                        await engine.run(
+                            examples=iter(examples),
+                            process=functools.partial(
+                                generate_one,
+                                args=pass_args,
+                                prompt_template=prompt_template,
+                            ),
+                            sink=outputs.write,
+                            total=len(examples),
+                            journal=journal,
+                            dead_letters=dead_letters,
+                        )
+                    )
+                return stats
+
+            try:
+                # 主流程结束后，按错误类别的重试策略重新派发死信队列中的种子
+                return await magicoder.engine.run_with_retries(
+                    dataset, run_pass, dead_letters, args.retry_passes
+                )
+            finally:
+                await magicoder.http_client.get_async_http_client().aclose()
+
+        # 并发生成，所有请求复用同一个连接池，结果按 index 顺序写出
+        stats = asyncio.run(run())
+    print(
+        f"Done: {stats.n_succeeded} succeeded, {stats.n_failed} failed",
+        stats.errors,
+    )
+    if seed_filter is not None:
+        print("[seed_filter]", seed_filter.report())
+    telemetry.close()
+    print(json.dumps(telemetry.summary(), indent=2))
 
 
 if __name__ == "__main__":
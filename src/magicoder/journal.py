@@ -0,0 +1,215 @@
+"""生成过程的预写日志（journal）
+
+每个 index 的状态变化都以一行 JSON 追加到日志文件里，按批次 fsync：
+
+    {"window": [start, end]}                                   # 文件头
+    {"index": 3, "state": "in_flight", "attempts": 1}
+    {"index": 3, "state": "failed", "attempts": 1, "reason": "..."}
+    {"index": 3, "state": "done", "attempts": 2}
+    {"index": 5, "state": "skipped", "attempts": 0, "reason": "..."}
+
+日志里没有出现过的 index 就是 pending。续跑时只需重放这个小文件，就能精确地找出所有
+尚未完成的 index（包括中间失败的），不用再读一遍巨大的输出文件。
+"""
+
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from enum import Enum
+from pathlib import Path
+from typing import Callable, Iterable
+
+from magicoder.output_writer import iter_records
+
+
+class IndexState(str, Enum):
+    PENDING = "pending"
+    IN_FLIGHT = "in_flight"
+    DONE = "done"
+    FAILED = "failed"
+    # 派发前被跳过（例如重复的种子），不再生成
+    SKIPPED = "skipped"
+
+
+# 不会再派发的状态
+FINISHED = (IndexState.DONE, IndexState.SKIPPED)
+
+
+@dataclass
+class IndexStatus:
+    state: IndexState = field(default=IndexState.PENDING)
+    attempts: int = field(default=0)
+    reason: str | None = field(default=None)
+
+
+def journal_path_for(output_path: str | Path) -> Path:
+    """输出文件对应的日志文件路径。"""
+    output_path = Path(output_path)
+    return output_path.with_name(output_path.name + ".journal")
+
+
+class GenerationJournal:
+    """追加写入、批量 fsync 的生成日志。
+
+    Args:
+        path (str | Path): 日志文件路径，已存在时会先重放其中的记录。
+        window (tuple[int, int] | None): 本次运行负责的 [start, end)，新建日志时必须提供。
+        fsync_every (int): 每累计多少条记录 fsync 一次。
+        fsync_interval (float): 距上次 fsync 超过多少秒时 fsync 一次。
+        before_sync (Callable[[], None] | None): 每次 fsync 日志前调用，用于先把输出文件落盘，
+            保证日志中标为 done 的数据一定已经写入。
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        window: tuple[int, int] | None = None,
+        fsync_every: int = 64,
+        fsync_interval: float = 1.0,
+        before_sync: Callable[[], None] | None = None,
+    ):
+        self.path = Path(path)
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.before_sync = before_sync
+        self.statuses: dict[int, IndexStatus] = {}
+        self.window: tuple[int, int] | None = None
+        if self.path.exists():
+            self._replay()
+            assert window is None or self.window == tuple(window), "Window mismatch"
+        else:
+            assert window is not None, "A new journal needs a window"
+            self.window = (window[0], window[1])
+        # 日志里有记录但尚未完成（in_flight 或 failed）的 index；没有记录的 index 都是 pending
+        self._unfinished = {
+            index
+            for index, status in self.statuses.items()
+            if status.state not in FINISHED
+        }
+        self._file = self.path.open("a")
+        self._pending: list[str] = []
+        self._n_unsynced = 0
+        self._last_sync = time.time()
+        if self.path.stat().st_size == 0:
+            # 文件头立即落盘，崩溃后重放时总能读到窗口
+            self._append(dict(window=list(self.window)))
+            self.sync()
+
+    def _replay(self):
+        with self.path.open("r") as f:
+            lines = f.readlines()
+        # 进程崩溃时最后一行可能只写了一半，丢掉即可
+        if len(lines) > 0 and not lines[-1].endswith("\n"):
+            lines.pop()
+            with self.path.open("w") as f:
+                f.writelines(lines)
+        for line in lines:
+            event = json.loads(line)
+            if "window" in event:
+                self.window = (event["window"][0], event["window"][1])
+                continue
+            self.statuses[event["index"]] = IndexStatus(
+                state=IndexState(event["state"]),
+                attempts=event["attempts"],
+                reason=event.get("reason"),
+            )
+        assert self.window is not None, f"Journal {self.path} has no window header"
+
+    def _append(self, event: dict):
+        # 先留在内存里，到 sync 时在输出落盘之后才写出，日志永远不会领先于输出
+        self._pending.append(json.dumps(event) + "\n")
+
+    def status(self, index: int) -> IndexStatus:
+        return self.statuses.get(index, IndexStatus())
+
+    def mark(self, index: int, state: IndexState, reason: str | None = None):
+        status = self.statuses.setdefault(index, IndexStatus())
+        if state == IndexState.IN_FLIGHT:
+            status.attempts += 1
+        status.state = state
+        status.reason = reason
+        if state in FINISHED:
+            self._unfinished.discard(index)
+        else:
+            self._unfinished.add(index)
+        event: dict = dict(index=index, state=state.value, attempts=status.attempts)
+        if reason is not None:
+            event["reason"] = reason
+        self._append(event)
+        self._n_unsynced += 1
+        if (
+            self._n_unsynced >= self.fsync_every
+            or time.time() - self._last_sync >= self.fsync_interval
+        ):
+            self.sync()
+
+    def mark_in_flight(self, index: int):
+        self.mark(index, IndexState.IN_FLIGHT)
+
+    def mark_done(self, index: int):
+        self.mark(index, IndexState.DONE)
+
+    def mark_failed(self, index: int, reason: str):
+        self.mark(index, IndexState.FAILED, reason)
+
+    def mark_skipped(self, index: int, reason: str):
+        self.mark(index, IndexState.SKIPPED, reason)
+
+    def sync(self):
+        if self.before_sync is not None:
+            self.before_sync()
+        self._file.write("".join(self._pending))
+        self._pending.clear()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._n_unsynced = 0
+        self._last_sync = time.time()
+
+    def missing(self, indices: Iterable[int] | None = None) -> list[int]:
+        """
+        返回尚未完成（pending、in_flight 或 failed）的 index，默认检查整个窗口。
+
+        窗口里每个 index 都有记录时（例如续跑收尾阶段）只需排序未完成的那些；否则仍要遍历
+        整个窗口找出没有记录的 pending index。
+        """
+        if indices is None:
+            assert self.window is not None
+            if len(self.statuses) == self.window[1] - self.window[0]:
+                return sorted(self._unfinished)
+            indices = range(*self.window)
+        return [
+            index
+            for index in indices
+            if index not in self.statuses or index in self._unfinished
+        ]
+
+    def counts(self) -> dict[str, int]:
+        assert self.window is not None
+        counts = {state.value: 0 for state in IndexState}
+        for status in self.statuses.values():
+            counts[status.state.value] += 1
+        counts[IndexState.PENDING.value] = (
+            self.window[1] - self.window[0] - len(self.statuses)
+        )
+        return counts
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+    def discard(self):
+        """丢弃还没写出的记录并关闭。失去分片租约后调用，日志已经归接手的 worker 所有。"""
+        self._pending.clear()
+        self._file.close()
+
+    @staticmethod
+    def from_output(
+        output_path: str | Path, window: tuple[int, int]
+    ) -> "GenerationJournal":
+        """为没有日志的旧输出文件补建日志：文件里已有的 index 记为 done。"""
+        journal = GenerationJournal(journal_path_for(output_path), window=window)
+        for record in iter_records(output_path):
+            journal.mark_done(record["index"])
+        journal.sync()
+        return journal
@@ -0,0 +1,217 @@
+"""用本地的 Hugging Face 模型生成 OSS-Instruct 数据
+
+`generate_data.py --mode local --model <模型目录或名称>` 不调用远程接口，而是通过
+`magicoder.llm_wrapper.ModelContext.complete` 批量生成。种子的提示先用模型的对话模板渲染，
+再按 token 长度排序、分批，同一批里的提示长度接近，左侧填充浪费的计算最少：
+
+    长度  12  13  15  15 | 40  41  44 | 120 ...
+          ---- 一批 ----   -- 一批 --
+
+每批的大小受 `batch_size` 和 `max_batch_tokens`（填充后的提示长度加上生成长度，乘以批大小）
+限制。生成结果转成 `ChatResult`，之后的解析、日志和死信队列与实时模式完全相同。
+
+torch 和 transformers 只在 `configure` 时才导入，调用 API 生成时不需要它们。
+用随机权重的小模型（例如 `hf-internal-testing/tiny-random-LlamaForCausalLM`）可以在 CPU 上
+跑通整个流程。
+"""
+
+from typing import TYPE_CHECKING
+
+from magicoder.chat import ChatResult
+
+if TYPE_CHECKING:
+    from magicoder.llm_wrapper import ModelContext
+
+# 模型配置里没有最大位置数时使用的上下文长度
+DEFAULT_CONTEXT_SIZE = 2048
+
+
+def load_model_context(
+    model_name_or_path: str, dtype: str = "auto", max_context_size: int | None = None
+) -> "ModelContext":
+    """
+    加载本地生成用的模型。`SupportedModelKeys` 中的模型沿用 `get_model_context`，
+    其他的（自己的检查点、测试用的小模型）直接用 `AutoModelForCausalLM` 加载。
+
+    Args:
+        model_name_or_path (str): 模型名称或目录。
+        dtype (str): 权重的数据类型，"auto" 表示使用检查点中保存的类型。
+        max_context_size (int | None): 上下文长度，默认取模型配置的 `max_position_embeddings`。
+
+    """
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    from magicoder.llm_wrapper import (
+        ModelContext,
+        SupportedModelKeys,
+        TokenizationContext,
+        get_model_context,
+    )
+
+    if model_name_or_path in SupportedModelKeys.all():
+        return get_model_context(model_name_or_path)
+    tokenizer = AutoTokenizer.from_pretrained(model_name_or_path, use_fast=True)
+    model = AutoModelForCausalLM.from_pretrained(
+        model_name_or_path,
+        torch_dtype=dtype if dtype == "auto" else getattr(torch, dtype),
+    )
+    model.to("cuda" if torch.cuda.is_available() else "cpu")
+    model.eval()
+    if max_context_size is None:
+        max_context_size = getattr(
+            model.config, "max_position_embeddings", DEFAULT_CONTEXT_SIZE
+        )
+    return ModelContext(
+        TokenizationContext.from_tokenizer(tokenizer), model, max_context_size
+    )
+
+
+def length_batches(
+    lengths: list[int], batch_size: int, max_batch_tokens: int, max_new_tokens: int
+) -> list[list[int]]:
+    """
+    按长度从长到短把提示分批，最长的一批先跑，显存不够时尽早暴露。
+
+    Args:
+        lengths (list[int]): 每个提示的 token 数。
+        batch_size (int): 每批最多的提示数。
+        max_batch_tokens (int): 每批填充后的提示长度加上 `max_new_tokens`，再乘以批大小的上限。
+            单个提示超过上限时自成一批。
+        max_new_tokens (int): 最多生成的 token 数。
+
+    Returns:
+        list[list[int]]: 每批中提示的位置。
+
+    """
+    assert batch_size > 0
+    batches: list[list[int]] = []
+    batch: list[int] = []
+    for position in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        # 按长度降序排列，批中第一个提示就是最长的，决定了填充后的长度
+        longest = lengths[batch[0]] if len(batch) > 0 else lengths[position]
+        if len(batch) > 0 and (
+            len(batch) >= batch_size
+            or (len(batch) + 1) * (longest + max_new_tokens) > max_batch_tokens
+        ):
+            batches.append(batch)
+            batch = []
+        batch.append(position)
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+def finish_reason_for(output_ids: list[int], eos_token_id: int) -> str:
+    """生成了结束符的是 "stop"，否则是用完了长度（"length"）。"""
+    return "stop" if eos_token_id in output_ids else "length"
+
+
+class LocalGenerator:
+    """
+    Args:
+        model_context (ModelContext): 本地模型和分词器。
+        batch_size (int): 每批最多的提示数。
+        max_batch_tokens (int): 每批的 token 上限，见 `length_batches`。
+        top_p (float): 采样时的 top-p，温度为 0 时不采样。
+    """
+
+    def __init__(
+        self,
+        model_context: "ModelContext",
+        batch_size: int = 8,
+        max_batch_tokens: int = 65536,
+        top_p: float = 1.0,
+    ):
+        self.model_context = model_context
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.top_p = top_p
+
+    @property
+    def tokenizer(self):
+        return self.model_context.tokenization_context.tokenizer
+
+    def render(self, messages: list[dict]) -> str:
+        """用模型的对话模板渲染消息，没有模板的基础模型直接拼接。"""
+        if getattr(self.tokenizer, "chat_template", None) is None:
+            return "\n\n".join(message["content"] for message in messages) + "\n\n"
+        prompt = self.tokenizer.apply_chat_template(
+            messages, tokenize=False, add_generation_prompt=True
+        )
+        # `ModelContext.complete` 编码时会自己加 BOS，模板里的去掉，避免重复
+        bos_token = self.model_context.tokenization_context.bos_token
+        if bos_token and prompt.startswith(bos_token):
+            prompt = prompt[len(bos_token) :]
+        return prompt
+
+    def prompt_lengths(self, prompts: list[str]) -> list[int]:
+        input_ids = self.tokenizer(
+            prompts, add_special_tokens=False, return_attention_mask=False
+        )["input_ids"]
+        return [len(ids) for ids in input_ids]
+
+    def complete(
+        self, prompts: list[str], max_new_tokens: int, temperature: float
+    ) -> list[ChatResult]:
+        """生成一批提示，耗时较长，由调用方放到线程里执行。"""
+        from magicoder.llm_wrapper import GenerationConfig
+
+        config = GenerationConfig(
+            max_new_tokens=max_new_tokens, top_p=self.top_p, temperature=temperature
+        )
+        response = self.model_context.complete(config, prompts)
+        eos_token_id = self.model_context.tokenization_context.eos_token_id
+        pad_token_id = self.model_context.tokenization_context.pad_token_id
+        n_prompt_tokens = response.raw_inputs.ne(pad_token_id).sum(dim=1).tolist()
+        results: list[ChatResult] = []
+        for output_ids, content, prompt_tokens in zip(
+            response.raw_outputs.tolist(), response.decoded_outputs, n_prompt_tokens
+        ):
+            finish_reason = finish_reason_for(output_ids, eos_token_id)
+            # 结束符之后都是填充
+            completion_tokens = (
+                output_ids.index(eos_token_id) + 1
+                if finish_reason == "stop"
+                else len(output_ids)
+            )
+            results.append(
+                ChatResult(
+                    content=content,
+                    reasoning_content="",
+                    finish_reason=finish_reason,
+                    usage=dict(
+                        prompt_tokens=prompt_tokens,
+                        completion_tokens=completion_tokens,
+                        total_tokens=prompt_tokens + completion_tokens,
+                    ),
+                    endpoint="local",
+                )
+            )
+        return results
+
+
+_LOCAL_GENERATOR: LocalGenerator | None = None
+
+
+def configure(
+    model_name_or_path: str,
+    batch_size: int = 8,
+    max_batch_tokens: int = 65536,
+    dtype: str = "auto",
+    top_p: float = 1.0,
+) -> LocalGenerator:
+    """加载模型并设置全局的本地生成器，同一进程里的所有窗口和分片共用。"""
+    global _LOCAL_GENERATOR
+    print(f"[local] Loading {model_name_or_path}")
+    _LOCAL_GENERATOR = LocalGenerator(
+        load_model_context(model_name_or_path, dtype),
+        batch_size=batch_size,
+        max_batch_tokens=max_batch_tokens,
+        top_p=top_p,
+    )
+    return _LOCAL_GENERATOR
+
+
+def get_local_generator() -> LocalGenerator | None:
+    return _LOCAL_GENERATOR
@@ -0,0 +1,508 @@
+"""本地的 OpenAI 兼容模拟服务
+
+回放预先写好的 `[Problem Description]` / `[Solution]` 回复，用于在不花钱的情况下压测和
+调试生成流程。支持：
+
+- `POST /v1/chat/completions` 和 `POST /chat/completions`（分别对应 OpenAI SDK 的 base_url
+  和天翼云式的完整地址），流式（SSE）和非流式都支持；
+- 流式时先输出 `reasoning_content` 再输出 `content`，`stream_options.include_usage` 时
+  最后附带一个 usage chunk；
+- 可配置的首 token 延迟、生成速度（token/s），按比例注入 429 / 503、截断（finish_reason=length）、
+  无法解析的回复和中途卡住的流；
+- Batch API（`POST /v1/files`、`POST /v1/batches`、`GET /v1/batches/{id}`、
+  `GET /v1/files/{id}/content`），批次在 `--batch_seconds` 秒后完成，错误按同样的比例注入。
+
+    python -m magicoder.mock_openai_server --port 8000 --tokens_per_second 200 --error_429_rate 0.05
+    export OPENAI_BASE_URL=http://127.0.0.1:8000/v1 OPENAI_API_KEY=mock
+"""
+
+import email.parser
+import itertools
+import json
+import random
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Iterator, cast
+
+from magicoder.rate_limit import CHARS_PER_TOKEN
+
+CANNED_RESPONSES = [
+    (
+        "Write a function `moving_average(values: list[float], k: int) -> list[float]` "
+        "that returns the averages of every window of `k` consecutive values. "
+        "Raise `ValueError` when `k` is not positive or larger than the input.",
+        "```python\ndef moving_average(values: list[float], k: int) -> list[float]:\n"
+        "    if k <= 0 or k > len(values):\n"
+        '        raise ValueError("invalid window size")\n'
+        "    window = sum(values[:k])\n"
+        "    result = [window / k]\n"
+        "    for i in range(k, len(values)):\n"
+        "        window += values[i] - values[i - k]\n"
+        "        result.append(window / k)\n"
+        "    return result\n```",
+    ),
+    (
+        "Implement a class `LRUCache` with `get(key)` and `put(key, value)` that "
+        "evicts the least recently used entry once `capacity` entries are stored.",
+        "```python\nfrom collections import OrderedDict\n\n\nclass LRUCache:\n"
+        "    def __init__(self, capacity: int):\n"
+        "        self.capacity = capacity\n"
+        "        self.entries: OrderedDict = OrderedDict()\n\n"
+        "    def get(self, key):\n"
+        "        if key not in self.entries:\n"
+        "            return None\n"
+        "        self.entries.move_to_end(key)\n"
+        "        return self.entries[key]\n\n"
+        "    def put(self, key, value):\n"
+        "        self.entries[key] = value\n"
+        "        self.entries.move_to_end(key)\n"
+        "        if len(self.entries) > self.capacity:\n"
+        "            self.entries.popitem(last=False)\n```",
+    ),
+    (
+        "Given a string, return the length of the longest substring without "
+        "repeating characters.",
+        "```python\ndef longest_unique_substring(s: str) -> int:\n"
+        "    last_seen: dict[str, int] = {}\n"
+        "    start = best = 0\n"
+        "    for i, ch in enumerate(s):\n"
+        "        if last_seen.get(ch, -1) >= start:\n"
+        "            start = last_seen[ch] + 1\n"
+        "        last_seen[ch] = i\n"
+        "        best = max(best, i - start + 1)\n"
+        "    return best\n```",
+    ),
+]
+
+REASONING = (
+    "The snippet suggests a small utility. I will turn it into a self-contained "
+    "problem, state the edge cases explicitly, and give an efficient solution. "
+)
+
+
+@dataclass(frozen=True)
+class Args:
+    host: str = field(default="127.0.0.1")
+    port: int = field(default=8000)
+    ttft: float = field(
+        default=0.2, metadata={"help": "Seconds before the first token is sent"}
+    )
+    tokens_per_second: float = field(
+        default=500.0, metadata={"help": "Generation speed per request"}
+    )
+    reasoning_repeats: int = field(
+        default=4, metadata={"help": "How many times the reasoning text is repeated"}
+    )
+    error_429_rate: float = field(default=0.0)
+    error_5xx_rate: float = field(default=0.0)
+    truncation_rate: float = field(
+        default=0.0, metadata={"help": "Fraction of responses ending with `length`"}
+    )
+    malformed_rate: float = field(
+        default=0.0, metadata={"help": "Fraction of responses without section headers"}
+    )
+    stall_rate: float = field(
+        default=0.0,
+        metadata={"help": "Fraction of streams that stop sending halfway through"},
+    )
+    stall_seconds: float = field(default=3600.0)
+    batch_seconds: float = field(
+        default=0.0, metadata={"help": "Seconds before a submitted batch completes"}
+    )
+    responses_file: str | None = field(
+        default=None,
+        metadata={"help": "JSONL with `problem` and `solution` to replay instead"},
+    )
+    seed: int = field(default=0)
+
+
+# 前缀缓存的块大小（token），与 DeepSeek 一致
+CACHE_BLOCK_TOKENS = 64
+
+
+def _count_tokens(text: str) -> int:
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+def _split_tokens(text: str) -> list[str]:
+    """按大约 CHARS_PER_TOKEN 个字符切分，模拟逐 token 输出。"""
+    return [text[i : i + CHARS_PER_TOKEN] for i in range(0, len(text), CHARS_PER_TOKEN)]
+
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, args: Args):
+        super().__init__((args.host, args.port), _Handler)
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.rng_lock = threading.Lock()
+        self.responses = CANNED_RESPONSES
+        if args.responses_file is not None:
+            with Path(args.responses_file).open() as f:
+                self.responses = [
+                    (data["problem"], data["solution"]) for data in map(json.loads, f)
+                ]
+        self.n_requests = 0
+        # Batch API 的文件和批次，只保存在内存里
+        self.files: dict[str, bytes] = {}
+        self.batches: dict[str, dict] = {}
+        self.batch_lock = threading.Lock()
+        # 模拟服务商的前缀缓存：见过的完整块前缀
+        self.prefix_cache: set[int] = set()
+        self.prefix_cache_lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        host, port = cast(tuple[str, int], self.server_address)[:2]
+        return f"http://{host}:{port}"
+
+    def draw(self) -> tuple[float, int]:
+        """返回 (用于注入错误的随机数, 回复编号)。"""
+        with self.rng_lock:
+            self.n_requests += 1
+            return self.rng.random(), self.rng.randrange(len(self.responses))
+
+    def cache_hit_tokens(self, prompt_text: str) -> int:
+        """按块匹配见过的前缀，返回命中的 token 数，并把这次的所有完整块加入缓存。"""
+        block = CACHE_BLOCK_TOKENS * CHARS_PER_TOKEN
+        n_blocks = len(prompt_text) // block
+        keys = [hash(prompt_text[: (i + 1) * block]) for i in range(n_blocks)]
+        with self.prefix_cache_lock:
+            n_hits = 0
+            while n_hits < n_blocks and keys[n_hits] in self.prefix_cache:
+                n_hits += 1
+            self.prefix_cache.update(keys)
+        return n_hits * CACHE_BLOCK_TOKENS
+
+    def start(self) -> "MockOpenAIServer":
+        """在后台线程中运行，供压测脚本使用。"""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: MockOpenAIServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, data: dict):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        path = self.path.rstrip("/")
+        if path.startswith("/v1/batches/"):
+            batch_id = path.removeprefix("/v1/batches/")
+            if (batch := self.server.batches.get(batch_id)) is None:
+                self._send_json(404, {"error": {"message": f"No batch {batch_id}"}})
+                return
+            if time.time() >= batch["created_at"] + self.server.args.batch_seconds:
+                with self.server.batch_lock:
+                    batch = self._finish_batch(batch)
+            self._send_json(200, batch)
+            return
+        if path.startswith("/v1/files/") and path.endswith("/content"):
+            file_id = path.removeprefix("/v1/files/").removesuffix("/content")
+            if (data := self.server.files.get(file_id)) is None:
+                self._send_json(404, {"error": {"message": f"No file {file_id}"}})
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_POST(self):
+        path = self.path.rstrip("/")
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if path == "/v1/files":
+            self._upload_file(body)
+            return
+        if path == "/v1/batches":
+            self._create_batch(json.loads(body))
+            return
+        if path not in ("/v1/chat/completions", "/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+        request = json.loads(body)
+        status, response = self._complete(request)
+        if response is not None:
+            self._send_json(status, response)
+
+    def _upload_file(self, body: bytes):
+        # multipart/form-data 借用 email 解析器拆分
+        message = email.parser.BytesParser().parsebytes(
+            f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body
+        )
+        data, filename = b"", "upload"
+        for part in message.get_payload():
+            if part.get_param("name", header="content-disposition") == "file":
+                data = part.get_payload(decode=True)
+                filename = part.get_filename() or filename
+        file_id = f"file-mock-{uuid.uuid4().hex[:12]}"
+        self.server.files[file_id] = data
+        self._send_json(
+            200,
+            dict(
+                id=file_id,
+                object="file",
+                bytes=len(data),
+                created_at=int(time.time()),
+                filename=filename,
+                purpose="batch",
+                status="processed",
+            ),
+        )
+
+    def _create_batch(self, request: dict):
+        if request["input_file_id"] not in self.server.files:
+            self._send_json(404, {"error": {"message": "Unknown input file"}})
+            return
+        batch_id = f"batch-mock-{uuid.uuid4().hex[:12]}"
+        batch = dict(
+            id=batch_id,
+            object="batch",
+            endpoint=request["endpoint"],
+            completion_window=request["completion_window"],
+            input_file_id=request["input_file_id"],
+            created_at=int(time.time()),
+            status="in_progress",
+            output_file_id=None,
+            error_file_id=None,
+            request_counts=dict(total=0, completed=0, failed=0),
+        )
+        self.server.batches[batch_id] = batch
+        self._send_json(200, batch)
+
+    def _finish_batch(self, batch: dict) -> dict:
+        """到时间后一次性处理批文件中的所有请求。"""
+        if batch["status"] == "completed":
+            return batch
+        outputs: list[str] = []
+        errors: list[str] = []
+        for line in self.server.files[batch["input_file_id"]].splitlines():
+            request = json.loads(line)
+            status, response = self._complete(
+                dict(request["body"], stream=False), simulate_latency=False
+            )
+            result = dict(
+                id=f"batch_req_{uuid.uuid4().hex[:12]}",
+                custom_id=request["custom_id"],
+                response=dict(status_code=status, body=response),
+                error=None,
+            )
+            (outputs if status == 200 else errors).append(json.dumps(result) + "\n")
+        for key, lines in (("output_file_id", outputs), ("error_file_id", errors)):
+            if len(lines) > 0:
+                file_id = f"file-mock-{uuid.uuid4().hex[:12]}"
+                self.server.files[file_id] = "".join(lines).encode()
+                batch[key] = file_id
+        batch["status"] = "completed"
+        batch["request_counts"] = dict(
+            total=len(outputs) + len(errors),
+            completed=len(outputs),
+            failed=len(errors),
+        )
+        return batch
+
+    def _complete(
+        self, request: dict, simulate_latency: bool = True
+    ) -> tuple[int, dict | None]:
+        """
+        按请求生成一个回复，Batch 请求不模拟延迟。
+
+        Returns:
+            tuple[int, dict | None]: 状态码和响应体；流式请求直接写出，响应体为 None。
+
+        """
+        args = self.server.args
+        draw, response_index = self.server.draw()
+
+        # 错误按比例依次注入：429、5xx、截断、无法解析
+        if draw < args.error_429_rate:
+            return 429, {"error": {"message": "Rate limit reached (mock)"}}
+        draw -= args.error_429_rate
+        if draw < args.error_5xx_rate:
+            return 503, {"error": {"message": "Service unavailable (mock)"}}
+        draw -= args.error_5xx_rate
+        # n > 1 时每个 choice 各自抽取回复，截断和格式错误也按 choice 注入
+        choices = [self._choice(draw, response_index)]
+        for _ in range(1, request.get("n") or 1):
+            with self.server.rng_lock:
+                draw = self.server.rng.random()
+                response_index = self.server.rng.randrange(len(self.server.responses))
+            choices.append(self._choice(draw, response_index))
+        stall = False
+        if args.stall_rate > 0:
+            with self.server.rng_lock:
+                stall = self.server.rng.random() < args.stall_rate
+        reasoning = REASONING * args.reasoning_repeats
+
+        prompt_text = "".join(m.get("content") or "" for m in request["messages"])
+        completion_tokens = sum(
+            _count_tokens(reasoning + content) for content, _ in choices
+        )
+        cached_tokens = self.server.cache_hit_tokens(prompt_text)
+        usage = dict(
+            prompt_tokens=_count_tokens(prompt_text),
+            prompt_cache_hit_tokens=cached_tokens,
+            prompt_cache_miss_tokens=_count_tokens(prompt_text) - cached_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=_count_tokens(prompt_text) + completion_tokens,
+            completion_tokens_details=dict(
+                reasoning_tokens=_count_tokens(reasoning) * len(choices)
+            ),
+        )
+        completion_id = f"chatcmpl-mock-{uuid.uuid4().hex[:12]}"
+        model = request.get("model", "mock")
+        if simulate_latency:
+            time.sleep(args.ttft)
+        if request.get("stream"):
+            include_usage = (request.get("stream_options") or {}).get("include_usage")
+            self._stream(
+                completion_id,
+                model,
+                reasoning,
+                choices,
+                usage if include_usage else None,
+                stall,
+            )
+            return 200, None
+        if simulate_latency:
+            time.sleep(usage["completion_tokens"] / args.tokens_per_second)
+        return (
+            200,
+            dict(
+                id=completion_id,
+                object="chat.completion",
+                created=int(time.time()),
+                model=model,
+                choices=[
+                    dict(
+                        index=i,
+                        message=dict(
+                            role="assistant",
+                            content=content,
+                            reasoning_content=reasoning,
+                        ),
+                        finish_reason=finish_reason,
+                    )
+                    for i, (content, finish_reason) in enumerate(choices)
+                ],
+                usage=usage,
+            ),
+        )
+
+    def _choice(self, draw: float, response_index: int) -> tuple[str, str]:
+        """按随机数构造一个 choice 的 (回复内容, finish_reason)，已扣除 429/5xx 的比例。"""
+        args = self.server.args
+        problem, solution = self.server.responses[response_index]
+        content = f"[Problem Description]\n{problem}\n\n[Solution]\n{solution}"
+        if draw < args.truncation_rate:
+            return content[: len(content) // 2], "length"
+        if draw - args.truncation_rate < args.malformed_rate:
+            return f"{problem}\n\n{solution}", "stop"
+        return content, "stop"
+
+    def _deltas(self, reasoning: str, content: str) -> Iterator[dict]:
+        for token in _split_tokens(reasoning):
+            yield dict(reasoning_content=token)
+        for token in _split_tokens(content):
+            yield dict(content=token)
+
+    def _stream(
+        self,
+        completion_id: str,
+        model: str,
+        reasoning: str,
+        choices: list[tuple[str, str]],
+        usage: dict | None,
+        stall: bool = False,
+    ):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def event(choices: list, usage: dict | None = None) -> bytes:
+            chunk = dict(
+                id=completion_id,
+                object="chat.completion.chunk",
+                created=int(time.time()),
+                model=model,
+                choices=choices,
+                usage=usage,
+            )
+            return f"data: {json.dumps(chunk)}\n\n".encode()
+
+        interval = 1 / self.server.args.tokens_per_second
+        next_time = time.monotonic()
+        # 多个 choice 的 delta 交替发出，与真实服务一致
+        deltas = [
+            dict(index=index, delta=delta, finish_reason=None)
+            for group in itertools.zip_longest(
+                *(self._deltas(reasoning, content) for content, _ in choices)
+            )
+            for index, delta in enumerate(group)
+            if delta is not None
+        ]
+        try:
+            for i, delta in enumerate(deltas):
+                if stall and i == len(deltas) // 2:
+                    # 模拟服务端在流的中途停住
+                    time.sleep(self.server.args.stall_seconds)
+                next_time += interval
+                # 攒够一段时间再一起 sleep，避免每个 token 都调用一次 sleep
+                if (delay := next_time - time.monotonic()) > 0.01:
+                    time.sleep(delay)
+                self._write_chunk(event([delta]))
+            for index, (_, finish_reason) in enumerate(choices):
+                self._write_chunk(
+                    event([dict(index=index, delta={}, finish_reason=finish_reason)])
+                )
+            if usage is not None:
+                self._write_chunk(event([], usage))
+            self._write_chunk(b"data: [DONE]\n\n")
+            self._write_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端提前关闭了流（例如流式校验中止了请求）
+            self.close_connection = True
+
+
+def main():
+    # 测试和压测脚本直接使用服务类，只有命令行入口需要 transformers
+    from transformers import HfArgumentParser
+
+    args, *_ = cast(
+        tuple[Args, ...], HfArgumentParser(Args).parse_args_into_dataclasses()
+    )
+    server = MockOpenAIServer(args)
+    print(f"Mock OpenAI server listening on {server.url}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
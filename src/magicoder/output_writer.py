@@ -0,0 +1,178 @@
+"""成组提交（group commit）的生成结果输出
+
+逐条 `json.dumps` + `write` + `flush` 在并发生成时成了热路径上的瓶颈。`OutputWriter` 把记录
+先放进内存缓冲，攒够 `flush_records` 条、`flush_bytes` 字节或距上次写出超过 `flush_interval`
+秒时，一次 `write` 写出整批。fsync 策略：
+
+- `commit`（默认）：只在 `sync()` 时 fsync。生成日志在 fsync 之前会先调用它，保证日志中标为
+  done 的记录一定已经落盘；
+- `flush`：每批写出后都 fsync；
+- `never`：从不 fsync，交给操作系统，只适合压测。
+
+设置 `max_segment_bytes` 后输出按大小切成多个段，第一个段就是输出路径本身，之后依次为：
+
+    data-xxx.jsonl
+    data-xxx.0001.jsonl
+    data-xxx.0002.jsonl
+
+打开时会截掉最后一个段里崩溃时只写了一半的最后一行，之后可以安全地追加。
+"""
+
+import json
+import os
+import time
+from pathlib import Path
+from typing import Iterator
+
+FSYNC_POLICIES = ("commit", "flush", "never")
+
+
+def segment_path_for(path: str | Path, n: int) -> Path:
+    """输出的第 n 个段，第 0 个段就是输出路径本身。"""
+    path = Path(path)
+    if n == 0:
+        return path
+    return path.with_name(f"{path.stem}.{n:04d}{path.suffix}")
+
+
+def segment_paths(path: str | Path) -> list[Path]:
+    """按顺序列出输出已有的所有段。"""
+    paths: list[Path] = []
+    while (segment := segment_path_for(path, len(paths))).exists():
+        paths.append(segment)
+    return paths
+
+
+def repair_torn_line(path: str | Path) -> int:
+    """截掉崩溃时只写了一半的最后一行，返回截掉的字节数。只从文件末尾往前读。"""
+    path = Path(path)
+    if not path.exists():
+        return 0
+    with path.open("rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            start = max(0, position - 65536)
+            f.seek(start)
+            chunk = f.read(position - start)
+            if position == end and chunk.endswith(b"\n"):
+                return 0
+            if (newline := chunk.rfind(b"\n")) >= 0:
+                position = start + newline + 1
+                break
+            position = start
+        f.truncate(position)
+    return end - position
+
+
+def iter_records(path: str | Path) -> Iterator[dict]:
+    """按顺序读出所有段中完整的记录。"""
+    for segment in segment_paths(path):
+        with segment.open("r") as f:
+            for line in f:
+                if line.endswith("\n"):
+                    yield json.loads(line)
+
+
+class OutputWriter:
+    """
+    Args:
+        path (str | Path): 输出路径（第一个段），已存在时追加到最后一个段。
+        flush_records (int): 缓冲多少条记录后写出。
+        flush_bytes (int): 缓冲多少字节后写出。
+        flush_interval (float): 距上次写出超过多少秒时，下一次写入会触发写出。
+        fsync (str): fsync 策略，见 `FSYNC_POLICIES`。
+        max_segment_bytes (int | None): 每个段的大小上限，None 表示不切分。
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        flush_records: int = 64,
+        flush_bytes: int = 1 << 20,
+        flush_interval: float = 1.0,
+        fsync: str = "commit",
+        max_segment_bytes: int | None = None,
+    ):
+        assert fsync in FSYNC_POLICIES, f"Unknown fsync policy: {fsync}"
+        assert max_segment_bytes is None or max_segment_bytes > 0
+        self.path = Path(path)
+        self.flush_records = flush_records
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.max_segment_bytes = max_segment_bytes
+        self.segment = max(len(segment_paths(self.path)) - 1, 0)
+        segment_path = segment_path_for(self.path, self.segment)
+        if (n_bytes := repair_torn_line(segment_path)) > 0:
+            print(f"[output] Dropped a torn line of {n_bytes} bytes in {segment_path}")
+        self._file = segment_path.open("a")
+        self._size = self._file.tell()
+        self._buffer: list[str] = []
+        self._buffer_bytes = 0
+        self._last_flush = time.monotonic()
+        self.n_records = 0
+        self.n_flushes = 0
+
+    def write(self, record: dict):
+        line = json.dumps(record) + "\n"
+        self._buffer.append(line)
+        self._buffer_bytes += len(line)
+        self.n_records += 1
+        if (
+            len(self._buffer) >= self.flush_records
+            or self._buffer_bytes >= self.flush_bytes
+            or time.monotonic() - self._last_flush >= self.flush_interval
+        ):
+            self.flush()
+
+    def _rotate(self):
+        self._file.flush()
+        if self.fsync != "never":
+            os.fsync(self._file.fileno())
+        self._file.close()
+        self.segment += 1
+        self._file = segment_path_for(self.path, self.segment).open("a")
+        self._size = 0
+
+    def flush(self):
+        """把缓冲的记录一次写出（必要时切换到新的段）。"""
+        if len(self._buffer) > 0:
+            batch: list[str] = []
+            batch_bytes = 0
+            for line in self._buffer:
+                if (
+                    self.max_segment_bytes is not None
+                    and self._size + batch_bytes > 0
+                    and self._size + batch_bytes + len(line) > self.max_segment_bytes
+                ):
+                    self._file.write("".join(batch))
+                    self._rotate()
+                    batch, batch_bytes = [], 0
+                batch.append(line)
+                batch_bytes += len(line)
+            self._file.write("".join(batch))
+            self._size += batch_bytes
+            self._buffer.clear()
+            self._buffer_bytes = 0
+            self._file.flush()
+            if self.fsync == "flush":
+                os.fsync(self._file.fileno())
+            self.n_flushes += 1
+        self._last_flush = time.monotonic()
+
+    def sync(self):
+        """写出缓冲并 fsync，生成日志 fsync 之前调用。"""
+        self.flush()
+        if self.fsync != "never":
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+    def discard(self):
+        """丢弃缓冲中还没写出的记录并关闭。失去分片租约后调用，输出已经归接手的 worker 所有。"""
+        self._buffer.clear()
+        self._buffer_bytes = 0
+        self._file.close()
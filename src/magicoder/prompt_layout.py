@@ -0,0 +1,66 @@
+"""请求的提示布局：让服务商的前缀缓存尽量命中
+
+DeepSeek 等服务商会缓存请求开头相同的部分（按固定长度的块），命中的 prompt token 价格只有
+原价的几分之一，首 token 也更快。`data/prompt.txt` 把种子代码放在模板中间，之后的要求说明
+每个请求都一样，却因为排在种子后面而无法命中缓存。
+
+`prefix` 布局把模板里包含 `{code}` 的段落（以空行分隔）移到末尾，其余段落保持原来的顺序：
+
+    system: SYSTEM                                  ┐
+    user:   Please gain inspiration from ...        │ 所有请求逐字节相同
+            Guidelines for each section: ...        │
+            Code snippet for inspiration:           ┘
+            ```
+            <种子代码>
+            ```
+
+`template` 布局（默认）原样使用模板，保证已有数据的指纹不变。布局会改变提示，`prefix`
+布局计入数据指纹。
+"""
+
+import functools
+
+LAYOUTS = ("template", "prefix")
+
+
+@functools.cache
+def arrange(template: str, layout: str) -> str:
+    """按布局重排模板，结果仍然是带 `{code}` 占位符的模板。"""
+    assert layout in LAYOUTS, f"Unknown prompt layout: {layout}"
+    if layout == "template":
+        return template
+    paragraphs = template.strip("\n").split("\n\n")
+    code_paragraphs = [paragraph for paragraph in paragraphs if "{code}" in paragraph]
+    assert len(code_paragraphs) == 1, "The template needs one paragraph with {code}"
+    stable = [paragraph for paragraph in paragraphs if "{code}" not in paragraph]
+    return "\n\n".join(stable + code_paragraphs)
+
+
+def build_messages(system: str, template: str, code: str, layout: str) -> list[dict]:
+    """构造一个种子的对话消息。"""
+    return [
+        {"role": "system", "content": system},
+        {"role": "user", "content": arrange(template, layout).format(code=code)},
+    ]
+
+
+def stable_prefix(system: str, template: str, layout: str) -> str:
+    """所有请求共有的前缀（system 消息加上 user 消息中种子之前的部分）。"""
+    return system + arrange(template, layout).split("{code}")[0]
+
+
+def group_by_prefix(examples: list[dict], window: int) -> list[tuple[int, dict]]:
+    """
+    在每 `window` 个种子内按种子代码排序派发：开头几行相同的种子（同样的 import、
+    许可证头）相邻，它们共有的部分接在固定前缀后面，也能命中缓存。
+
+    Returns:
+        list[tuple[int, dict]]: 按派发顺序排列的 (原来的位置, 种子)。`window` 不超过生成引擎的
+            重排窗口时，引擎按原来的位置写出，输出仍按 index 排序。
+
+    """
+    order: list[int] = []
+    for start in range(0, len(examples), window):
+        chunk = range(start, min(start + window, len(examples)))
+        order.extend(sorted(chunk, key=lambda position: examples[position]["seed"]))
+    return [(position, examples[position]) for position in order]
@@ -0,0 +1,267 @@
+"""RPM / TPM 令牌桶限流
+
+请求前按估算的 token 数（prompt + max_tokens）预扣额度，响应返回后按实际 `usage` 多退少补。
+桶的状态保存在一个加了 `fcntl` 文件锁的小文件里，所以同一台机器上的所有生成进程共享同一份配额。
+默认的状态文件由接口地址和 API key 的哈希决定：同一个账号的进程共享配额，不同接口或账号互不影响。
+异步版本在线程里读写状态文件，等锁时不会阻塞事件循环。
+"""
+
+import asyncio
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Mapping, Sequence
+
+# 粗略估算：平均每个 token 约 4 个字符
+CHARS_PER_TOKEN = 4
+
+
+def default_state_file(endpoint: str | None, api_key: str | None) -> Path:
+    """按接口地址和 API key 区分的状态文件，文件名里只有哈希，不含 key 本身。"""
+    digest = hashlib.sha256(f"{endpoint or ''}\0{api_key or ''}".encode())
+    return (
+        Path(tempfile.gettempdir())
+        / f"magicoder-rate-limit-{digest.hexdigest()[:16]}.json"
+    )
+
+
+def estimate_request_tokens(
+    messages: Sequence[Mapping[str, Any]], max_tokens: int | None, n: int | None = 1
+) -> int:
+    """估算一次请求最多会消耗的 token 数（prompt + 最大生成长度 × 回复数）。"""
+    n_chars = sum(len(str(message.get("content") or "")) for message in messages)
+    return n_chars // CHARS_PER_TOKEN + (max_tokens or 0) * (n or 1)
+
+
+def usage_total_tokens(usage: Any) -> int | None:
+    """从 OpenAI 对象或 HTTP 返回的字典中读取 `usage.total_tokens`。"""
+    if usage is None:
+        return None
+    if isinstance(usage, Mapping):
+        return usage.get("total_tokens")
+    return getattr(usage, "total_tokens", None)
+
+
+@dataclass
+class Reservation:
+    """一次已预扣的额度，拿到实际 usage 后调用 `settle`。"""
+
+    limiter: "RateLimiter"
+    estimated_tokens: int
+    settled: bool = field(default=False)
+
+    def settle(self, usage: Any) -> None:
+        if self.settled:
+            return
+        actual_tokens = usage_total_tokens(usage)
+        if actual_tokens is None:
+            # 拿不到 usage 时保守地按估算值计费
+            actual_tokens = self.estimated_tokens
+        self.limiter.charge_tokens(actual_tokens - self.estimated_tokens)
+        self.settled = True
+
+    def cancel(self) -> None:
+        """请求没有发出去或失败时退还预扣的 token（请求数不退还）。"""
+        if self.settled:
+            return
+        self.limiter.charge_tokens(-self.estimated_tokens)
+        self.settled = True
+
+    async def async_settle(self, usage: Any) -> None:
+        """`settle` 的异步版本。"""
+        if not self.settled:
+            await asyncio.to_thread(self.settle, usage)
+
+    async def async_cancel(self) -> None:
+        """`cancel` 的异步版本。"""
+        if not self.settled:
+            await asyncio.to_thread(self.cancel)
+
+
+@dataclass
+class RateLimiter:
+    """同时约束每分钟请求数（rpm）和每分钟 token 数（tpm）的令牌桶。
+
+    Args:
+        rpm (int | None): 每分钟请求数上限，None 表示不限。
+        tpm (int | None): 每分钟 token 数上限，None 表示不限。
+        state_file (Path | None): 共享状态文件，None 表示只在当前进程内限流。
+    """
+
+    rpm: int | None = None
+    tpm: int | None = None
+    state_file: Path | None = None
+
+    def __post_init__(self):
+        assert self.rpm is None or self.rpm > 0
+        assert self.tpm is None or self.tpm > 0
+        self._lock = threading.Lock()
+        self._state: dict[str, float] | None = None
+
+    def _capacities(self) -> dict[str, float]:
+        return dict(
+            requests=float("inf") if self.rpm is None else float(self.rpm),
+            tokens=float("inf") if self.tpm is None else float(self.tpm),
+        )
+
+    def _update(self, n_requests: int, n_tokens: int, force: bool) -> float:
+        """在锁内补充令牌并尝试扣减，返回还需要等待的秒数（0 表示已扣减）。"""
+        with self._lock:
+            if self.state_file is None:
+                return self._update_state(n_requests, n_tokens, force)
+            self.state_file.parent.mkdir(parents=True, exist_ok=True)
+            fd = os.open(self.state_file, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                with os.fdopen(os.dup(fd), "r+") as f:
+                    content = f.read()
+                    self._state = json.loads(content) if content else None
+                    wait = self._update_state(n_requests, n_tokens, force)
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(self._state))
+                    f.flush()
+                return wait
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+
+    def _update_state(self, n_requests: int, n_tokens: int, force: bool) -> float:
+        now = time.time()
+        capacities = self._capacities()
+        if self._state is None:
+            self._state = dict(
+                requests=capacities["requests"],
+                tokens=capacities["tokens"],
+                updated_at=now,
+            )
+        elapsed = max(0.0, now - self._state["updated_at"])
+        self._state["updated_at"] = now
+        for key in ("requests", "tokens"):
+            capacity = capacities[key]
+            if capacity == float("inf"):
+                self._state[key] = capacity
+                continue
+            # 其他进程可能配置了不同的上限
+            level = min(self._state.get(key, capacity), capacity)
+            self._state[key] = min(capacity, level + elapsed * capacity / 60)
+        if force:
+            self._state["tokens"] -= n_tokens
+            return 0.0
+        # 单次请求超过桶容量时最多要求桶满，避免永远等不到
+        need = dict(
+            requests=min(n_requests, capacities["requests"]),
+            tokens=min(n_tokens, capacities["tokens"]),
+        )
+        waits = [
+            (need[key] - self._state[key]) * 60 / capacities[key]
+            for key in ("requests", "tokens")
+            if self._state[key] < need[key]
+        ]
+        if len(waits) > 0:
+            return max(waits)
+        self._state["requests"] -= n_requests
+        self._state["tokens"] -= n_tokens
+        return 0.0
+
+    def charge_tokens(self, n_tokens: int) -> None:
+        """直接计入（或退还，若为负数）token，不等待。"""
+        if n_tokens != 0 and self.tpm is not None:
+            self._update(0, n_tokens, force=True)
+
+    def acquire(self, n_tokens: int) -> Reservation:
+        while (wait := self._update(1, n_tokens, force=False)) > 0:
+            time.sleep(wait)
+        return Reservation(self, n_tokens)
+
+    async def async_acquire(self, n_tokens: int) -> Reservation:
+        # 文件锁可能被其他进程持有，放到线程里等待
+        while (wait := await asyncio.to_thread(self._update, 1, n_tokens, False)) > 0:
+            await asyncio.sleep(wait)
+        return Reservation(self, n_tokens)
+
+
+_RATE_LIMITER: RateLimiter | None = None
+_CONFIGURED = False
+
+
+def configure(
+    rpm: int | None,
+    tpm: int | None,
+    state_file: str | Path | None = None,
+    endpoint: str | None = None,
+    api_key: str | None = None,
+) -> RateLimiter | None:
+    """设置进程内共享的限流器；rpm 和 tpm 都为 None 时关闭限流。
+
+    state_file 为 None 时按 endpoint 和 api_key 选择默认的状态文件（见 `default_state_file`）。
+    """
+    global _RATE_LIMITER, _CONFIGURED
+    _CONFIGURED = True
+    if rpm is None and tpm is None:
+        _RATE_LIMITER = None
+    else:
+        _RATE_LIMITER = RateLimiter(
+            rpm=rpm,
+            tpm=tpm,
+            state_file=(
+                default_state_file(endpoint, api_key)
+                if state_file is None
+                else Path(state_file)
+            ),
+        )
+    return _RATE_LIMITER
+
+
+def get_rate_limiter() -> RateLimiter | None:
+    """返回共享的限流器。未调用 `configure` 时从环境变量
+    `MAGICODER_RPM`、`MAGICODER_TPM` 和 `MAGICODER_RATE_LIMIT_FILE` 读取配置，
+    默认的状态文件按 `OPENAI_BASE_URL` 和 `OPENAI_API_KEY` 区分。"""
+    if not _CONFIGURED:
+        rpm = os.getenv("MAGICODER_RPM")
+        tpm = os.getenv("MAGICODER_TPM")
+        configure(
+            rpm=None if rpm is None else int(rpm),
+            tpm=None if tpm is None else int(tpm),
+            state_file=os.getenv("MAGICODER_RATE_LIMIT_FILE"),
+            endpoint=os.getenv("OPENAI_BASE_URL"),
+            api_key=os.getenv("OPENAI_API_KEY"),
+        )
+    return _RATE_LIMITER
+
+
+def reserve(
+    messages: Sequence[Mapping[str, Any]],
+    max_tokens: int | None,
+    limiter: RateLimiter | None = None,
+    n: int | None = 1,
+) -> Reservation | None:
+    """阻塞直到限流器允许发出请求；未启用限流时返回 None。
+
+    `limiter` 为 None 时使用共享的限流器（见 `get_rate_limiter`）。
+    """
+    if limiter is None:
+        limiter = get_rate_limiter()
+    if limiter is None:
+        return None
+    return limiter.acquire(estimate_request_tokens(messages, max_tokens, n))
+
+
+async def async_reserve(
+    messages: Sequence[Mapping[str, Any]],
+    max_tokens: int | None,
+    limiter: RateLimiter | None = None,
+    n: int | None = 1,
+) -> Reservation | None:
+    """`reserve` 的异步版本。"""
+    if limiter is None:
+        limiter = get_rate_limiter()
+    if limiter is None:
+        return None
+    return await limiter.async_acquire(estimate_request_tokens(messages, max_tokens, n))
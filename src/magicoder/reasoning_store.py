@@ -0,0 +1,250 @@
+"""r1 推理过程（`reasoning_content`）的压缩旁路存储
+
+推理过程通常是问题和答案的 5~10 倍长，但之后的清洗、去污染、预处理和合并都用不到它。
+生成时把推理过程单独写到输出文件旁边，主 JSONL 里只保留一个引用：
+
+    data-xxx.jsonl                  # {"index": 3, ..., "reasoning_ref": {...}}
+    data-xxx.jsonl.reasoning        # 每条推理过程独立压缩后依次追加
+    data-xxx.jsonl.reasoning.idx    # {"codec": "zstd"} 文件头 + {"index", "offset", "length"}
+                                    # （每个种子多个回复时还有 "sub_index"）
+
+引用里带有相对主文件目录的存储文件名、偏移和长度，读取单条推理过程只需要一次 seek；
+索引文件用于按 index 查找。安装了 `zstandard` 时用 zstd 压缩，否则退回标准库的 zlib。
+
+多个进程可能追加同一个存储（分片被接手、共用的输出目录），每次写入都在 `fcntl` 排他锁内
+先定位到文件末尾再追加，偏移总是指向自己写入的字节。
+"""
+
+import fcntl
+import functools
+import json
+import os
+import zlib
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import cast
+
+from magicoder.output_writer import repair_torn_line
+
+try:
+    import zstandard
+
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
+CODECS = ("zstd", "zlib")
+DEFAULT_CODEC = "zstd" if ZSTD_AVAILABLE else "zlib"
+
+
+def store_path_for(output_path: str | Path) -> Path:
+    """输出文件对应的推理过程存储路径。"""
+    output_path = Path(output_path)
+    return output_path.with_name(output_path.name + ".reasoning")
+
+
+def index_path_for(store_path: str | Path) -> Path:
+    store_path = Path(store_path)
+    return store_path.with_name(store_path.name + ".idx")
+
+
+def _compress(codec: str, data: bytes, level: int) -> bytes:
+    if codec == "zstd":
+        assert ZSTD_AVAILABLE, "Install `zstandard` to write zstd reasoning stores"
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    return zlib.compress(data, level)
+
+
+def _decompress(codec: str, data: bytes) -> bytes:
+    if codec == "zstd":
+        assert ZSTD_AVAILABLE, "Install `zstandard` to read zstd reasoning stores"
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def _read_codec(index_path: Path) -> str | None:
+    if not index_path.exists():
+        return None
+    with index_path.open("r") as f:
+        header = f.readline()
+    return json.loads(header)["codec"] if header.endswith("\n") else None
+
+
+class ReasoningStore:
+    """追加写入的推理过程存储，每条推理过程独立压缩，可以随机读取。
+
+    Args:
+        path (str | Path): 存储文件路径，已存在时继续追加（沿用已有的压缩方式）。
+        codec (str): "zstd" 或 "zlib"。
+        level (int): 压缩级别。
+    """
+
+    def __init__(self, path: str | Path, codec: str = DEFAULT_CODEC, level: int = 3):
+        assert codec in CODECS, f"Unknown codec {codec}"
+        self.path = Path(path)
+        self.index_path = index_path_for(self.path)
+        existing_codec = _read_codec(self.index_path)
+        self.codec = codec if existing_codec is None else existing_codec
+        self.level = level
+        # 崩溃时索引可能只写了半行；存储文件末尾的半条记录没有被引用，直接在后面追加即可
+        repair_torn_line(self.index_path)
+        self._file = self.path.open("ab")
+        self._index = self.index_path.open("a")
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        try:
+            if self.index_path.stat().st_size == 0:
+                self._index.write(json.dumps(dict(codec=self.codec)) + "\n")
+                self._index.flush()
+        finally:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+    def put(self, index: int, text: str, sub_index: int | None = None) -> dict:
+        """写入一条推理过程，返回写入主 JSONL 的引用。"""
+        data = _compress(self.codec, text.encode("utf-8"), self.level)
+        # `tell()` 看不到其他进程的写入，在锁内重新定位到末尾，存储和索引一起追加
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        try:
+            offset = self._file.seek(0, os.SEEK_END)
+            self._file.write(data)
+            self._file.flush()
+            entry = dict(index=index, offset=offset, length=len(data))
+            if sub_index is not None:
+                entry["sub_index"] = sub_index
+            self._index.write(json.dumps(entry) + "\n")
+            self._index.flush()
+        finally:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        return dict(
+            file=self.path.name, offset=offset, length=len(data), codec=self.codec
+        )
+
+    def sync(self):
+        """把存储和索引落盘。主文件 fsync 之前调用，保证引用指向的数据已经写入。"""
+        os.fsync(self._file.fileno())
+        os.fsync(self._index.fileno())
+
+    def close(self):
+        self._file.close()
+        self._index.close()
+
+
+def detach_reasoning(data: dict, store: ReasoningStore) -> dict:
+    """把记录里的 `reasoning_content` 移到存储中，换成 `reasoning_ref`。"""
+    reasoning_content = data.pop("reasoning_content", None)
+    if reasoning_content:
+        data["reasoning_ref"] = store.put(
+            data["index"], reasoning_content, data.get("sub_index")
+        )
+    return data
+
+
+class ReasoningReader:
+    """按需读取推理过程。索引在第一次按 index 查找时才加载。"""
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.index_path = index_path_for(self.path)
+        self.codec = _read_codec(self.index_path) or DEFAULT_CODEC
+        self._offsets: dict[tuple[int, int], tuple[int, int]] | None = None
+
+    def read(self, offset: int, length: int) -> str:
+        with self.path.open("rb") as f:
+            f.seek(offset)
+            data = f.read(length)
+        return _decompress(self.codec, data).decode("utf-8")
+
+    def _load_index(self) -> dict[tuple[int, int], tuple[int, int]]:
+        offsets: dict[tuple[int, int], tuple[int, int]] = {}
+        with self.index_path.open("r") as f:
+            next(f)
+            for line in f:
+                if not line.endswith("\n"):
+                    continue
+                entry = json.loads(line)
+                # 同一 index 重新生成过时，以最后一次写入为准
+                key = (entry["index"], entry.get("sub_index", 0))
+                offsets[key] = (entry["offset"], entry["length"])
+        return offsets
+
+    def get(self, index: int, sub_index: int = 0) -> str | None:
+        if self._offsets is None:
+            self._offsets = self._load_index()
+        if (index, sub_index) not in self._offsets:
+            return None
+        return self.read(*self._offsets[(index, sub_index)])
+
+    def __contains__(self, index: int) -> bool:
+        if self._offsets is None:
+            self._offsets = self._load_index()
+        return (index, 0) in self._offsets
+
+
+@functools.cache
+def get_reader(path: Path) -> ReasoningReader:
+    return ReasoningReader(path)
+
+
+def load_reasoning(data: dict, data_path: str | Path) -> str:
+    """
+    取出一条记录的推理过程。
+
+    Args:
+        data (dict): 主 JSONL 中的一条记录，推理过程可以是内联的或引用。
+        data_path (str | Path): 记录所在的主文件，引用中的存储文件名相对它的目录。
+
+    Returns:
+        str: 推理过程，没有时返回空字符串。
+
+    """
+    if "reasoning_ref" not in data:
+        return data.get("reasoning_content") or ""
+    ref = data["reasoning_ref"]
+    store_path = (Path(data_path).parent / ref["file"]).resolve()
+    return get_reader(store_path).read(ref["offset"], ref["length"])
+
+
+@dataclass(frozen=True)
+class Args:
+    data_file: str
+    output_file: str
+    inline: bool = field(
+        default=False,
+        metadata={"help": "Write reasoning back inline instead of detaching it"},
+    )
+    codec: str = field(default=DEFAULT_CODEC, metadata={"choices": list(CODECS)})
+
+
+def main():
+    """把已有的数据文件转换成旁路存储的格式，或者反过来把推理过程写回主文件。"""
+    from transformers import HfArgumentParser
+
+    args, *_ = cast(
+        tuple[Args, ...], HfArgumentParser(Args).parse_args_into_dataclasses()
+    )
+    output_path = Path(args.output_file)
+    assert not output_path.exists(), f"{output_path} already exists"
+    store = (
+        None if args.inline else ReasoningStore(store_path_for(output_path), args.codec)
+    )
+    n_records = 0
+    with open(args.data_file, "r") as f_in, output_path.open("w") as f_out:
+        for line in f_in:
+            data = json.loads(line)
+            if store is None:
+                data["reasoning_content"] = load_reasoning(data, args.data_file)
+                data.pop("reasoning_ref", None)
+            else:
+                if "reasoning_ref" in data:
+                    data["reasoning_content"] = load_reasoning(data, args.data_file)
+                    del data["reasoning_ref"]
+                data = detach_reasoning(data, store)
+            f_out.write(json.dumps(data) + "\n")
+            n_records += 1
+    if store is not None:
+        store.sync()
+        store.close()
+    print(f"Wrote {n_records} records to {output_path}")
+
+
+if __name__ == "__main__":
+    main()
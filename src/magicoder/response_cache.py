@@ -0,0 +1,163 @@
+"""对话补全响应的持久化缓存
+
+以 (model, messages, temperature, max_tokens, n, stream) 的哈希为键，把原始响应（包括
+`reasoning_content`）保存在 SQLite 里。重跑生成脚本时命中的请求直接回放，不再花钱，
+解析和清洗逻辑就可以离线反复调整。
+
+被解析拒绝的回复（截断、无法解析等）不能留在缓存里，否则以同样参数重试时只会回放同一个
+坏回复。生成函数在 `track_keys` 中发请求，回复不可用时用 `evict` 删除本次命中或写入的条目。
+"""
+
+import contextvars
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Iterator
+
+
+def cache_key(
+    model: str,
+    messages: Any,
+    temperature: float | None = None,
+    max_tokens: int | None = None,
+    n: int | None = None,
+    stream: bool | None = None,
+) -> str:
+    """与 `Args.fingerprint` 一样，把决定响应内容的参数拼起来取 sha256。"""
+    args = (
+        model,
+        json.dumps(messages, sort_keys=True, ensure_ascii=False),
+        temperature,
+        max_tokens,
+        n,
+        bool(stream),
+    )
+    combined = "".join(map(str, args))
+    return hashlib.sha256(combined.encode()).hexdigest()
+
+
+def request_key(request: dict, content_key: str = "messages") -> str:
+    """
+    按请求参数计算缓存键，OpenAI SDK 和 HTTP 客户端共用，保证两边取的参数一致。
+
+    Args:
+        request (dict): 请求参数（SDK 的关键字参数或 HTTP 请求体）。
+        content_key (str): 提示所在的键，对话补全为 "messages"，文本补全为 "prompt"。
+
+    """
+    return cache_key(
+        model=request["model"],
+        messages=request[content_key],
+        temperature=request.get("temperature"),
+        max_tokens=request.get("max_tokens"),
+        n=request.get("n"),
+        stream=request.get("stream"),
+    )
+
+
+# 当前请求命中或写入的缓存键，见 `track_keys`
+_USED_KEYS: contextvars.ContextVar[list[str] | None] = contextvars.ContextVar(
+    "response_cache_keys", default=None
+)
+
+
+def _mark_used(key: str) -> None:
+    if (keys := _USED_KEYS.get()) is not None:
+        keys.append(key)
+
+
+@contextmanager
+def track_keys() -> Iterator[list[str]]:
+    """收集这段代码（包括其中创建的任务）命中或写入的缓存键。"""
+    keys: list[str] = []
+    token = _USED_KEYS.set(keys)
+    try:
+        yield keys
+    finally:
+        _USED_KEYS.reset(token)
+
+
+def evict(keys: list[str]) -> None:
+    """删除不可用的回复，之后同样的请求会重新发送。"""
+    cache = get_response_cache()
+    if cache is None:
+        return
+    for key in keys:
+        cache.delete(key)
+
+
+class ResponseCache:
+    """基于 SQLite 的响应缓存，多进程可以共用同一个文件。"""
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, response TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def get(self, key: str) -> Any | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            self.n_misses += 1
+            return None
+        self.n_hits += 1
+        _mark_used(key)
+        return json.loads(row[0])
+
+    def put(self, key: str, response: Any) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+                (key, json.dumps(response, ensure_ascii=False), time.time()),
+            )
+            self._conn.commit()
+        _mark_used(key)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+_RESPONSE_CACHE: ResponseCache | None = None
+_CONFIGURED = False
+
+
+def configure(path: str | Path | None) -> ResponseCache | None:
+    """设置进程内共享的响应缓存；path 为 None 时关闭缓存。"""
+    global _RESPONSE_CACHE, _CONFIGURED
+    _CONFIGURED = True
+    _RESPONSE_CACHE = None if path is None else ResponseCache(path)
+    return _RESPONSE_CACHE
+
+
+def get_response_cache() -> ResponseCache | None:
+    """返回共享的响应缓存。未调用 `configure` 时从环境变量
+    `MAGICODER_RESPONSE_CACHE` 读取缓存文件路径。"""
+    if not _CONFIGURED:
+        configure(os.getenv("MAGICODER_RESPONSE_CACHE"))
+    return _RESPONSE_CACHE
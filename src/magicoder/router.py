@@ -0,0 +1,350 @@
+"""按健康状况加权，在多个 OpenAI 兼容接口之间分配请求
+
+每个接口有自己的权重和配额（rpm / tpm），路由器记录各接口的成功率和延迟（指数滑动平均），
+按 `权重 × 成功率 × 相对速度` 随机选择接口；连续失败的接口会被摘除一段时间再重新启用。
+这样总吞吐量就是各家合同配额之和，而不是单个服务商的容量。
+
+接口配置文件是一个 JSON 列表，例如：
+
+    [
+        {"name": "aliyun", "kind": "openai", "model": "deepseek-r1",
+         "base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1",
+         "api_key_env": "OPENAI_API_KEY", "weight": 2, "rpm": 600},
+        {"name": "xirang", "kind": "http", "model": "<MODEL_CODE>",
+         "base_url": "https://wishub-x1.ctyun.cn/v1/chat/completions",
+         "api_key_env": "XIRANG_API_KEY", "weight": 1, "rpm": 300}
+    ]
+"""
+
+import dataclasses
+import json
+import os
+import random
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Literal
+
+import httpx
+import openai
+
+import magicoder
+from magicoder import http_client, rate_limit, telemetry
+from magicoder.chat import ChatResult, collect_stream
+from magicoder.concurrency import Outcome, classify_error
+from magicoder.hedging import Hedger
+from magicoder.stream_validator import SectionValidator
+from magicoder.stream_watchdog import StreamDeadlines, StreamWatchdog
+
+EndpointKind = Literal["openai", "http"]
+
+
+@dataclass(frozen=True)
+class EndpointConfig:
+    """
+    Args:
+        name (str): 接口名称，用于日志和统计。
+        kind (EndpointKind): "openai" 使用 OpenAI SDK；"http" 直接 POST 到完整的
+            `/chat/completions` 地址（如天翼云），流式时按 SSE 解析。
+        model (str): 请求中使用的模型名称（天翼云为模型代码）。
+        base_url (str | None): "openai" 为 SDK 的 base_url；"http" 为完整的请求地址。
+        api_key_env (str): 保存 API key 的环境变量名。
+        weight (float): 相对权重，通常与合同配额成正比。
+        rpm (int | None): 该接口的每分钟请求数上限。
+        tpm (int | None): 该接口的每分钟 token 数上限。
+        connect_timeout (float): 建立连接的超时时间（秒）。
+        read_timeout (float): 等待响应（非流式）或两次读取之间（流式）的超时时间（秒）。
+    """
+
+    name: str
+    kind: EndpointKind
+    model: str
+    base_url: str | None = field(default=None)
+    api_key_env: str = field(default="OPENAI_API_KEY")
+    weight: float = field(default=1.0)
+    rpm: int | None = field(default=None)
+    tpm: int | None = field(default=None)
+    connect_timeout: float = field(default=10.0)
+    read_timeout: float = field(default=600.0)
+
+
+class Endpoint:
+    """一个接口及其健康统计。"""
+
+    # 指数滑动平均的系数
+    EWMA_ALPHA = 0.1
+
+    def __init__(self, config: EndpointConfig):
+        assert config.weight > 0, f"Endpoint {config.name} needs a positive weight"
+        self.config = config
+        self.success_rate = 1.0
+        self.latency: float | None = None
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.n_requests = 0
+        self._openai_client: openai.AsyncOpenAI | None = None
+        self._http_client: http_client.AsyncChatHTTPClient | None = None
+        # 每个接口单独计配额；未配置时使用共享限流器
+        self.limiter: rate_limit.RateLimiter | None = None
+        if config.rpm is not None or config.tpm is not None:
+            self.limiter = rate_limit.RateLimiter(
+                rpm=config.rpm,
+                tpm=config.tpm,
+                state_file=rate_limit.default_state_file(
+                    config.base_url, os.getenv(config.api_key_env)
+                ),
+            )
+
+    @property
+    def name(self) -> str:
+        return self.config.name
+
+    def is_available(self, now: float) -> bool:
+        return now >= self.ejected_until
+
+    def _api_key(self) -> str | None:
+        return os.getenv(self.config.api_key_env)
+
+    def openai_client(self) -> openai.AsyncOpenAI:
+        if self._openai_client is None:
+            self._openai_client = openai.AsyncOpenAI(
+                api_key=self._api_key(),
+                base_url=self.config.base_url,
+                timeout=httpx.Timeout(
+                    self.config.read_timeout, connect=self.config.connect_timeout
+                ),
+            )
+        return self._openai_client
+
+    def http_client(self) -> http_client.AsyncChatHTTPClient:
+        if self._http_client is None:
+            assert self.config.base_url is not None, "HTTP endpoints need a base_url"
+            api_key = self._api_key()
+            assert api_key, f"Missing environment variable {self.config.api_key_env}"
+            self._http_client = http_client.AsyncChatHTTPClient(
+                http_client.XirangConfig(
+                    url=self.config.base_url,
+                    api_key=api_key,
+                    model_code=self.config.model,
+                ),
+                connect_timeout=self.config.connect_timeout,
+                read_timeout=self.config.read_timeout,
+            )
+        return self._http_client
+
+    async def complete(
+        self,
+        stream: bool,
+        validator: SectionValidator | None = None,
+        deadlines: StreamDeadlines | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        kwargs = dict(model=self.config.model, **kwargs)
+        if stream:
+            # 流式响应的最后一个 chunk 带上 usage，用于限流结算
+            kwargs["stream_options"] = {"include_usage": True}
+        if self.config.kind == "http":
+            if stream:
+                return await collect_stream(
+                    http_client.astream_with_limit(
+                        self.http_client(), kwargs, self.limiter
+                    ),
+                    validator,
+                    None if deadlines is None else StreamWatchdog(deadlines),
+                )
+            response = await http_client.apost_with_cache(
+                self.http_client(), kwargs, self.limiter
+            )
+            return ChatResult.from_response(response)
+        request = magicoder.utils.async_chat_completions(
+            client=self.openai_client(), limiter=self.limiter, stream=stream, **kwargs
+        )
+        if stream and deadlines is not None:
+            # 看门狗从发出请求开始计时，等待响应头的时间也计入首 token 期限
+            watchdog = StreamWatchdog(deadlines)
+            response = await watchdog.start(request)
+            return await collect_stream(response, validator, watchdog)
+        response = await request
+        if stream:
+            return await collect_stream(response, validator)
+        return ChatResult.from_response(response)
+
+    def record(self, outcome: Outcome, latency: float) -> None:
+        if outcome == Outcome.ABORTED:
+            # 回复内容不合格不代表接口不健康
+            return
+        alpha = self.EWMA_ALPHA
+        success = 1.0 if outcome == Outcome.SUCCESS else 0.0
+        self.success_rate = (1 - alpha) * self.success_rate + alpha * success
+        if outcome == Outcome.SUCCESS:
+            self.consecutive_failures = 0
+            self.latency = (
+                latency
+                if self.latency is None
+                else (1 - alpha) * self.latency + alpha * latency
+            )
+        elif outcome == Outcome.OVERLOAD:
+            self.consecutive_failures += 1
+
+    async def aclose(self) -> None:
+        if self._openai_client is not None:
+            await self._openai_client.close()
+        if self._http_client is not None:
+            await self._http_client.aclose()
+
+
+class Router:
+    """
+    Args:
+        endpoints (list[Endpoint]): 参与路由的接口。
+        eject_after (int): 连续多少次过载错误（429 / 5xx / 超时）后摘除接口。
+        min_success_rate (float): 成功率滑动平均低于该值时摘除接口。
+        cooldown (float): 摘除的秒数，到期后以中性的健康状态重新参与路由。
+        hedger (Hedger | None): 开启对冲时，慢请求会再发一份给（优先）另一个接口。
+        stream_deadlines (StreamDeadlines | None): 流式请求的首 token、chunk 间隔和总时长期限。
+    """
+
+    def __init__(
+        self,
+        endpoints: list[Endpoint],
+        eject_after: int = 5,
+        min_success_rate: float = 0.2,
+        cooldown: float = 60.0,
+        hedger: Hedger | None = None,
+        stream_deadlines: StreamDeadlines | None = None,
+    ):
+        assert len(endpoints) > 0, "Router needs at least one endpoint"
+        names = [endpoint.name for endpoint in endpoints]
+        assert len(set(names)) == len(names), f"Duplicate endpoint names: {names}"
+        self.endpoints = endpoints
+        self.eject_after = eject_after
+        self.min_success_rate = min_success_rate
+        self.cooldown = cooldown
+        self.hedger = hedger
+        self.stream_deadlines = stream_deadlines
+
+    @staticmethod
+    def from_file(path: str | Path, **kwargs: Any) -> "Router":
+        configs = json.loads(Path(path).read_text())
+        return Router(
+            [Endpoint(EndpointConfig(**config)) for config in configs], **kwargs
+        )
+
+    @staticmethod
+    def from_env(model: str, **kwargs: Any) -> "Router":
+        """只有一个接口的路由器，使用 `OPENAI_API_KEY` 和 `OPENAI_BASE_URL`。"""
+        config = EndpointConfig(
+            name="default",
+            kind="openai",
+            model=model,
+            base_url=os.getenv("OPENAI_BASE_URL"),
+        )
+        return Router([Endpoint(config)], **kwargs)
+
+    def _score(self, endpoint: Endpoint, fastest: float | None) -> float:
+        score = endpoint.config.weight * max(endpoint.success_rate, 0.01)
+        if fastest is not None and endpoint.latency is not None:
+            score *= fastest / endpoint.latency
+        return score
+
+    def pick(self, exclude: set[str] | None = None) -> Endpoint:
+        """按健康状况随机选择接口；`exclude` 中的接口只在没有其他可用接口时才会被选中。"""
+        now = time.time()
+        available = [e for e in self.endpoints if e.is_available(now)]
+        if exclude and any(e.name not in exclude for e in available):
+            available = [e for e in available if e.name not in exclude]
+        if len(available) == 0:
+            # 全部被摘除时选最早恢复的一个，不让生成停下来
+            return min(self.endpoints, key=lambda e: e.ejected_until)
+        latencies = [e.latency for e in available if e.latency is not None]
+        fastest = min(latencies) if len(latencies) > 0 else None
+        weights = [self._score(e, fastest) for e in available]
+        return random.choices(available, weights=weights)[0]
+
+    def _eject_if_unhealthy(self, endpoint: Endpoint) -> None:
+        if (
+            endpoint.consecutive_failures < self.eject_after
+            and endpoint.success_rate >= self.min_success_rate
+        ):
+            return
+        endpoint.ejected_until = time.time() + self.cooldown
+        print(
+            f"[router] Ejecting {endpoint.name} for {self.cooldown:.0f}s "
+            f"(success rate {endpoint.success_rate:.2f}, "
+            f"{endpoint.consecutive_failures} consecutive failures)"
+        )
+        # 冷却结束后从中性状态重新开始
+        endpoint.consecutive_failures = 0
+        endpoint.success_rate = 0.5
+
+    async def complete(
+        self,
+        stream: bool = False,
+        validator: SectionValidator | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        """选择一个接口发送请求。异常原样抛出，由生成引擎决定是否重试。
+
+        `validator` 只对流式请求生效。
+        """
+        if self.hedger is None:
+            return await self._complete_once(self.pick(), stream, validator, **kwargs)
+        used: set[str] = set()
+
+        def attempt():
+            endpoint = self.pick(exclude=used)
+            used.add(endpoint.name)
+            # 每一份请求都需要独立的校验状态
+            return self._complete_once(
+                endpoint,
+                stream,
+                None if validator is None else dataclasses.replace(validator),
+                **kwargs,
+            )
+
+        result = await self.hedger.run(attempt)
+        telemetry.observe(endpoint=result.endpoint)
+        return result
+
+    async def _complete_once(
+        self,
+        endpoint: Endpoint,
+        stream: bool,
+        validator: SectionValidator | None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        endpoint.n_requests += 1
+        telemetry.observe(endpoint=endpoint.name)
+        start = time.monotonic()
+        try:
+            result = await endpoint.complete(
+                stream=stream,
+                validator=validator,
+                deadlines=self.stream_deadlines,
+                **kwargs,
+            )
+        except Exception as e:
+            endpoint.record(classify_error(e), time.monotonic() - start)
+            self._eject_if_unhealthy(endpoint)
+            raise
+        endpoint.record(Outcome.SUCCESS, time.monotonic() - start)
+        result.endpoint = endpoint.name
+        telemetry.observe(finish_reason=result.finish_reason)
+        telemetry.observe_usage(result.usage)
+        return result
+
+    def summary(self) -> dict[str, dict]:
+        return {
+            endpoint.name: dict(
+                requests=endpoint.n_requests,
+                success_rate=round(endpoint.success_rate, 3),
+                latency=(
+                    None if endpoint.latency is None else round(endpoint.latency, 2)
+                ),
+            )
+            for endpoint in self.endpoints
+        }
+
+    async def aclose(self) -> None:
+        for endpoint in self.endpoints:
+            await endpoint.aclose()
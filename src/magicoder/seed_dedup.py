@@ -0,0 +1,262 @@
+"""派发请求之前的种子代码去重
+
+`clean_data.filter_same_seed_problem_solution` 要等补全生成（并付费）之后才去掉重复的种子。
+StarCoder 语料里有大量重复的许可证头、import 和样板代码，这里在派发前就把它们跳过：
+
+- 精确重复：与 `clean_data` 相同，去掉所有空白后取哈希；
+- 近似重复：MinHash + LSH 分桶（与 `minhash_deduplication` 相同的哈希方式），候选再用
+  签名估计的 Jaccard 相似度确认。
+
+索引保存在 SQLite 里，跨运行、跨分片共享：同一段代码只会生成一次。每个种子以
+（数据集指纹, raw_index）登记，不同语料的同一个 raw_index 互不干扰；同一个种子再次出现
+（例如续跑）时不算重复。
+
+派发前只用 `find_duplicates` 查询，成功写出之后才用 `add` 登记。失败或被跳过的种子不会
+留在索引里，之后的运行仍然可以生成它们。
+"""
+
+import hashlib
+import os
+import re
+import sqlite3
+import struct
+import threading
+from pathlib import Path
+from typing import Sequence
+
+import numpy as np
+
+from magicoder.clean_data import remove_all_whitespaces
+
+NON_ALPHA = re.compile("[^A-Za-z_0-9]")
+MAX_HASH = np.uint64((1 << 32) - 1)
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+
+
+def exact_key(seed: str) -> str:
+    return hashlib.sha256(remove_all_whitespaces(seed).encode()).hexdigest()
+
+
+def _sha1_hash32(data: bytes) -> int:
+    return struct.unpack("<I", hashlib.sha1(data).digest()[:4])[0]
+
+
+def _integrate(f, a: float, b: float, n: int = 1000) -> float:
+    xs = np.linspace(a, b, n + 1)
+    ys = f(xs)
+    return float((ys[:-1] + ys[1:]).sum() * (b - a) / (2 * n))
+
+
+def optimal_param(threshold: float, num_perm: int) -> tuple[int, int]:
+    """与 `minhash_deduplication.optimal_param` 相同（误报和漏报等权），用 numpy 做数值积分。"""
+    min_error = float("inf")
+    opt = (1, num_perm)
+    for b in range(1, num_perm + 1):
+        for r in range(1, num_perm // b + 1):
+            fp = _integrate(lambda s: 1 - (1 - s**r) ** b, 0.0, threshold)
+            fn = _integrate(lambda s: (1 - s**r) ** b, threshold, 1.0)
+            if (error := 0.5 * fp + 0.5 * fn) < min_error:
+                min_error = error
+                opt = (b, r)
+    return opt
+
+
+class MinHasher:
+    def __init__(self, num_perm: int = 128, ngram_size: int = 5, seed: int = 42):
+        self.num_perm = num_perm
+        self.ngram_size = ngram_size
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+
+    def signature(self, text: str) -> np.ndarray | None:
+        """返回 uint32 的 MinHash 签名；代码太短、凑不出一个 n-gram 时返回 None。"""
+        words = [word for word in NON_ALPHA.split(text) if word != ""]
+        if len(words) < self.ngram_size:
+            return None
+        shingles = {
+            " ".join(words[i : i + self.ngram_size])
+            for i in range(len(words) - self.ngram_size + 1)
+        }
+        hv = np.array(
+            [_sha1_hash32(shingle.encode("utf-8")) for shingle in shingles],
+            dtype=np.uint64,
+        )
+        phv = np.bitwise_and((np.outer(hv, self.a) + self.b) % MERSENNE_PRIME, MAX_HASH)
+        return phv.min(axis=0).astype(np.uint32)
+
+
+class SeedIndex:
+    """
+    Args:
+        path (str | Path): SQLite 文件，多个进程（分片 worker）可以共用。
+        threshold (float): 估计的 Jaccard 相似度达到该值即视为近似重复。
+        num_perm (int): MinHash 签名长度。
+        ngram_size (int): 按标识符切分后的 n-gram 大小。
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        threshold: float = 0.85,
+        num_perm: int = 128,
+        ngram_size: int = 5,
+    ):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.threshold = threshold
+        self.hasher = MinHasher(num_perm, ngram_size)
+        self.n_bands, self.n_rows = optimal_param(threshold, num_perm)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            self.path, timeout=60, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);"
+            "CREATE TABLE IF NOT EXISTS exact "
+            "(key TEXT PRIMARY KEY, source TEXT, raw_index INTEGER);"
+            "CREATE TABLE IF NOT EXISTS signatures "
+            "(id INTEGER PRIMARY KEY, source TEXT, raw_index INTEGER, signature BLOB);"
+            "CREATE TABLE IF NOT EXISTS bands (band INTEGER, bucket INTEGER, id INTEGER);"
+            "CREATE INDEX IF NOT EXISTS bands_bucket ON bands (band, bucket);"
+        )
+        # 参数不同的签名无法比较，已有索引必须沿用建立时的参数
+        params = f"{threshold}:{num_perm}:{ngram_size}"
+        self._conn.execute("INSERT OR IGNORE INTO meta VALUES ('params', ?)", (params,))
+        (existing,) = self._conn.execute(
+            "SELECT value FROM meta WHERE key = 'params'"
+        ).fetchone()
+        assert existing == params, f"Seed index {path} was built with {existing}"
+
+    def _buckets(self, signature: np.ndarray) -> list[int]:
+        buckets = []
+        for band in range(self.n_bands):
+            rows = signature[band * self.n_rows : (band + 1) * self.n_rows]
+            digest = hashlib.blake2b(rows.tobytes(), digest_size=8).digest()
+            buckets.append(int.from_bytes(digest, "little", signed=True))
+        return buckets
+
+    def _find_near(
+        self, signature: np.ndarray, buckets: list[int]
+    ) -> tuple[str, int] | None:
+        candidates: set[int] = set()
+        for band, bucket in enumerate(buckets):
+            candidates.update(
+                id
+                for (id,) in self._conn.execute(
+                    "SELECT id FROM bands WHERE band = ? AND bucket = ?", (band, bucket)
+                )
+            )
+        for id in sorted(candidates):
+            source, raw_index, blob = self._conn.execute(
+                "SELECT source, raw_index, signature FROM signatures WHERE id = ?",
+                (id,),
+            ).fetchone()
+            other = np.frombuffer(blob, dtype=np.uint32)
+            if (signature == other).mean() >= self.threshold:
+                return source, raw_index
+        return None
+
+    def _check_and_add(
+        self, seed: str, owner: tuple[str, int]
+    ) -> tuple[str, int] | None:
+        """返回与之重复的种子，不重复时登记并返回 None。"""
+        key = exact_key(seed)
+        row = self._conn.execute(
+            "SELECT source, raw_index FROM exact WHERE key = ?", (key,)
+        ).fetchone()
+        if row is not None:
+            if tuple(row) == owner:
+                # 续跑时遇到自己登记过的种子
+                return None
+            return row[0], row[1]
+        signature = self.hasher.signature(seed)
+        if signature is not None:
+            buckets = self._buckets(signature)
+            if (duplicate := self._find_near(signature, buckets)) is not None:
+                return duplicate
+        self._conn.execute("INSERT INTO exact VALUES (?, ?, ?)", (key, *owner))
+        if signature is not None:
+            id = self._conn.execute(
+                "INSERT INTO signatures (source, raw_index, signature) "
+                "VALUES (?, ?, ?)",
+                (*owner, signature.tobytes()),
+            ).lastrowid
+            self._conn.executemany(
+                "INSERT INTO bands VALUES (?, ?, ?)",
+                [(band, bucket, id) for band, bucket in enumerate(buckets)],
+            )
+        return None
+
+    def _transaction(
+        self,
+        seeds: Sequence[str],
+        raw_indices: Sequence[int],
+        source: str,
+        commit: bool,
+    ) -> list[tuple[str, int] | None]:
+        with self._lock:
+            # 整批在一个写事务里完成，并发的 worker 不会同时登记同一段代码
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                duplicates = [
+                    self._check_and_add(seed, (source, raw_index))
+                    for seed, raw_index in zip(seeds, raw_indices)
+                ]
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT" if commit else "ROLLBACK")
+        return duplicates
+
+    def find_duplicates(
+        self, seeds: Sequence[str], raw_indices: Sequence[int], source: str
+    ) -> list[tuple[str, int] | None]:
+        """
+        检查一批种子是否与索引中的、或同一批中更靠前的种子重复，不修改索引。
+
+        Args:
+            seeds (Sequence[str]): 种子代码。
+            raw_indices (Sequence[int]): 种子在语料中的行号。
+            source (str): 语料的指纹。
+
+        Returns:
+            list[tuple[str, int] | None]: 每个种子重复的那个（数据集指纹, raw_index），
+                不重复时为 None。
+
+        """
+        # 在事务里依次登记以便批内互相比较，最后回滚
+        return self._transaction(seeds, raw_indices, source, commit=False)
+
+    def add(self, seeds: Sequence[str], raw_indices: Sequence[int], source: str):
+        """登记成功写出的种子；已有重复（例如其他 worker 刚登记）的不再登记。"""
+        self._transaction(seeds, raw_indices, source, commit=True)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM exact").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+_SEED_INDEX: SeedIndex | None = None
+_CONFIGURED = False
+
+
+def configure(path: str | Path | None, threshold: float = 0.85) -> SeedIndex | None:
+    """设置进程内共享的种子索引；path 为 None 时不去重。"""
+    global _SEED_INDEX, _CONFIGURED
+    _CONFIGURED = True
+    _SEED_INDEX = None if path is None else SeedIndex(path, threshold)
+    return _SEED_INDEX
+
+
+def get_seed_index() -> SeedIndex | None:
+    """返回共享的种子索引。未调用 `configure` 时从环境变量 `MAGICODER_SEED_INDEX`
+    读取索引文件路径。"""
+    if not _CONFIGURED:
+        configure(os.getenv("MAGICODER_SEED_INDEX"))
+    return _SEED_INDEX
@@ -0,0 +1,203 @@
+"""派发请求之前的种子代码质量预筛
+
+`extract_seed_code` 随机截取 1~15 行，经常截到空行、右括号、许可证、压缩过的代码或自动生成
+的代码。这些种子照样要花一次完整的 r1 调用，结果往往解析失败或在清洗时被丢掉。
+
+这里对每个种子在 Python 里逐条算出几个廉价的特征（str 的内建方法和预编译的正则），
+特征按列收集后再用 numpy 一次比较所有阈值：
+
+- 非空白字符数和非空白比例：空行、只有括号的片段；
+- 标识符 token 的熵：重复的样板、数据表；
+- 注释行比例、许可证和自动生成标记：许可证头、"DO NOT EDIT" 的生成代码；
+- 最长行和最长 token：压缩过的 JS/CSS、base64 数据；
+- 语法标记（括号、赋值、分号、常见关键字）：混进语料的纯文本。
+
+被拒绝的种子在同一文档里重新截取，多次仍不合格时标记为 rejected，不再派发。
+
+`refine` 不改动计数，拒绝原因和重新截取次数作为列保存在数据集里；接受率由 `observe`
+按实际选中的窗口统计，`datasets` 命中缓存、跳过映射时也一样。
+"""
+
+import re
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Callable, Sequence
+
+import numpy as np
+
+TOKEN = re.compile(r"[A-Za-z_][A-Za-z_0-9]*|\d+")
+COMMENT_LINE = re.compile(r"^\s*(#|//|/\*|\*|--|;|<!--|%|')")
+LICENSE = re.compile(
+    r"copyright|licen[cs]e|spdx-license|warrant(y|ies)|all rights reserved",
+    re.IGNORECASE,
+)
+GENERATED = re.compile(
+    r"auto-?generated|do not edit|generated by|code generator", re.IGNORECASE
+)
+CODE_MARKER = re.compile(
+    r"[=(){}\[\];]|\b(def|class|return|import|function|func|fn|var|let|const|"
+    r"public|private|static|void|int|if|for|while|struct|package|include)\b"
+)
+LONGEST_TOKEN = re.compile(r"\S+")
+
+REASONS = (
+    "too short",
+    "mostly whitespace",
+    "low entropy",
+    "mostly comments",
+    "license text",
+    "generated code",
+    "minified",
+    "no code markers",
+)
+
+
+def _entropy(tokens: list[str]) -> float:
+    if len(tokens) == 0:
+        return 0.0
+    counts = np.fromiter(Counter(tokens).values(), dtype=np.float64)
+    probs = counts / counts.sum()
+    return float(-(probs * np.log2(probs)).sum())
+
+
+def _features(seed: str) -> tuple:
+    lines = [line for line in seed.splitlines() if line.strip() != ""]
+    n_non_whitespace = len(seed) - sum(map(str.isspace, seed))
+    n_comment_lines = sum(COMMENT_LINE.match(line) is not None for line in lines)
+    return (
+        n_non_whitespace,
+        n_non_whitespace / max(len(seed), 1),
+        _entropy(TOKEN.findall(seed)),
+        n_comment_lines / max(len(lines), 1),
+        LICENSE.search(seed) is not None,
+        GENERATED.search(seed) is not None,
+        max(map(len, lines), default=0),
+        max(map(len, LONGEST_TOKEN.findall(seed)), default=0),
+        CODE_MARKER.search(seed) is not None,
+    )
+
+
+@dataclass
+class SeedFilter:
+    min_non_whitespace: int = 20
+    min_non_whitespace_ratio: float = 0.25
+    min_token_entropy: float = 2.0
+    max_comment_ratio: float = 0.7
+    max_line_length: int = 300
+    max_token_length: int = 100
+    # 重新截取的次数，0 表示只判定不重试
+    max_resamples: int = 3
+    n_seeds: int = field(default=0)
+    n_accepted_first: int = field(default=0)
+    n_accepted_resampled: int = field(default=0)
+    rejections: Counter = field(default_factory=Counter)
+
+    def score(self, seeds: Sequence[str]) -> dict[str, np.ndarray]:
+        """逐条计算特征，按列返回。"""
+        columns = zip(*map(_features, seeds))
+        names = (
+            "non_whitespace",
+            "non_whitespace_ratio",
+            "token_entropy",
+            "comment_ratio",
+            "license",
+            "generated",
+            "line_length",
+            "token_length",
+            "code_marker",
+        )
+        return {name: np.asarray(column) for name, column in zip(names, columns)}
+
+    def reject_reasons(self, seeds: Sequence[str]) -> list[str | None]:
+        """每个种子被拒绝的（第一条）原因，合格时为 None。"""
+        if len(seeds) == 0:
+            return []
+        scores = self.score(seeds)
+        # 与 REASONS 一一对应
+        failures = np.stack(
+            [
+                scores["non_whitespace"] < self.min_non_whitespace,
+                scores["non_whitespace_ratio"] < self.min_non_whitespace_ratio,
+                scores["token_entropy"] < self.min_token_entropy,
+                scores["comment_ratio"] > self.max_comment_ratio,
+                scores["license"],
+                scores["generated"],
+                (scores["line_length"] > self.max_line_length)
+                | (scores["token_length"] > self.max_token_length),
+                ~scores["code_marker"].astype(bool),
+            ]
+        )
+        rejected = failures.any(axis=0)
+        first = failures.argmax(axis=0)
+        return [
+            REASONS[reason] if is_rejected else None
+            for is_rejected, reason in zip(rejected, first)
+        ]
+
+    def refine(
+        self, seeds: list[str], resample: Callable[[int], str]
+    ) -> tuple[list[str], list[str], list[int]]:
+        """
+        筛选一批种子，不合格的用 `resample(i)` 重新截取。
+
+        Args:
+            seeds (list[str]): 初次截取的种子。
+            resample (Callable[[int], str]): 为第 i 个种子在原文档中重新截取。
+
+        Returns:
+            tuple[list[str], list[str], list[int]]: 最终的种子、拒绝原因（合格时为空字符串）
+                和每个种子重新截取的次数。
+
+        """
+        seeds = list(seeds)
+        reasons = self.reject_reasons(seeds)
+        resamples = [0] * len(seeds)
+        for _ in range(self.max_resamples):
+            pending = [i for i, reason in enumerate(reasons) if reason is not None]
+            if len(pending) == 0:
+                break
+            resampled = [resample(i) for i in pending]
+            for i, seed, reason in zip(
+                pending, resampled, self.reject_reasons(resampled)
+            ):
+                seeds[i] = seed
+                reasons[i] = reason
+                resamples[i] += 1
+        return seeds, [reason or "" for reason in reasons], resamples
+
+    def observe(self, rejections: Sequence[str], resamples: Sequence[int]):
+        """按 `refine` 产出的两列统计接受率。"""
+        rejections_array = np.asarray(rejections, dtype=object)
+        accepted = rejections_array == ""
+        first_try = np.asarray(resamples) == 0
+        self.n_seeds += len(rejections_array)
+        self.n_accepted_first += int((accepted & first_try).sum())
+        self.n_accepted_resampled += int((accepted & ~first_try).sum())
+        self.rejections.update(rejections_array[~accepted].tolist())
+
+    def report(self) -> dict:
+        n_rejected = sum(self.rejections.values())
+        return dict(
+            seeds=self.n_seeds,
+            accepted_first_try=self.n_accepted_first,
+            accepted_after_resampling=self.n_accepted_resampled,
+            rejected=n_rejected,
+            acceptance_rate=(
+                round(1 - n_rejected / self.n_seeds, 4) if self.n_seeds > 0 else None
+            ),
+            rejections=dict(self.rejections.most_common()),
+        )
+
+
+_SEED_FILTER: SeedFilter | None = None
+
+
+def configure(enabled: bool, max_resamples: int = 3) -> SeedFilter | None:
+    """设置进程内共享的种子预筛（用于汇总接受率）；enabled 为 False 时不筛选。"""
+    global _SEED_FILTER
+    _SEED_FILTER = SeedFilter(max_resamples=max_resamples) if enabled else None
+    return _SEED_FILTER
+
+
+def get_seed_filter() -> SeedFilter | None:
+    return _SEED_FILTER
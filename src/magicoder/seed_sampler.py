@@ -0,0 +1,130 @@
+"""按需取种子的随机排列采样器
+
+旧流程先对整个语料做 `map(extract_seed_code)`，再 `shuffle`、加 index 列，最后才
+`select([start, end))`，开销与语料大小成正比。这里用一个以 seed 为密钥的 Feistel 网络
+构造 [0, n) 上的伪随机排列：打乱后的第 i 个位置可以在 O(1) 时间内算出对应的原始行，
+于是只需要为请求的窗口读取文档、提取种子代码。
+
+给定 (seed, start_index, 窗口) 得到的种子代码是确定的。注意它与旧的 `shuffle`
+采样得到的种子不同，因此 `sampler` 参与数据指纹的计算，默认仍使用 `shuffle`，
+需要时用 `--sampler permutation` 开启。
+"""
+
+import hashlib
+import random
+from typing import Callable
+
+from datasets import Dataset
+
+from magicoder.journal import GenerationJournal
+from magicoder.seed_filter import SeedFilter
+
+SAMPLERS = ("shuffle", "permutation")
+
+
+class FeistelPermutation:
+    """[0, n) 上由密钥决定的伪随机排列。
+
+    在 2^(2k) ≥ n 的定义域上做平衡 Feistel 网络，结果落在 [0, n) 之外时继续迭代
+    （cycle walking）。定义域不超过 4n，平均迭代次数小于 4。
+
+    Args:
+        n (int): 排列的大小。
+        key (int): 密钥，通常为 `args.seed`。
+        rounds (int): Feistel 轮数。
+    """
+
+    def __init__(self, n: int, key: int, rounds: int = 6):
+        assert n > 0, "Cannot permute an empty range"
+        self.n = n
+        self.rounds = rounds
+        self.half_bits = max(1, ((n - 1).bit_length() + 1) // 2)
+        self.mask = (1 << self.half_bits) - 1
+        self._key = str(key).encode()
+
+    def _round(self, round_index: int, value: int) -> int:
+        digest = hashlib.blake2b(
+            round_index.to_bytes(1, "little") + value.to_bytes(8, "little"),
+            key=self._key,
+            digest_size=8,
+        ).digest()
+        return int.from_bytes(digest, "little") & self.mask
+
+    def _encrypt(self, value: int) -> int:
+        left, right = value >> self.half_bits, value & self.mask
+        for round_index in range(self.rounds):
+            left, right = right, left ^ self._round(round_index, right)
+        return (left << self.half_bits) | right
+
+    def __call__(self, position: int) -> int:
+        """打乱后的第 `position` 个位置对应的原始行号。"""
+        assert 0 <= position < self.n, f"{position} out of range [0, {self.n})"
+        value = self._encrypt(position)
+        while value >= self.n:
+            value = self._encrypt(value)
+        return value
+
+    def __len__(self) -> int:
+        return self.n
+
+
+def row_rng(seed: int, raw_index: int) -> random.Random:
+    """每一行独立的随机数生成器，提取结果不依赖窗口里的其他行。"""
+    return random.Random(f"{seed}:{raw_index}")
+
+
+def select_window(
+    dataset: Dataset,
+    seed: int,
+    start_index: int,
+    end_index: int,
+    extract: Callable[[str, random.Random], str],
+    seed_filter: SeedFilter | None = None,
+) -> Dataset:
+    """
+    只为打乱后的 [start_index, end_index) 读取原始文档并提取种子代码。
+
+    Args:
+        dataset (Dataset): 原始语料，包含 "content" 列。
+        seed (int): 排列和提取种子代码的随机种子。
+        start_index (int): 窗口起点（打乱后的位置）。
+        end_index (int): 窗口终点（不含）。
+        extract (Callable[[str, random.Random], str]): 从文档中提取种子代码。
+        seed_filter (SeedFilter | None): 种子预筛，不合格的种子用同一行的随机数生成器重新提取。
+
+    Returns:
+        Dataset: 包含 "seed"、"raw_index" 和 "index" 列，与旧流程的列一致；
+            预筛时另有 "rejection" 列（合格时为空字符串）和 "resamples" 列。
+
+    """
+    permutation = FeistelPermutation(len(dataset), key=seed)
+    raw_indices = [permutation(index) for index in range(start_index, end_index)]
+    contents = dataset.select(raw_indices)["content"]
+    rngs = [row_rng(seed, raw_index) for raw_index in raw_indices]
+    columns = {
+        "seed": [extract(content, rng) for content, rng in zip(contents, rngs)],
+        "raw_index": raw_indices,
+        "index": list(range(start_index, end_index)),
+    }
+    if seed_filter is not None:
+        (
+            columns["seed"],
+            columns["rejection"],
+            columns["resamples"],
+        ) = seed_filter.refine(columns["seed"], lambda i: extract(contents[i], rngs[i]))
+    return Dataset.from_dict(columns)
+
+
+def skip_rejected_seeds(dataset: Dataset, journal: GenerationJournal) -> Dataset:
+    """去掉预筛后仍不合格的种子，并在日志中记为 skipped。"""
+    kept: list[int] = []
+    for position, (index, rejection) in enumerate(
+        zip(dataset["index"], dataset["rejection"])
+    ):
+        if rejection == "":
+            kept.append(position)
+        else:
+            journal.mark_skipped(index, f"Low-quality seed: {rejection}")
+    if len(kept) < len(dataset):
+        print(f"[seed_filter] Skipped {len(dataset) - len(kept)} low-quality seeds")
+    return dataset.select(kept)
@@ -0,0 +1,339 @@
+"""基于租约文件的分片生成
+
+把一段种子范围切成固定大小的分片，放在多台机器都能访问的共享目录里：
+
+    shard_dir/
+        plan.json                  # 范围、分片大小、seed 和数据指纹，由第一个 worker 创建
+        leases/{start}_{end}.lease # 当前持有者和到期时间
+        leases/{start}_{end}.lock  # 续约、接手和释放租约时持有的文件锁
+        segments/{start}_{end}.jsonl          # 分片输出
+        segments/{start}_{end}.jsonl.journal  # 分片的生成日志（见 magicoder.journal）
+        segments/{start}_{end}.jsonl.reasoning  # 分片的推理过程（见 magicoder.reasoning_store）
+        segments/{start}_{end}.jsonl.dead  # 分片的死信队列（见 magicoder.dead_letter）
+        segments/{start}_{end}.done           # 分片完成的标记
+
+worker 用 `O_EXCL` 创建租约文件来认领分片，并在后台线程里定期续约。租约过期说明持有者
+已经退出，其他 worker 会接手：输出和日志都是追加写入的，接手后只重新生成日志里尚未完成的
+index。续约时发现租约已被接手的 worker 立即取消在途请求，丢弃还没写出的缓冲，不再写入
+该分片的任何文件。所有分片完成后按分片顺序合并，同一 index 只保留第一条，结果是确定的。
+
+认领空闲的分片只依赖原子的文件创建；续约、接手过期的租约和释放都要先读出租约、检查持有者
+再写入，这几步在分片的 `fcntl` 文件锁内进行，否则续约可能覆盖刚被别人接手的租约，两个 worker
+同时写同一个分片。NFS 上 `flock` 由服务端的记录锁实现；各机器的时钟偏差应远小于租约时长。
+"""
+
+import fcntl
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Iterator, cast
+
+from transformers import HfArgumentParser
+
+from magicoder.output_writer import iter_records, repair_torn_line, segment_paths
+
+
+@dataclass(frozen=True)
+class Shard:
+    start: int
+    end: int
+
+    @property
+    def name(self) -> str:
+        return f"{self.start}_{self.end}"
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def _write_json_atomic(path: Path, data: dict):
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}")
+    with tmp_path.open("w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _read_json(path: Path) -> dict | None:
+    """文件不存在或刚创建还没写完时返回 None。"""
+    try:
+        return json.loads(path.read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def repair_segment(path: Path):
+    """截掉崩溃时只写了一半的最后一行，接手的 worker 才能安全地追加。"""
+    for segment in segment_paths(path) or [path]:
+        repair_torn_line(segment)
+
+
+class ShardCoordinator:
+    """
+    Args:
+        shard_dir (str | Path): 所有 worker 共享的目录，必须已经用 `init_plan` 初始化。
+        worker_id (str): 写入租约文件的 worker 标识。
+        lease_ttl (float): 租约时长（秒），超过该时间未续约的分片会被其他 worker 接手。
+    """
+
+    def __init__(
+        self,
+        shard_dir: str | Path,
+        worker_id: str | None = None,
+        lease_ttl: float = 300.0,
+    ):
+        self.shard_dir = Path(shard_dir)
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_ttl = lease_ttl
+        plan = _read_json(self.shard_dir / "plan.json")
+        assert plan is not None, f"No plan.json in {self.shard_dir}"
+        self.plan = plan
+        (self.shard_dir / "leases").mkdir(exist_ok=True)
+        (self.shard_dir / "segments").mkdir(exist_ok=True)
+
+    @staticmethod
+    def init_plan(
+        shard_dir: str | Path, start: int, end: int, shard_size: int, **extra: Any
+    ) -> dict:
+        """创建分片计划；计划已存在时直接返回已有的计划，由调用方检查是否一致。"""
+        assert start < end and shard_size > 0
+        shard_dir = Path(shard_dir)
+        shard_dir.mkdir(parents=True, exist_ok=True)
+        plan_path = shard_dir / "plan.json"
+        plan = dict(start=start, end=end, shard_size=shard_size, **extra)
+        tmp_path = shard_dir / f".plan.json.{uuid.uuid4().hex}"
+        tmp_path.write_text(json.dumps(plan, indent=4))
+        try:
+            # link 不会覆盖已有文件，多个 worker 同时启动时只有一个计划生效
+            os.link(tmp_path, plan_path)
+        except FileExistsError:
+            pass
+        finally:
+            tmp_path.unlink()
+        existing = _read_json(plan_path)
+        assert existing is not None
+        return existing
+
+    def shards(self) -> list[Shard]:
+        start, end, size = self.plan["start"], self.plan["end"], self.plan["shard_size"]
+        return [Shard(s, min(s + size, end)) for s in range(start, end, size)]
+
+    def segment_path(self, shard: Shard) -> Path:
+        return self.shard_dir / "segments" / f"{shard.name}.jsonl"
+
+    def _done_path(self, shard: Shard) -> Path:
+        return self.shard_dir / "segments" / f"{shard.name}.done"
+
+    def _lease_path(self, shard: Shard) -> Path:
+        return self.shard_dir / "leases" / f"{shard.name}.lease"
+
+    def is_done(self, shard: Shard) -> bool:
+        return self._done_path(shard).exists()
+
+    def all_done(self) -> bool:
+        return all(self.is_done(shard) for shard in self.shards())
+
+    @contextmanager
+    def _locked(self, shard: Shard) -> Iterator[None]:
+        fd = os.open(
+            self.shard_dir / "leases" / f"{shard.name}.lock",
+            os.O_RDWR | os.O_CREAT,
+            0o644,
+        )
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def _lease(self) -> dict:
+        return dict(worker=self.worker_id, expires=time.time() + self.lease_ttl)
+
+    def _try_create_lease(self, shard: Shard) -> bool:
+        try:
+            fd = os.open(
+                self._lease_path(shard), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644
+            )
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            json.dump(self._lease(), f)
+            f.flush()
+            os.fsync(f.fileno())
+        return True
+
+    def _break_stale_lease(self, shard: Shard) -> bool:
+        """删掉过期的租约，成功时返回 True。调用方持有分片的锁。"""
+        lease_path = self._lease_path(shard)
+        lease = _read_json(lease_path)
+        if lease is None or lease["expires"] > time.time():
+            return False
+        lease_path.unlink(missing_ok=True)
+        print(
+            f"[shard] Taking over {shard.name} from "
+            f"{lease['worker']} (lease expired)"
+        )
+        return True
+
+    def claim(self) -> Shard | None:
+        """认领下一个未完成且没有有效租约的分片，没有可认领的分片时返回 None。"""
+        for shard in self.shards():
+            if self.is_done(shard):
+                continue
+            if self._try_create_lease(shard):
+                return shard
+            with self._locked(shard):
+                if self._break_stale_lease(shard) and self._try_create_lease(shard):
+                    return shard
+        return None
+
+    def renew(self, shard: Shard) -> bool:
+        """续约；租约已经被别人接手时返回 False。"""
+        with self._locked(shard):
+            lease = _read_json(self._lease_path(shard))
+            if lease is None or lease["worker"] != self.worker_id:
+                return False
+            _write_json_atomic(self._lease_path(shard), self._lease())
+        return True
+
+    def release(self, shard: Shard):
+        with self._locked(shard):
+            lease = _read_json(self._lease_path(shard))
+            if lease is not None and lease["worker"] == self.worker_id:
+                self._lease_path(shard).unlink(missing_ok=True)
+
+    def complete(self, shard: Shard, **summary: Any):
+        """标记分片完成。调用前分片输出和日志必须已经落盘。"""
+        _write_json_atomic(
+            self._done_path(shard), dict(worker=self.worker_id, **summary)
+        )
+        self.release(shard)
+
+    @contextmanager
+    def hold(
+        self, shard: Shard, on_lost: Callable[[], None] | None = None
+    ) -> Iterator["LeaseKeeper"]:
+        """
+        在后台线程里每隔 `lease_ttl / 3` 秒续约一次，退出时释放租约。
+
+        Args:
+            on_lost (Callable[[], None] | None): 租约被接手时在续约线程里调用，
+                持有者应立即停止写入分片的输出、日志和死信队列。
+
+        """
+        keeper = LeaseKeeper(self, shard, on_lost)
+        keeper.start()
+        try:
+            yield keeper
+        finally:
+            keeper.stop()
+            self.release(shard)
+
+    def merge(self, output_path: str | Path) -> int:
+        """
+        按分片顺序合并所有分片输出，同一 (index, sub_index) 只保留第一条。返回写出的条数。
+        """
+        assert self.all_done(), "Not all shards are done"
+        output_path = Path(output_path)
+        tmp_path = output_path.with_name(f".{output_path.name}.{uuid.uuid4().hex}")
+        n_written = 0
+        with tmp_path.open("w") as f_out:
+            for shard in self.shards():
+                # 每个种子请求多个回复时，一个 index 有多条记录，以 sub_index 区分
+                records: dict[tuple[int, int], str] = {}
+                segment_path = self.segment_path(shard)
+                # 分片输出可能按大小切成了多个段（见 magicoder.output_writer）
+                for data in iter_records(segment_path):
+                    if (key := (data["index"], data.get("sub_index", 0))) in records:
+                        continue
+                    if "reasoning_ref" in data:
+                        # 推理过程的存储留在 segments/ 下，引用改为相对合并文件的路径
+                        data["reasoning_ref"]["file"] = os.path.relpath(
+                            segment_path.parent / data["reasoning_ref"]["file"],
+                            output_path.parent,
+                        )
+                    records[key] = json.dumps(data) + "\n"
+                for key in sorted(records):
+                    f_out.write(records[key])
+                n_written += len(records)
+            f_out.flush()
+            os.fsync(f_out.fileno())
+        os.replace(tmp_path, output_path)
+        return n_written
+
+    def status(self) -> dict[str, int]:
+        now = time.time()
+        counts = dict(done=0, leased=0, pending=0)
+        for shard in self.shards():
+            lease = _read_json(self._lease_path(shard))
+            if self.is_done(shard):
+                counts["done"] += 1
+            elif lease is not None and lease["expires"] > now:
+                counts["leased"] += 1
+            else:
+                counts["pending"] += 1
+        return counts
+
+
+@dataclass
+class LeaseKeeper:
+    coordinator: ShardCoordinator
+    shard: Shard
+    # 续约失败时在续约线程里调用，见 `ShardCoordinator.hold`
+    on_lost: Callable[[], None] | None = field(default=None)
+    # 续约失败（租约被接手）时置为 True，持有者应立即停止写入
+    lost: bool = field(default=False)
+
+    def __post_init__(self):
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.coordinator.lease_ttl / 3):
+            if not self.coordinator.renew(self.shard):
+                self.lost = True
+                print(f"[shard] Lost the lease on {self.shard.name}")
+                if self.on_lost is not None:
+                    self.on_lost()
+                return
+
+
+@dataclass(frozen=True)
+class Args:
+    shard_dir: str
+    output: str | None = field(
+        default=None,
+        metadata={"help": "Merge all shards into this file once they are done"},
+    )
+
+
+def main():
+    args, *_ = cast(
+        tuple[Args, ...], HfArgumentParser(Args).parse_args_into_dataclasses()
+    )
+    coordinator = ShardCoordinator(args.shard_dir)
+    print(coordinator.plan)
+    print(coordinator.status())
+    if args.output is not None:
+        n_written = coordinator.merge(args.output)
+        print(f"Merged {n_written} records into {args.output}")
+
+
+if __name__ == "__main__":
+    main()
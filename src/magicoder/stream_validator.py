@@ -0,0 +1,75 @@
+"""流式响应的增量校验
+
+`parse_problem_solution` 要求回复里先出现 `[Problem Description]`，再在后面的某一行出现
+`[Solution]`。流式生成时可以边收 chunk 边检查这两个标记，一旦回复已经不可能被解析
+（例如开头很长一段都没有问题标题，或者解答标题出现在问题标题之前），就立即中止请求，
+不必为注定要丢弃的回复付完全部 token。
+"""
+
+from dataclasses import dataclass, field
+
+from magicoder.rate_limit import CHARS_PER_TOKEN
+
+PROBLEM_MARKER = "[problem description]"
+SOLUTION_MARKER = "[solution]"
+
+
+class StreamAborted(Exception):
+    """回复已经不可能被解析，流被提前中止。由生成引擎立即重新派发。"""
+
+
+@dataclass
+class SectionValidator:
+    """按 chunk 检查回复中的段落标记，只看回复内容，不看 r1 模型的推理过程。
+
+    Args:
+        max_tokens_before_problem (int): 回复开头多少 token 内必须出现问题标题。
+        max_tokens_before_solution (int | None): 回复开头多少 token 内必须出现解答标题，
+            None 表示不限制。设为略小于 max_tokens 可以避免回复被截断（finish_reason=length）。
+    """
+
+    max_tokens_before_problem: int = 256
+    max_tokens_before_solution: int | None = None
+
+    text: str = field(init=False, default="")
+    problem_position: int | None = field(init=False, default=None)
+    solution_position: int | None = field(init=False, default=None)
+
+    def feed(self, delta: str) -> None:
+        """追加一段回复内容，回复不可能被解析时抛出 `StreamAborted`。"""
+        # 标记可能被切在两个 chunk 之间，从上次末尾往前回退一个标记的长度再查找
+        search_from = max(0, len(self.text) - len(PROBLEM_MARKER))
+        self.text += delta.lower()
+        if self.problem_position is None:
+            position = self.text.find(PROBLEM_MARKER, search_from)
+            if position >= 0:
+                self.problem_position = position
+        if self.solution_position is None:
+            position = self.text.find(SOLUTION_MARKER, search_from)
+            if position >= 0:
+                self.solution_position = position
+        self._check()
+
+    def _check(self) -> None:
+        n_tokens = len(self.text) / CHARS_PER_TOKEN
+        if self.solution_position is not None:
+            if (
+                self.problem_position is None
+                or self.problem_position > self.solution_position
+            ):
+                raise StreamAborted("Solution header before problem header")
+            # 两个标记在同一行时 parse_problem_solution 同样无法解析
+            if "\n" not in self.text[self.problem_position : self.solution_position]:
+                raise StreamAborted("Problem and solution headers on the same line")
+            return
+        if self.problem_position is None and n_tokens > self.max_tokens_before_problem:
+            raise StreamAborted(
+                f"No problem header within {self.max_tokens_before_problem} tokens"
+            )
+        if (
+            self.max_tokens_before_solution is not None
+            and n_tokens > self.max_tokens_before_solution
+        ):
+            raise StreamAborted(
+                f"No solution header within {self.max_tokens_before_solution} tokens"
+            )
@@ -0,0 +1,111 @@
+"""流式响应的卡死看门狗
+
+服务端在流的中途停住时，`async for chunk in response` 会一直等下去，一个卡住的连接就能让
+worker 停摆。看门狗给流式读取设置三个期限：
+
+- `first_token`：从发出请求到收到第一个 token（推理过程或回复内容）；
+- `inter_chunk`：收到第一个 token 之后，相邻两个 chunk 之间；
+- `total`：整个流的总时长。
+
+任一期限到期就取消读取、关闭连接，抛出带有原因和已收到部分输出的 `StreamStalled`。
+它被归为过载（与超时相同），生成引擎会降低并发、稍后重新派发这个种子。
+"""
+
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Awaitable, TypeVar
+
+T = TypeVar("T")
+
+
+class StreamStalled(Exception):
+    """流式响应超过期限没有进展，已被取消。
+
+    Args:
+        reason (str): 到期的期限，"first_token"、"inter_chunk" 或 "total"。
+        elapsed (float): 从开始读取到取消的秒数。
+        n_chunks (int): 已收到的 chunk 数。
+    """
+
+    def __init__(self, reason: str, elapsed: float, n_chunks: int):
+        self.reason = reason
+        self.elapsed = elapsed
+        self.n_chunks = n_chunks
+        # 由 `collect_stream` 填入已收到的部分输出
+        self.partial_content = ""
+        self.partial_reasoning = ""
+        super().__init__(reason, elapsed, n_chunks)
+
+    def __str__(self) -> str:
+        return (
+            f"Stream stalled ({self.reason} deadline) after {self.elapsed:.1f}s and "
+            f"{self.n_chunks} chunks, {len(self.partial_reasoning)} reasoning and "
+            f"{len(self.partial_content)} content characters received"
+        )
+
+
+@dataclass(frozen=True)
+class StreamDeadlines:
+    """各期限的秒数，None 表示不限制。"""
+
+    first_token: float | None = field(default=180.0)
+    inter_chunk: float | None = field(default=60.0)
+    total: float | None = field(default=1200.0)
+
+
+class StreamWatchdog:
+    def __init__(self, deadlines: StreamDeadlines):
+        self.deadlines = deadlines
+        self.started = time.monotonic()
+        self.first_token: float | None = None
+        self.last_chunk = self.started
+        self.n_chunks = 0
+
+    def mark_first_token(self) -> None:
+        if self.first_token is None:
+            self.first_token = time.monotonic()
+
+    def _next_deadline(self) -> tuple[float | None, str]:
+        """最早到期的期限（绝对时间）和它的名字。"""
+        candidates: list[tuple[float, str]] = []
+        if self.deadlines.total is not None:
+            candidates.append((self.started + self.deadlines.total, "total"))
+        if self.first_token is None:
+            if self.deadlines.first_token is not None:
+                candidates.append(
+                    (self.started + self.deadlines.first_token, "first_token")
+                )
+        elif self.deadlines.inter_chunk is not None:
+            candidates.append(
+                (self.last_chunk + self.deadlines.inter_chunk, "inter_chunk")
+            )
+        if len(candidates) == 0:
+            return None, ""
+        return min(candidates)
+
+    async def _wait(self, awaitable: Awaitable[T]) -> T:
+        deadline, reason = self._next_deadline()
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        try:
+            return await asyncio.wait_for(awaitable, timeout)
+        except asyncio.TimeoutError:
+            raise StreamStalled(
+                reason, time.monotonic() - self.started, self.n_chunks
+            ) from None
+
+    async def start(self, request: Awaitable[T]) -> T:
+        """等待流式请求返回响应头，同样受首 token 和总时长期限的约束。"""
+        return await self._wait(request)
+
+    async def iterate(self, response: Any) -> AsyncIterator[Any]:
+        """逐个转发 chunk，期限到期时抛出 `StreamStalled`（由调用方关闭流）。"""
+        iterator = response.__aiter__()
+        while True:
+            try:
+                chunk = await self._wait(iterator.__anext__())
+            except StopAsyncIteration:
+                return
+            self.last_chunk = time.monotonic()
+            self.n_chunks += 1
+            yield chunk
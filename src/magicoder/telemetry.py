@@ -0,0 +1,357 @@
+"""逐请求的遥测数据和指标导出
+
+每次请求（每次尝试）记录一条 `RequestMetrics`：排队等待、首 token 延迟（TTFT）、总延迟、
+prompt / completion / reasoning token 数、finish_reason、重试次数和解析结果。
+
+- 指标流：每条记录追加一行 JSON 到 `metrics_file`，便于事后用 pandas 分析。
+- Prometheus：定期把累计指标以文本格式原子地写入 `prometheus_file`，
+  可以交给 node_exporter 的 textfile collector 采集。
+- 运行结束时 `summary()` 给出 p50/p95/p99、tokens/s 和每 1k token 的产出条数。
+
+延迟类指标保存在固定大小的蓄水池样本里（总和与计数仍然精确），长时间运行时内存和每次导出
+排序的开销都不随请求数增长。
+
+请求路径上的各层（生成引擎、路由器、流式聚合、生成函数）通过 `contextvars` 找到当前请求的
+记录并填写各自知道的字段，不需要层层传参。每个 asyncio task 有独立的上下文，互不干扰。
+"""
+
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any
+
+from magicoder.concurrency import percentile
+
+QUANTILES = (50, 95, 99)
+RESERVOIR_SIZE = 4096
+
+
+class Reservoir:
+    """均匀蓄水池抽样（Algorithm R），用于估计分位数；总和与计数是精确的。"""
+
+    def __init__(self, size: int = RESERVOIR_SIZE, seed: int = 0):
+        self.size = size
+        self.samples: list[float] = []
+        self.count = 0
+        self.sum = 0.0
+        self._rng = random.Random(seed)
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        if len(self.samples) < self.size:
+            self.samples.append(value)
+        elif (slot := self._rng.randrange(self.count)) < self.size:
+            self.samples[slot] = value
+
+    def __len__(self) -> int:
+        return self.count
+
+
+@dataclass
+class RequestMetrics:
+    index: int | None = None
+    attempt: int = 1
+    endpoint: str | None = None
+    # 等待并发配额的秒数
+    queue_wait: float | None = None
+    # 从发出请求到收到第一个 token（含推理过程）的秒数，仅流式请求有
+    ttft: float | None = None
+    latency: float | None = None
+    prompt_tokens: int | None = None
+    completion_tokens: int | None = None
+    reasoning_tokens: int | None = None
+    # 命中服务商前缀缓存的 prompt token 数，见 magicoder.prompt_layout
+    cached_tokens: int | None = None
+    finish_reason: str | None = None
+    # 请求函数内部（退避装饰器）的重试次数；引擎层面的重试体现在 attempt 上
+    retries: int = 0
+    # 是否发出了对冲请求，以及哪一份先成功（primary / hedge），见 magicoder.hedging
+    hedged: bool = False
+    hedge_winner: str | None = None
+    # 流式响应卡住时到期的期限（first_token / inter_chunk / total），见 magicoder.stream_watchdog
+    stalled: str | None = None
+    # ok / incomplete / unparseable / empty，请求失败时为 None
+    parse_outcome: str | None = None
+    # 每个种子请求多个回复时，回复中的 choice 数和去重后可用的条数
+    n_choices: int | None = None
+    n_distinct_choices: int | None = None
+    # success / overload / failure / aborted，见 magicoder.concurrency.Outcome
+    outcome: str | None = None
+    error: str | None = None
+    timestamp: float = field(default_factory=time.time)
+    started: float = field(default_factory=time.monotonic, repr=False)
+
+    def update(self, **fields: Any) -> None:
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+    def to_dict(self) -> dict:
+        data = asdict(self)
+        data.pop("started")
+        return data
+
+
+_CURRENT: contextvars.ContextVar[RequestMetrics | None] = contextvars.ContextVar(
+    "magicoder_request_metrics", default=None
+)
+
+
+def current() -> RequestMetrics | None:
+    return _CURRENT.get()
+
+
+def start_request(
+    index: int | None = None, attempt: int = 1, queue_wait: float | None = None
+) -> RequestMetrics:
+    """开始记录一次请求，之后同一上下文里的 `observe*` 都会写到这条记录上。"""
+    metrics = RequestMetrics(index=index, attempt=attempt, queue_wait=queue_wait)
+    _CURRENT.set(metrics)
+    return metrics
+
+
+def observe(**fields: Any) -> None:
+    """填写当前请求的字段，不在请求上下文中时什么也不做。"""
+    if (metrics := current()) is not None:
+        metrics.update(**fields)
+
+
+def observe_first_token() -> None:
+    if (metrics := current()) is not None and metrics.ttft is None:
+        metrics.ttft = time.monotonic() - metrics.started
+
+
+def observe_retry() -> None:
+    if (metrics := current()) is not None:
+        metrics.retries += 1
+
+
+def _get(obj: Any, key: str) -> Any:
+    if obj is None:
+        return None
+    if isinstance(obj, dict):
+        return obj.get(key)
+    return getattr(obj, key, None)
+
+
+def usage_fields(usage: Any) -> dict[str, int | None]:
+    """从 usage（字典或 SDK 对象）中读取 token 数。"""
+    return dict(
+        prompt_tokens=_get(usage, "prompt_tokens"),
+        completion_tokens=_get(usage, "completion_tokens"),
+        reasoning_tokens=_get(
+            _get(usage, "completion_tokens_details"), "reasoning_tokens"
+        ),
+        # DeepSeek 返回 prompt_cache_hit_tokens，OpenAI 返回 prompt_tokens_details.cached_tokens
+        cached_tokens=_get(usage, "prompt_cache_hit_tokens")
+        or _get(_get(usage, "prompt_tokens_details"), "cached_tokens"),
+    )
+
+
+def observe_usage(usage: Any) -> None:
+    if usage is not None:
+        observe(**usage_fields(usage))
+
+
+def finish_request(
+    metrics: RequestMetrics, outcome: str, error: str | None = None
+) -> None:
+    """结束一次请求并交给共享的 `Telemetry` 记录。"""
+    if metrics.latency is None:
+        metrics.latency = time.monotonic() - metrics.started
+    metrics.outcome = outcome
+    metrics.error = error
+    if (telemetry := get_telemetry()) is not None:
+        telemetry.record(metrics)
+
+
+class Telemetry:
+    """
+    Args:
+        metrics_file (str | Path | None): 逐请求的 JSONL 指标流。
+        prometheus_file (str | Path | None): Prometheus 文本格式的指标文件。
+        export_interval (float): 重写 Prometheus 文件的最小间隔（秒）。
+    """
+
+    def __init__(
+        self,
+        metrics_file: str | Path | None = None,
+        prometheus_file: str | Path | None = None,
+        export_interval: float = 15.0,
+    ):
+        self.prometheus_file = (
+            None if prometheus_file is None else Path(prometheus_file)
+        )
+        self.export_interval = export_interval
+        self._file = None if metrics_file is None else open(metrics_file, "a")
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._last_export = 0.0
+        self._last_flush = 0.0
+        self.outcomes: Counter[tuple[str, str]] = Counter()
+        self.parse_outcomes: Counter[str] = Counter()
+        self.tokens: Counter[str] = Counter()
+        self.latencies = Reservoir()
+        self.ttfts = Reservoir()
+        self.queue_waits = Reservoir()
+        self.hedges: Counter[str] = Counter()
+        self.n_records = 0
+
+    def record(self, metrics: RequestMetrics) -> None:
+        with self._lock:
+            self.outcomes[(metrics.endpoint or "", metrics.outcome or "")] += 1
+            if metrics.parse_outcome is not None:
+                self.parse_outcomes[metrics.parse_outcome] += 1
+            if metrics.parse_outcome == "ok":
+                self.n_records += 1
+            for kind in ("prompt", "completion", "reasoning", "cached"):
+                if (n_tokens := getattr(metrics, f"{kind}_tokens")) is not None:
+                    self.tokens[kind] += n_tokens
+            if metrics.latency is not None:
+                self.latencies.add(metrics.latency)
+            if metrics.ttft is not None:
+                self.ttfts.add(metrics.ttft)
+            if metrics.queue_wait is not None:
+                self.queue_waits.add(metrics.queue_wait)
+            if metrics.hedged:
+                self.hedges[metrics.hedge_winner or "none"] += 1
+            now = time.time()
+            if self._file is not None:
+                self._file.write(json.dumps(metrics.to_dict()) + "\n")
+                if now - self._last_flush >= 1.0:
+                    self._file.flush()
+                    self._last_flush = now
+            if (
+                self.prometheus_file is not None
+                and now - self._last_export >= self.export_interval
+            ):
+                self._export()
+                self._last_export = now
+
+    @staticmethod
+    def _quantiles(values: Reservoir) -> dict[str, float | None]:
+        return {
+            f"p{q}": (
+                round(percentile(values.samples, q), 3) if len(values) > 0 else None
+            )
+            for q in QUANTILES
+        }
+
+    def summary(self) -> dict[str, Any]:
+        with self._lock:
+            elapsed = max(time.time() - self._start, 1e-9)
+            total_tokens = self.tokens["prompt"] + self.tokens["completion"]
+            outcomes: Counter[str] = Counter()
+            for (_, outcome), count in self.outcomes.items():
+                outcomes[outcome] += count
+            return dict(
+                requests=sum(outcomes.values()),
+                outcomes=dict(outcomes),
+                parse_outcomes=dict(self.parse_outcomes),
+                latency=self._quantiles(self.latencies),
+                ttft=self._quantiles(self.ttfts),
+                queue_wait=self._quantiles(self.queue_waits),
+                tokens=dict(self.tokens),
+                hedges=dict(self.hedges),
+                completion_tokens_per_second=round(
+                    self.tokens["completion"] / elapsed, 1
+                ),
+                prompt_cache_hit_rate=(
+                    round(self.tokens["cached"] / self.tokens["prompt"], 3)
+                    if self.tokens["prompt"] > 0
+                    else None
+                ),
+                records_per_1k_tokens=(
+                    round(1000 * self.n_records / total_tokens, 3)
+                    if total_tokens > 0
+                    else None
+                ),
+            )
+
+    def _prometheus_text(self) -> str:
+        lines: list[str] = []
+
+        def metric(name: str, kind: str, help: str):
+            lines.append(f"# HELP magicoder_{name} {help}")
+            lines.append(f"# TYPE magicoder_{name} {kind}")
+
+        metric("requests_total", "counter", "Requests by endpoint and outcome.")
+        for (endpoint, outcome), count in sorted(self.outcomes.items()):
+            lines.append(
+                f'magicoder_requests_total{{endpoint="{endpoint}",'
+                f'outcome="{outcome}"}} {count}'
+            )
+        metric("parse_outcomes_total", "counter", "Parse outcomes of responses.")
+        for outcome, count in sorted(self.parse_outcomes.items()):
+            lines.append(
+                f'magicoder_parse_outcomes_total{{outcome="{outcome}"}} {count}'
+            )
+        metric("hedges_total", "counter", "Hedged requests by winning copy.")
+        for winner, count in sorted(self.hedges.items()):
+            lines.append(f'magicoder_hedges_total{{winner="{winner}"}} {count}')
+        metric("tokens_total", "counter", "Tokens reported by the API.")
+        for kind, count in sorted(self.tokens.items()):
+            lines.append(f'magicoder_tokens_total{{kind="{kind}"}} {count}')
+        for name, values, help in (
+            ("request_latency_seconds", self.latencies, "Total request latency."),
+            ("ttft_seconds", self.ttfts, "Time to first streamed token."),
+            ("queue_wait_seconds", self.queue_waits, "Wait for a concurrency slot."),
+        ):
+            metric(name, "summary", help)
+            for q in QUANTILES:
+                if len(values) > 0:
+                    lines.append(
+                        f'magicoder_{name}{{quantile="{q / 100}"}} '
+                        f"{percentile(values.samples, q)}"
+                    )
+            lines.append(f"magicoder_{name}_sum {values.sum}")
+            lines.append(f"magicoder_{name}_count {values.count}")
+        return "\n".join(lines) + "\n"
+
+    def _export(self) -> None:
+        assert self.prometheus_file is not None
+        # 先写临时文件再重命名，采集方不会读到写了一半的文件
+        tmp_path = self.prometheus_file.with_name(f".{self.prometheus_file.name}.tmp")
+        tmp_path.write_text(self._prometheus_text())
+        os.replace(tmp_path, self.prometheus_file)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if self.prometheus_file is not None:
+                self._export()
+
+
+_TELEMETRY: Telemetry | None = None
+_CONFIGURED = False
+
+
+def configure(
+    metrics_file: str | Path | None = None,
+    prometheus_file: str | Path | None = None,
+) -> Telemetry:
+    """设置进程内共享的遥测。即使不写文件也会在内存中汇总，用于运行结束时的摘要。"""
+    global _TELEMETRY, _CONFIGURED
+    _CONFIGURED = True
+    _TELEMETRY = Telemetry(metrics_file, prometheus_file)
+    return _TELEMETRY
+
+
+def get_telemetry() -> Telemetry | None:
+    """返回共享的遥测。未调用 `configure` 时从环境变量 `MAGICODER_METRICS`
+    和 `MAGICODER_PROMETHEUS_FILE` 读取文件路径，两者都没有设置时不记录。"""
+    if not _CONFIGURED:
+        metrics_file = os.getenv("MAGICODER_METRICS")
+        prometheus_file = os.getenv("MAGICODER_PROMETHEUS_FILE")
+        if metrics_file is None and prometheus_file is None:
+            return None
+        configure(metrics_file, prometheus_file)
+    return _TELEMETRY
@@ -0,0 +1,119 @@
+"""带缓存的分词器注册表和批量 token 计数
+
+同一个名字只加载一次编码器，进程内共享。名字可以是 tiktoken 的编码名（如 "cl100k_base"）、
+OpenAI 模型名、API 侧的模型名（如 "deepseek-r1"，映射到对应的 HF 分词器），
+或者任意 HF 分词器路径（如 "codellama/CodeLlama-7b-Python-hf"）。
+
+批量接口走 tiktoken 的多线程编码或 HF fast tokenizer 的 Rust 批处理，
+统计几百万条文本的长度时应优先使用 `count_batch`。
+"""
+
+import functools
+import os
+from typing import Protocol, Sequence
+
+import tiktoken
+
+FALLBACK_ENCODING = "cl100k_base"
+BATCH_THREADS = min(8, os.cpu_count() or 1)
+
+# API 侧的模型名 -> HF 分词器。同一系列的模型共用分词器，只需要加载一个。
+HF_TOKENIZER_ALIASES = {
+    "deepseek-r1": "deepseek-ai/DeepSeek-R1",
+    "deepseek-v3": "deepseek-ai/DeepSeek-V3",
+    "deepseek-coder": "deepseek-ai/deepseek-coder-6.7b-base",
+    "codellama": "codellama/CodeLlama-7b-Python-hf",
+}
+
+
+class TokenCounter(Protocol):
+    name: str
+
+    def count(self, text: str) -> int:
+        ...
+
+    def count_batch(self, texts: Sequence[str]) -> list[int]:
+        ...
+
+
+class TiktokenCounter:
+    def __init__(self, encoding: tiktoken.Encoding):
+        self.name = encoding.name
+        self.encoding = encoding
+
+    def count(self, text: str) -> int:
+        # encode_ordinary 不检查特殊 token，种子代码里出现 "<|endoftext|>" 也不会报错
+        return len(self.encoding.encode_ordinary(text))
+
+    def count_batch(self, texts: Sequence[str]) -> list[int]:
+        encoded = self.encoding.encode_ordinary_batch(
+            list(texts), num_threads=BATCH_THREADS
+        )
+        return [len(tokens) for tokens in encoded]
+
+
+class HFTokenizerCounter:
+    def __init__(self, name_or_path: str):
+        # 只有用到 HF 分词器时才导入 transformers，OpenAI 接口的生成不需要它
+        from transformers import AutoTokenizer
+
+        self.name = name_or_path
+        self.tokenizer = AutoTokenizer.from_pretrained(name_or_path, use_fast=True)
+
+    def count(self, text: str) -> int:
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def count_batch(self, texts: Sequence[str]) -> list[int]:
+        input_ids = self.tokenizer(
+            list(texts), add_special_tokens=False, return_attention_mask=False
+        )["input_ids"]
+        return [len(ids) for ids in input_ids]
+
+
+def _hf_tokenizer_name(name: str) -> str | None:
+    lowered = name.lower()
+    for prefix, tokenizer_name in HF_TOKENIZER_ALIASES.items():
+        if lowered.startswith(prefix):
+            return tokenizer_name
+    if "/" in name:
+        return name
+    return None
+
+
+@functools.cache
+def get_token_counter(name: str) -> TokenCounter:
+    """
+    按名字获取（并缓存）token 计数器。
+
+    Args:
+        name (str): tiktoken 编码名、模型名或 HF 分词器路径。
+
+    Returns:
+        TokenCounter: 无法加载对应的分词器（例如离线环境）时退回 cl100k_base。
+
+    """
+    if name in tiktoken.list_encoding_names():
+        return TiktokenCounter(tiktoken.get_encoding(name))
+    if (hf_name := _hf_tokenizer_name(name)) is not None:
+        try:
+            return HFTokenizerCounter(hf_name)
+        except Exception as e:
+            print(
+                f"Warning: failed to load tokenizer {hf_name} ({type(e).__name__}). "
+                f"Using '{FALLBACK_ENCODING}' as fallback."
+            )
+            return get_token_counter(FALLBACK_ENCODING)
+    try:
+        return TiktokenCounter(tiktoken.encoding_for_model(name))
+    except KeyError:
+        print(
+            f"Warning: Model {name} not found in tiktoken registry. "
+            f"Using '{FALLBACK_ENCODING}' as fallback."
+        )
+        return get_token_counter(FALLBACK_ENCODING)
+
+
+def count_message_tokens(messages: Sequence[dict], name: str) -> int:
+    """对话消息中所有 content 的 token 数之和，不含对话标记（由调用方留出误差裕量）。"""
+    counter = get_token_counter(name)
+    return sum(counter.count_batch([message["content"] for message in messages]))
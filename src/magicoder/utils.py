@@ -1,5 +1,8 @@
+import asyncio
+import fcntl
 import functools
 import hashlib
+import inspect
 import json
 import os
 import random
@@ -8,7 +11,11 @@ from pathlib import Path
 from typing import Any, Iterable, Mapping, Sequence, TypeVar
 
 import openai
-import tiktoken
+from openai.types import Completion
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+from magicoder import chat, rate_limit, response_cache, telemetry, token_counter
+from magicoder.concurrency import Outcome, classify_error
 
 N_CORES = 1 if (count := os.cpu_count()) is None or count == 0 else count // 2
 
@@ -73,6 +80,29 @@ def retry_with_exponential_backoff(
     """Retry a function with exponential backoff."""
 
     def decorator(func):
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                # 与同步版本相同的策略，只是用 asyncio.sleep 避免阻塞事件循环
+                num_retries = 0
+                delay = initial_delay
+                while True:
+                    try:
+                        return await func(*args, **kwargs)
+                    except errors as e:
+                        print(f"Error: {e}. Retrying in {delay} seconds...")
+                        telemetry.observe_retry()
+                        num_retries += 1
+                        if num_retries > max_retries:
+                            raise Exception(
+                                f"Maximum number of retries ({max_retries}) exceeded."
+                            )
+                        delay *= exponential_base * (1 + jitter * random.random())
+                        await asyncio.sleep(delay)
+
+            return async_wrapper
+
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
             # 初始化变量
@@ -86,6 +116,7 @@ def retry_with_exponential_backoff(
                 # 对特定错误进行重试
                 except errors as e:
                     print(f"Error: {e}. Retrying in {delay} seconds...")
+                    telemetry.observe_retry()
                     # 增加重试次数
                     num_retries += 1
                     # 检查是否已达到最大重试次数
@@ -114,53 +145,294 @@ ERRORS = (
     openai.InternalServerError,
 )
 
+# 连接 10 秒；读取（非流式为整个响应，流式为两次读取之间）10 分钟，卡住的连接不会无限期等待
+OPENAI_TIMEOUT = openai.Timeout(600.0, connect=10.0)
+
 try:
     OPENAI_CLIENT: openai.OpenAI | None = openai.OpenAI(
         api_key=os.getenv("OPENAI_API_KEY"), 
         base_url=os.getenv(key="OPENAI_BASE_URL"),
+        timeout=OPENAI_TIMEOUT,
     )
 except openai.OpenAIError:
     OPENAI_CLIENT = None
 
+try:
+    # 并发生成使用的异步客户端，配置与 OPENAI_CLIENT 相同
+    OPENAI_ASYNC_CLIENT: openai.AsyncOpenAI | None = openai.AsyncOpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        base_url=os.getenv(key="OPENAI_BASE_URL"),
+        timeout=OPENAI_TIMEOUT,
+    )
+except openai.OpenAIError:
+    OPENAI_ASYNC_CLIENT = None
+
+
+def _settle_stream(stream, reservation: rate_limit.Reservation):
+    """逐个转发 chunk，在带 usage 的 chunk（通常是最后一个）到达时结算额度。"""
+    try:
+        for chunk in stream:
+            if getattr(chunk, "usage", None) is not None:
+                reservation.settle(chunk.usage)
+            yield chunk
+    finally:
+        reservation.settle(None)
+
+
+async def _async_settle_stream(stream, reservation: rate_limit.Reservation):
+    try:
+        async for chunk in stream:
+            if getattr(chunk, "usage", None) is not None:
+                await reservation.async_settle(chunk.usage)
+            yield chunk
+    finally:
+        await reservation.async_settle(None)
+        # 调用方提前关闭时（见 magicoder.stream_validator）一并关闭底层连接
+        await chat.close_stream(stream)
+
 
 @retry_with_exponential_backoff(ERRORS)
+def _create_chat_completion(*args, **kwargs):
+    assert OPENAI_CLIENT is not None
+    reservation = rate_limit.reserve(
+        kwargs["messages"], kwargs.get("max_tokens"), n=kwargs.get("n")
+    )
+    try:
+        response = OPENAI_CLIENT.chat.completions.create(*args, **kwargs)
+    except Exception:
+        if reservation is not None:
+            reservation.cancel()
+        raise
+    if reservation is None:
+        return response
+    if kwargs.get("stream"):
+        return _settle_stream(response, reservation)
+    reservation.settle(response.usage)
+    return response
+
+
+async def _async_create_chat_completion(
+    *args,
+    client: openai.AsyncOpenAI | None = None,
+    limiter: rate_limit.RateLimiter | None = None,
+    **kwargs,
+):
+    if client is None:
+        client = OPENAI_ASYNC_CLIENT
+    assert client is not None
+    reservation = await rate_limit.async_reserve(
+        kwargs["messages"], kwargs.get("max_tokens"), limiter, n=kwargs.get("n")
+    )
+    try:
+        response = await client.chat.completions.create(*args, **kwargs)
+    except Exception:
+        if reservation is not None:
+            await reservation.async_cancel()
+        raise
+    if reservation is None:
+        return response
+    if kwargs.get("stream"):
+        return _async_settle_stream(response, reservation)
+    await reservation.async_settle(response.usage)
+    return response
+
+
+_async_create_chat_completion_with_backoff = retry_with_exponential_backoff(ERRORS)(
+    _async_create_chat_completion
+)
+
+
+@retry_with_exponential_backoff(ERRORS)
+def _create_completion(*args, **kwargs):
+    assert OPENAI_CLIENT is not None
+    return OPENAI_CLIENT.completions.create(*args, **kwargs)
+
+
+def _record_stream(stream, cache: response_cache.ResponseCache, key: str):
+    """转发 chunk，流完整结束后再写入缓存，中途失败的流不会被缓存。"""
+    chunks: list[dict] = []
+    for chunk in stream:
+        chunks.append(chunk.model_dump())
+        yield chunk
+    cache.put(key, chunks)
+
+
+async def _async_record_stream(stream, cache: response_cache.ResponseCache, key: str):
+    chunks: list[dict] = []
+    try:
+        async for chunk in stream:
+            chunks.append(chunk.model_dump())
+            yield chunk
+    finally:
+        await chat.close_stream(stream)
+    cache.put(key, chunks)
+
+
+async def _async_replay_stream(chunks: list):
+    for chunk in chunks:
+        yield chunk
+
+
 def chat_completions_with_backoff(*args, **kwargs):
     """
     使用回退机制进行聊天补全请求。
-    
+
+    如果配置了响应缓存（见 `magicoder.response_cache`），命中时直接回放缓存的响应。
+    配置了遥测（见 `magicoder.telemetry`）时记录每次调用的延迟、token 数和重试次数。
+
     Args:
         *args: 可变参数列表，用于传递给 OPENAI_CLIENT.chat.completions.create 的位置参数。
         **kwargs: 关键字参数，用于传递给 OPENAI_CLIENT.chat.completions.create 的关键字参数。
-    
+
     Returns:
         返回 OPENAI_CLIENT.chat.completions.create 的结果。
-    
+
     Raises:
         AssertionError: 如果 OPENAI_CLIENT 未被初始化。
-    
+
     """
-    assert OPENAI_CLIENT is not None
-    return OPENAI_CLIENT.chat.completions.create(*args, **kwargs)
+    metrics = telemetry.start_request()
+    try:
+        response = _cached_chat_completion(*args, **kwargs)
+    except Exception as e:
+        reason = f"{type(e).__name__}: {e}"
+        telemetry.finish_request(metrics, classify_error(e).value, reason[:500])
+        raise
+    if kwargs.get("stream"):
+        return _observe_stream(response, metrics)
+    metrics.finish_reason = response.choices[0].finish_reason
+    if response.usage is not None:
+        metrics.update(**telemetry.usage_fields(response.usage))
+    telemetry.finish_request(metrics, Outcome.SUCCESS.value)
+    return response
+
+
+def _observe_stream(stream, metrics: telemetry.RequestMetrics):
+    """
+    转发 chunk，同时记录首 token 延迟、usage 和 finish_reason，流结束时提交记录。
+
+    中途出错或被调用方提前关闭（流式校验、卡住检测中止或取消）的流同样提交，分别记为错误的
+    类别和 aborted，这些正是遥测最需要看到的请求。
+    """
+    outcome, reason = Outcome.ABORTED, "stream closed before the end"
+    try:
+        for chunk in stream:
+            if chunk.usage is not None:
+                metrics.update(**telemetry.usage_fields(chunk.usage))
+            if len(chunk.choices) > 0:
+                if metrics.ttft is None:
+                    metrics.ttft = time.monotonic() - metrics.started
+                if chunk.choices[0].finish_reason:
+                    metrics.finish_reason = chunk.choices[0].finish_reason
+            yield chunk
+        outcome, reason = Outcome.SUCCESS, None
+    except Exception as e:
+        outcome, reason = classify_error(e), f"{type(e).__name__}: {e}"[:500]
+        raise
+    finally:
+        telemetry.finish_request(metrics, outcome.value, reason)
+
+
+def _cached_chat_completion(*args, **kwargs):
+    cache = response_cache.get_response_cache()
+    if cache is None:
+        return _create_chat_completion(*args, **kwargs)
+    key = response_cache.request_key(kwargs)
+    if (cached := cache.get(key)) is not None:
+        if kwargs.get("stream"):
+            return iter(map(ChatCompletionChunk.model_validate, cached))
+        return ChatCompletion.model_validate(cached)
+    response = _create_chat_completion(*args, **kwargs)
+    if kwargs.get("stream"):
+        return _record_stream(response, cache, key)
+    cache.put(key, response.model_dump())
+    return response
+
+
+async def _async_cached_chat_completion(
+    create, *args, client=None, limiter=None, **kwargs
+):
+    cache = response_cache.get_response_cache()
+    if cache is None:
+        return await create(*args, client=client, limiter=limiter, **kwargs)
+    key = response_cache.request_key(kwargs)
+    if (cached := cache.get(key)) is not None:
+        if kwargs.get("stream"):
+            chunks = list(map(ChatCompletionChunk.model_validate, cached))
+            return _async_replay_stream(chunks)
+        return ChatCompletion.model_validate(cached)
+    response = await create(*args, client=client, limiter=limiter, **kwargs)
+    if kwargs.get("stream"):
+        return _async_record_stream(response, cache, key)
+    cache.put(key, response.model_dump())
+    return response
+
+
+async def async_chat_completions_with_backoff(*args, **kwargs):
+    """`chat_completions_with_backoff` 的异步版本。"""
+    return await _async_cached_chat_completion(
+        _async_create_chat_completion_with_backoff, *args, **kwargs
+    )
+
+
+async def async_chat_completions(
+    *args,
+    client: openai.AsyncOpenAI | None = None,
+    limiter: rate_limit.RateLimiter | None = None,
+    **kwargs,
+):
+    """不带重试的异步版本，供并发生成引擎使用。
+
+    引擎根据 429 / 5xx 通过 AIMD 控制器降低并发并重新派发请求，
+    这里再做固定的指数退避只会让控制器看不到过载信号。
+
+    Args:
+        client: 使用的客户端，默认为 OPENAI_ASYNC_CLIENT。
+        limiter: 使用的限流器，默认为共享限流器。
+    """
+    return await _async_cached_chat_completion(
+        _async_create_chat_completion, *args, client=client, limiter=limiter, **kwargs
+    )
 
 
-@retry_with_exponential_backoff(ERRORS)
 def completions_with_backoff(*args, **kwargs):
-    assert OPENAI_CLIENT is not None
-    return OPENAI_CLIENT.completions.create(*args, **kwargs)
+    cache = response_cache.get_response_cache()
+    if cache is None or kwargs.get("stream"):
+        return _create_completion(*args, **kwargs)
+    key = response_cache.request_key(kwargs, "prompt")
+    if (cached := cache.get(key)) is not None:
+        return Completion.model_validate(cached)
+    response = _create_completion(*args, **kwargs)
+    cache.put(key, response.model_dump())
+    return response
 
 
-# https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
 def num_tokens_from_string(string: str, model: str) -> int:
     """Returns the number of tokens in a text string."""
-    encoding = None
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        print(f"Warning: Model {model} not found in tiktoken registry. Using 'cl100k_base' as fallback.")
-        encoding = tiktoken.get_encoding("cl100k_base")  # 手动指定编码器
-    # encoding = tiktoken.get_encoding(encoding_name)
-    num_tokens = len(encoding.encode(string))
-    return num_tokens
+    # 编码器按模型名缓存在 token_counter 中，不再每次调用都重新查找
+    return token_counter.get_token_counter(model).count(string)
+
+
+def record_seed(seed_save_file: str, seed: int, start_index: int, end_index: int):
+    """
+    记录生成种子代码所用的随机种子。
+
+    同一个数据文件常被切成多个窗口分别运行，每次运行的 seed 都可能不同，所以按窗口分别记录，
+    并加文件锁防止并行的进程互相覆盖。顶层的 seed / start_index / end_index 保留最近一次运行的值，
+    与旧格式兼容。
+    """
+    with open(seed_save_file, "a+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        content = f.read()
+        data = json.loads(content) if content.strip() else {}
+        data["seed"] = seed
+        data["start_index"] = start_index
+        data["end_index"] = end_index
+        data.setdefault("windows", {})[f"{start_index}_{end_index}"] = seed
+        f.seek(0)
+        f.truncate()
+        json.dump(data, f, indent=4, ensure_ascii=False)
 
 
 def timestamp() -> str:
@@ -0,0 +1,102 @@
+import asyncio
+import json
+
+import openai
+import pytest
+
+from magicoder import batch_api
+from magicoder.batch_api import BatchJob
+from magicoder.mock_openai_server import Args, MockOpenAIServer
+
+FINGERPRINT = "3f2a-seed7"
+
+
+def make_requests(n: int) -> list[dict]:
+    body = dict(
+        model="mock-model",
+        messages=[dict(role="user", content="Write a problem.")],
+        max_tokens=256,
+    )
+    return [
+        batch_api.batch_request(batch_api.custom_id_for(FINGERPRINT, index), body)
+        for index in range(n)
+    ]
+
+
+def read_lines(job: BatchJob, batch: batch_api.BatchState) -> list[dict]:
+    with (job.directory / batch.file).open() as f:
+        return [json.loads(line) for line in f]
+
+
+def test_custom_id_round_trip():
+    # 指纹里可以有 "-"，index 取最后一段
+    custom_id = batch_api.custom_id_for(FINGERPRINT, 12)
+    assert batch_api.index_from_custom_id(custom_id, FINGERPRINT) == 12
+    with pytest.raises(AssertionError):
+        batch_api.index_from_custom_id(custom_id, "another-run")
+
+
+def test_prepare_splits_by_count_and_bytes(tmp_path):
+    job = BatchJob(tmp_path / "out.jsonl.batches", client=None)  # type: ignore[arg-type]
+    batches = job.prepare(make_requests(7), max_requests=3, max_bytes=1 << 20)
+    assert [batch.n_requests for batch in batches] == [3, 3, 1]
+    assert [
+        line["custom_id"] for batch in batches for line in read_lines(job, batch)
+    ] == [batch_api.custom_id_for(FINGERPRINT, index) for index in range(7)]
+    for batch in batches:
+        job.mark_ingested(batch)
+
+    # 下一轮按字节数切分，每个文件放得下两行
+    line_bytes = len((json.dumps(make_requests(1)[0]) + "\n").encode())
+    max_bytes = 2 * line_bytes + line_bytes // 2
+    batches = job.prepare(make_requests(5), max_requests=100, max_bytes=max_bytes)
+    assert [batch.n_requests for batch in batches] == [2, 2, 1]
+    assert all(batch.file.startswith("round-01-") for batch in batches)
+    assert all((job.directory / b.file).stat().st_size <= max_bytes for b in batches)
+    # 上一轮的结果还没导入时不能开始新一轮
+    with pytest.raises(AssertionError):
+        job.prepare(make_requests(1), max_requests=100, max_bytes=max_bytes)
+
+
+def test_resume_polls_without_resubmitting(tmp_path):
+    server = MockOpenAIServer(Args(port=0, seed=1, reasoning_repeats=1)).start()
+    directory = tmp_path / "out.jsonl.batches"
+
+    def client() -> openai.AsyncOpenAI:
+        return openai.AsyncOpenAI(
+            base_url=f"{server.url}/v1", api_key="mock", max_retries=0
+        )
+
+    async def submit():
+        job = BatchJob(directory, client())
+        job.prepare(make_requests(5), max_requests=2, max_bytes=1 << 20)
+        await job.submit()
+        await job.client.close()
+
+    async def resume() -> list[int]:
+        # 进程中断后重新打开：从 state.json 读出已提交的批次，只轮询不重复提交
+        job = BatchJob(directory, client())
+        assert all(batch.batch_id is not None for batch in job.pending())
+        await job.submit()
+        while not await job.refresh():
+            await asyncio.sleep(0.01)
+        indices: list[int] = []
+        for batch in job.pending():
+            async for line in job.results(batch):
+                indices.append(
+                    batch_api.index_from_custom_id(line["custom_id"], FINGERPRINT)
+                )
+            job.mark_ingested(batch)
+        await job.client.close()
+        return indices
+
+    try:
+        asyncio.run(submit())
+        assert len(server.batches) == 3 and len(server.files) == 3
+        indices = asyncio.run(resume())
+    finally:
+        server.shutdown()
+    # 续跑没有再上传或提交，新增的只有 3 个批次的结果文件
+    assert len(server.batches) == 3 and len(server.files) == 6
+    assert sorted(indices) == list(range(5))
+    assert BatchJob(directory, client=None).pending() == []  # type: ignore[arg-type]
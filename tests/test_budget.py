@@ -0,0 +1,33 @@
+from magicoder.budget import Pricing, RunBudget
+from magicoder.telemetry import RequestMetrics, usage_fields
+
+USAGE = dict(
+    prompt_tokens=1000,
+    completion_tokens=3000,
+    completion_tokens_details=dict(reasoning_tokens=2000),
+    prompt_cache_hit_tokens=400,
+)
+
+
+def test_record_counts_tokens_and_pairs():
+    budget = RunBudget(Pricing(prompt=1.0, completion=2.0), max_tokens=10000)
+    # 本地生成和批处理按 usage 补的记录，与引擎的记录走同一个入口
+    budget.record(RequestMetrics(index=0, **usage_fields(USAGE), parse_outcome="ok"))
+    budget.record(
+        RequestMetrics(
+            index=1,
+            **usage_fields(USAGE),
+            parse_outcome="ok",
+            n_distinct_choices=3,
+        )
+    )
+    assert budget.exhausted() is None
+    budget.record(RequestMetrics(index=2, **usage_fields(USAGE)))
+    assert budget.n_requests == 3
+    assert budget.n_usable_seeds == 2
+    assert budget.n_pairs == 4
+    assert budget.reasoning_tokens == 6000
+    assert budget.cached_tokens == 1200
+    assert budget.total_tokens == 12000
+    assert budget.cost == (3000 + 9000 * 2.0) / 1e6
+    assert budget.exhausted() is not None
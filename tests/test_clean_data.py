@@ -0,0 +1,44 @@
+import pytest
+
+pytest.importorskip("transformers")
+
+from magicoder.clean_data import filter_same_seed_problem_solution
+
+
+def record(index: int, seed: str, problem: str, solution: str, **extra) -> dict:
+    return dict(index=index, seed=seed, problem=problem, solution=solution, **extra)
+
+
+def test_keeps_distinct_completions_of_one_seed():
+    raw_data = [
+        record(0, "def f():\n    pass", f"problem {i}", f"solution {i}", sub_index=i)
+        for i in range(3)
+    ]
+    chosen, rejected = filter_same_seed_problem_solution(raw_data)
+    assert [d["sub_index"] for d in chosen] == [0, 1, 2]
+    assert rejected == []
+
+
+def test_rejects_duplicates_across_seeds_and_choices():
+    raw_data = [
+        record(0, "seed a", "problem 0", "solution 0", sub_index=0),
+        # 同一个种子请求的另一个回复，但问题与第一个回复相同（忽略空白）
+        record(0, "seed a", "problem  0", "solution 1", sub_index=1),
+        record(0, "seed a", "problem 2", "solution 2", sub_index=2),
+        # 另一个种子请求用了相同的种子
+        record(1, "seed  a", "problem 3", "solution 3", sub_index=0),
+        # 没有 sub_index 的旧数据保持原来的行为
+        record(2, "seed b", "problem 4", "solution 4"),
+        record(2, "seed b", "problem 5", "solution 5"),
+    ]
+    chosen, rejected = filter_same_seed_problem_solution(raw_data)
+    assert [(d["index"], d.get("sub_index")) for d in chosen] == [
+        (0, 0),
+        (0, 2),
+        (2, None),
+    ]
+    assert [d["reason"] for d in rejected] == [
+        "duplicate problems",
+        "duplicate seeds",
+        "duplicate seeds",
+    ]
@@ -0,0 +1,208 @@
+import asyncio
+
+from magicoder.dead_letter import DeadLetterStore, GenerationError
+from magicoder.engine import (
+    EngineStats,
+    FailureRecorder,
+    GenerationEngine,
+    run_with_retries,
+)
+from magicoder.journal import GenerationJournal, IndexState
+
+
+def test_cancel_stops_dispatch_and_writes(tmp_path):
+    journal = GenerationJournal(tmp_path / "out.jsonl.journal", window=(0, 100))
+    written: list[dict] = []
+
+    async def main():
+        cancel = asyncio.Event()
+
+        async def process(example: dict) -> dict:
+            if example["index"] == 10:
+                # 租约在生成途中被接手
+                cancel.set()
+            await asyncio.sleep(0.01 if example["index"] < 10 else 10)
+            return dict(index=example["index"])
+
+        engine = GenerationEngine(concurrency=4)
+        return await engine.run(
+            examples=(dict(index=index) for index in range(100)),
+            process=process,
+            sink=written.append,
+            journal=journal,
+            cancel=cancel,
+        )
+
+    stats = asyncio.run(main())
+    journal.discard()
+    assert stats.n_dispatched < 100
+    # 取消时在途的请求直接放弃，之后不再写出，日志里也不会标为 done
+    assert [record["index"] for record in written] == list(range(len(written)))
+    assert len(written) < 10
+    replayed = GenerationJournal(tmp_path / "out.jsonl.journal")
+    done = {
+        index
+        for index, status in replayed.statuses.items()
+        if status.state == IndexState.DONE
+    }
+    assert done <= set(range(10))
+    replayed.close()
+
+
+def test_run_without_cancel_writes_in_order():
+    written: list[dict] = []
+
+    async def process(example: dict) -> list[dict]:
+        await asyncio.sleep(0.001 * (example["index"] % 3))
+        return [dict(index=example["index"], sub_index=i) for i in range(2)]
+
+    stats = asyncio.run(
+        GenerationEngine(concurrency=4).run(
+            examples=(dict(index=index) for index in range(20)),
+            process=process,
+            sink=written.append,
+        )
+    )
+    assert stats.n_succeeded == 20
+    assert [(r["index"], r["sub_index"]) for r in written] == [
+        (index, i) for index in range(20) for i in range(2)
+    ]
+
+
+def test_run_with_retries_uses_retry_policies(tmp_path):
+    dead_letters = DeadLetterStore(tmp_path / "out.jsonl.dead")
+    passes: list[dict] = []
+
+    async def run_pass(batches: dict) -> EngineStats:
+        passes.append(
+            {t: [e["index"] for e in examples] for t, examples in batches.items()}
+        )
+        stats = EngineStats()
+        record_failure = FailureRecorder(stats, dead_letters=dead_letters)
+        for examples in batches.values():
+            for example in examples:
+                stats.n_dispatched += 1
+                if example["index"] == 1:
+                    # 一直无法解析，用完重试策略的次数后留在死信队列里
+                    record_failure(example, GenerationError("unparseable", "bad"))
+                elif example["index"] == 2 and len(passes) == 1:
+                    record_failure(example, GenerationError("overload", "429"))
+                else:
+                    stats.n_succeeded += 1
+                    dead_letters.resolve(example["index"])
+        return stats
+
+    examples = [dict(index=i, raw_index=i, seed="") for i in range(3)]
+    stats = asyncio.run(run_with_retries(examples, run_pass, dead_letters, 5))
+    dead_letters.close()
+    # 默认沿用原来的温度
+    assert passes == [{None: [0, 1, 2]}, {None: [1, 2]}, {None: [1]}]
+    assert stats.n_failed == 1 and list(dead_letters.entries) == [1]
+    assert stats.n_dispatched == 6
+
+
+def test_release_positions_restore_index_order():
+    from magicoder.prompt_layout import group_by_prefix
+
+    examples = [dict(index=i, seed=f"import {'ab'[i % 2]}\n{i}") for i in range(40)]
+    grouped = group_by_prefix(examples, 8)
+    # 每 8 个一组按种子排序派发
+    assert [example["index"] for _, example in grouped[:8]] == [0, 2, 4, 6, 1, 3, 5, 7]
+    written: list[dict] = []
+
+    async def process(example: dict) -> dict:
+        await asyncio.sleep(0.001 * (example["index"] % 5))
+        return dict(index=example["index"])
+
+    stats = asyncio.run(
+        GenerationEngine(concurrency=2, reorder_window=8, warmup=1).run(
+            examples=[example for _, example in grouped],
+            process=process,
+            sink=written.append,
+            release_positions=[position for position, _ in grouped],
+        )
+    )
+    assert stats.n_succeeded == 40
+    assert [record["index"] for record in written] == list(range(40))
+
+
+def test_budget_stops_queued_requests(tmp_path, monkeypatch):
+    from magicoder import budget, telemetry
+
+    monkeypatch.setattr(budget, "_BUDGET", None)
+    budget.configure(budget.Pricing(), max_tokens=5)
+    journal = GenerationJournal(tmp_path / "out.jsonl.journal", window=(0, 10))
+    sent: list[int] = []
+    written: list[dict] = []
+
+    async def process(example: dict) -> dict:
+        sent.append(example["index"])
+        telemetry.observe(prompt_tokens=5, completion_tokens=0)
+        await asyncio.sleep(0.001)
+        return dict(index=example["index"])
+
+    stats = asyncio.run(
+        GenerationEngine(concurrency=1).run(
+            examples=(dict(index=index) for index in range(10)),
+            process=process,
+            sink=written.append,
+            journal=journal,
+        )
+    )
+    # 第一个请求就用完了预算，已经在等待配额的数据不再发送
+    assert sent == [0]
+    assert [record["index"] for record in written] == [0]
+    assert stats.n_succeeded == 1
+    assert journal.missing() == list(range(1, 10))
+    assert all(journal.status(index).attempts == 0 for index in range(1, 10))
+    journal.close()
+
+
+def test_budget_stop_writes_grouped_records_behind_a_gap(tmp_path, monkeypatch):
+    from magicoder import budget, telemetry
+
+    monkeypatch.setattr(budget, "_BUDGET", None)
+    budget.configure(budget.Pricing(), max_tokens=10)
+    journal = GenerationJournal(tmp_path / "out.jsonl.journal", window=(0, 6))
+    positions = [0, 1, 3, 2, 4, 5]
+    written: list[dict] = []
+
+    async def process(example: dict) -> dict:
+        telemetry.observe(prompt_tokens=5, completion_tokens=0)
+        await asyncio.sleep(0.01 * example["index"])
+        return dict(index=example["index"])
+
+    asyncio.run(
+        GenerationEngine(concurrency=2, reorder_window=2).run(
+            examples=[dict(index=position) for position in positions],
+            process=process,
+            sink=written.append,
+            journal=journal,
+            release_positions=positions,
+        )
+    )
+    # 3 已经付费生成，排在没有派发的 2 后面，照常写出；2 留给续跑
+    assert [record["index"] for record in written] == [0, 1, 3]
+    assert journal.missing() == [2, 4, 5]
+    journal.close()
+
+
+def test_retry_batches_mark_retried_seeds(tmp_path):
+    from magicoder.dead_letter import RetryPolicy, with_retry_temperature
+
+    dead_letters = DeadLetterStore(tmp_path / "out.jsonl.dead")
+    example = dict(index=3, raw_index=17, seed="def f(): pass")
+    dead_letters.add(example, GenerationError("unparseable", "bad"), attempts=2)
+    policies = dict(
+        unparseable=RetryPolicy(max_retries=1, temperature=0.6),
+        error=RetryPolicy(max_retries=0),
+    )
+    (retried,) = dead_letters.retry_batches(policies)[0.6]
+    dead_letters.close()
+    assert retried["retry"] == {"pass": 1, "temperature": 0.6, "failed_attempts": 2}
+    (retried,) = with_retry_temperature(
+        [dict(retried, retry=dict(retried["retry"], temperature=None))], 0.0
+    )
+    assert retried["retry"]["temperature"] == 0.0
+    # 主流程的种子原样返回
+    assert with_retry_temperature([example], 0.0) == [example]
@@ -0,0 +1,177 @@
+import json
+import shutil
+import sys
+from dataclasses import dataclass
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("datasets")
+pytest.importorskip("transformers")
+
+from magicoder import token_counter, utils  # noqa: E402
+from magicoder.dead_letter import DeadLetterStore  # noqa: E402
+from magicoder.journal import GenerationJournal, IndexState  # noqa: E402
+from magicoder.mock_openai_server import Args, MockOpenAIServer  # noqa: E402
+from magicoder.output_writer import iter_records  # noqa: E402
+
+N_SEEDS = 30
+PROMPT = Path(__file__).parents[1] / "data" / "prompt.txt"
+
+
+@dataclass
+class CharCounter:
+    """不下载分词器，按字符数估算 token。"""
+
+    name: str = "chars"
+
+    def count(self, text: str) -> int:
+        return len(text) // 4
+
+    def count_batch(self, texts) -> list[int]:
+        return [self.count(text) for text in texts]
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """一份小的种子文档和提示模板，生成脚本在这个目录里运行。"""
+    (tmp_path / "data").mkdir()
+    shutil.copy(PROMPT, tmp_path / "data" / "prompt.txt")
+    with (tmp_path / "seeds.jsonl").open("w") as f:
+        for i in range(N_SEEDS):
+            lines = [f"def f{i}_{j}(x):\n    return x * {j} + {i}\n" for j in range(8)]
+            f.write(json.dumps(dict(content="".join(lines))) + "\n")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(token_counter, "get_token_counter", lambda name: CharCounter())
+    # 单核机器上 N_CORES 为 0，load_dataset 不接受
+    monkeypatch.setattr(utils, "N_CORES", None)
+    return tmp_path
+
+
+def run_main(monkeypatch, main, *argv: str):
+    monkeypatch.setattr(sys, "argv", ["generate", *argv])
+    main()
+
+
+def check_outputs(path: Path, failure_classes: set[str]):
+    """输出按 index 有序，日志与输出、死信队列一致，每个种子要么写出要么在死信队列里。"""
+    records = list(iter_records(path))
+    indices = [record["index"] for record in records]
+    assert indices == sorted(set(indices))
+    assert all(record["problem"] and record["solution"] for record in records)
+
+    journal = GenerationJournal(Path(f"{path}.journal"))
+    states = {index: status.state for index, status in journal.statuses.items()}
+    journal.close()
+    done = {index for index, state in states.items() if state == IndexState.DONE}
+    failed = {index for index, state in states.items() if state == IndexState.FAILED}
+    assert done == set(indices)
+    assert done | failed == set(range(N_SEEDS))
+
+    dead_letters = DeadLetterStore(Path(f"{path}.dead"))
+    entries = dict(dead_letters.entries)
+    dead_letters.close()
+    assert set(entries) == failed
+    assert len(entries) > 0
+    for entry in entries.values():
+        assert entry["error_class"] in failure_classes
+        if entry["error_class"] in ("incomplete", "unparseable"):
+            # 死信里保留原始回复，便于排查
+            assert entry["response"]["content"]
+    return records, entries
+
+
+@pytest.mark.parametrize("sampler", ["shuffle", "permutation"])
+def test_generate_data_against_mock(workdir, monkeypatch, sampler):
+    from magicoder import generate_data
+
+    server = MockOpenAIServer(
+        Args(
+            port=0,
+            seed=1,
+            ttft=0.0,
+            tokens_per_second=1e6,
+            reasoning_repeats=1,
+            error_429_rate=0.1,
+            truncation_rate=0.2,
+            malformed_rate=0.1,
+            stall_rate=0.1,
+            stall_seconds=30.0,
+        )
+    ).start()
+    endpoints = workdir / "endpoints.json"
+    endpoints.write_text(
+        json.dumps(
+            [
+                dict(
+                    name="mock",
+                    kind="openai",
+                    model="mock-model",
+                    base_url=f"{server.url}/v1",
+                )
+            ]
+        )
+    )
+    monkeypatch.setenv("OPENAI_API_KEY", "mock")
+    try:
+        run_main(
+            monkeypatch,
+            generate_data.main,
+            "--seed_code_start_index=0",
+            f"--max_new_data={N_SEEDS}",
+            "--seed=7",
+            "--dataset_name=seeds.jsonl",
+            "--model=mock-model",
+            f"--endpoints_file={endpoints}",
+            f"--sampler={sampler}",
+            "--seed_filter=False",
+            "--reasoning_store=True",
+            "--inter_chunk_timeout=0.5",
+            "--max_attempts=5",
+            "--retry_passes=0",
+        )
+    finally:
+        server.shutdown()
+    (path,) = workdir.glob("data-*.jsonl")
+    records, entries = check_outputs(path, {"incomplete", "unparseable", "aborted"})
+    # 推理过程写在旁路存储里
+    assert all("reasoning_ref" in record for record in records)
+    # 429 和卡住的流由引擎重试，不会进入死信队列
+    assert server.n_requests > N_SEEDS
+
+
+def test_http_generate_data_against_mock(workdir, monkeypatch):
+    from magicoder import http_generate_data
+
+    server = MockOpenAIServer(
+        Args(
+            port=0,
+            seed=2,
+            ttft=0.0,
+            tokens_per_second=1e6,
+            reasoning_repeats=1,
+            error_429_rate=0.1,
+            truncation_rate=0.2,
+            malformed_rate=0.1,
+        )
+    ).start()
+    monkeypatch.setenv("XIRANG_BASE_URL", f"{server.url}/chat/completions")
+    monkeypatch.setenv("XIRANG_API_KEY", "mock")
+    monkeypatch.setenv("MODEL_CODE", "mock-model")
+    try:
+        run_main(
+            monkeypatch,
+            http_generate_data.main,
+            "--seed_code_start_index=0",
+            f"--max_new_data={N_SEEDS}",
+            "--seed=7",
+            "--dataset_name=seeds.jsonl",
+            "--model=mock-model",
+            "--max_attempts=5",
+            "--retry_passes=0",
+        )
+    finally:
+        server.shutdown()
+    (path,) = workdir.glob("data-*.jsonl")
+    check_outputs(path, {"incomplete", "unparseable"})
+    assert server.n_requests > N_SEEDS
@@ -0,0 +1,59 @@
+import asyncio
+from dataclasses import dataclass
+
+import pytest
+
+from magicoder.dead_letter import dead_letter_path_for
+from magicoder.generation_outputs import open_outputs
+from magicoder.journal import GenerationJournal, IndexState, journal_path_for
+from magicoder.output_writer import iter_records
+from magicoder.reasoning_store import store_path_for
+
+
+@dataclass
+class OutputArgs:
+    output_flush_records: int = 64
+    output_flush_interval: float = 60.0
+    output_fsync: str = "commit"
+    output_segment_mb: int = 0
+    reasoning_store: bool = True
+
+
+def write(outputs, index: int):
+    outputs.write(dict(index=index, problem="p", reasoning_content="r" * 100))
+    outputs.journal.mark_done(index)
+
+
+def test_outputs_are_closed_on_error(tmp_path):
+    path = tmp_path / "out.jsonl"
+    synced: list[int] = []
+    with pytest.raises(RuntimeError):
+        with open_outputs(
+            path, (0, 4), OutputArgs(), after_sync=lambda: synced.append(1)
+        ) as outputs:
+            write(outputs, 0)
+            write(outputs, 1)
+            raise RuntimeError("boom")
+    # 出错时缓冲里的输出和日志照样写出
+    records = list(iter_records(path))
+    assert [record["index"] for record in records] == [0, 1]
+    assert all("reasoning_ref" in record for record in records)
+    assert store_path_for(path).exists()
+    assert dead_letter_path_for(path).exists()
+    assert len(synced) > 0
+    journal = GenerationJournal(journal_path_for(path))
+    assert journal.missing() == [2, 3]
+    assert journal.status(1).state == IndexState.DONE
+    journal.close()
+
+
+def test_outputs_are_discarded_when_cancelled(tmp_path):
+    path = tmp_path / "out.jsonl"
+    cancel = asyncio.Event()
+    with open_outputs(path, (0, 4), OutputArgs(), cancel) as outputs:
+        write(outputs, 0)
+        cancel.set()
+    assert list(iter_records(path)) == []
+    journal = GenerationJournal(journal_path_for(path))
+    assert journal.missing() == [0, 1, 2, 3]
+    journal.close()
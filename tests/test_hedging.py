@@ -0,0 +1,44 @@
+import asyncio
+
+from magicoder import budget, hedging, telemetry
+
+
+def test_losing_copy_is_recorded(monkeypatch):
+    monkeypatch.setattr(telemetry, "_CONFIGURED", False)
+    monkeypatch.setattr(telemetry, "_TELEMETRY", None)
+    monkeypatch.setattr(budget, "_BUDGET", None)
+    shared = telemetry.configure()
+    run_budget = budget.configure(budget.Pricing())
+    hedger = hedging.Hedger(min_samples=10, budget=1.0)
+    hedger.samples.extend([0.01] * 10)
+    hedger.n_requests = 10
+    calls = 0
+
+    async def attempt() -> str:
+        nonlocal calls
+        calls += 1
+        copy = "primary" if calls == 1 else "hedge"
+        telemetry.observe(endpoint=copy, prompt_tokens=100)
+        if copy == "primary":
+            # 迟迟没有首 token，被对冲的一份超过后取消
+            await asyncio.sleep(10)
+        hedging.mark_first_token()
+        telemetry.observe(completion_tokens=20)
+        return copy
+
+    async def main():
+        metrics = telemetry.start_request(index=3)
+        return metrics, await hedger.run(attempt)
+
+    metrics, result = asyncio.run(main())
+    assert result == "hedge"
+    assert hedger.wins == {"hedge": 1}
+    # 胜出的一份并入引擎的记录
+    assert metrics.hedged and metrics.hedge_winner == "hedge"
+    assert metrics.endpoint == "hedge" and metrics.completion_tokens == 20
+    # 落后的一份作为 aborted 计入遥测和预算
+    assert shared.outcomes == {("primary", "aborted"): 1}
+    assert run_budget.n_requests == 1 and run_budget.prompt_tokens == 100
+    # 被取消的一份留下一个不短于对冲阈值的删失样本
+    assert len(hedger.samples) == 12
+    assert max(hedger.samples) >= 0.01
@@ -0,0 +1,146 @@
+import asyncio
+from dataclasses import replace
+
+import httpx
+import pytest
+import requests
+
+from magicoder import http_client
+from magicoder.chat import ChatResult, collect_stream
+from magicoder.concurrency import Outcome, classify_error
+from magicoder.engine import GenerationEngine
+from magicoder.mock_openai_server import Args, MockOpenAIServer
+
+FAST = Args(port=0, ttft=0.0, tokens_per_second=1e6, reasoning_repeats=1)
+
+
+def start_server(**kwargs) -> MockOpenAIServer:
+    return MockOpenAIServer(replace(FAST, **kwargs)).start()
+
+
+def config(server: MockOpenAIServer) -> http_client.XirangConfig:
+    return http_client.XirangConfig(
+        url=f"{server.url}/chat/completions", api_key="mock", model_code="mock-model"
+    )
+
+
+def payload(**kwargs) -> dict:
+    return dict(
+        http_client.build_chat_payload(
+            "mock-model", "You are a helpful assistant.", "Write a problem."
+        ),
+        **kwargs,
+    )
+
+
+def test_sync_client_non_streaming():
+    server = start_server()
+    client = http_client.ChatHTTPClient(config(server))
+    try:
+        for _ in range(3):
+            result = ChatResult.from_response(client.post(payload()))
+            assert "[Problem Description]" in result.content
+            assert result.finish_reason == "stop"
+            assert result.usage is not None and result.usage["total_tokens"] > 0
+    finally:
+        client.close()
+        server.shutdown()
+
+
+def test_async_client_n_choices():
+    server = start_server()
+
+    async def main():
+        client = http_client.AsyncChatHTTPClient(config(server), http2=False)
+        try:
+            return await http_client.apost_with_cache(client, payload(n=3))
+        finally:
+            await client.aclose()
+
+    try:
+        result = ChatResult.from_response(asyncio.run(main()))
+    finally:
+        server.shutdown()
+    assert len(result.choices) == 3
+    assert all("[Solution]" in choice.content for choice in result.choices)
+
+
+def test_async_client_streaming():
+    server = start_server()
+
+    async def main():
+        client = http_client.AsyncChatHTTPClient(config(server), http2=False)
+        try:
+            chunks = http_client.astream_with_limit(
+                client, payload(n=2, stream_options={"include_usage": True})
+            )
+            return await collect_stream(chunks)
+        finally:
+            await client.aclose()
+
+    try:
+        result = asyncio.run(main())
+    finally:
+        server.shutdown()
+    assert result.reasoning_content
+    assert "[Problem Description]" in result.content
+    assert result.finish_reason == "stop"
+    assert result.usage is not None
+    assert len(result.choices) == 2
+    assert "[Solution]" in result.other_choices[0].content
+
+
+@pytest.mark.parametrize("rate", ["error_429_rate", "error_5xx_rate"])
+def test_overload_errors_are_classified(rate):
+    server = start_server(**{rate: 1.0})
+
+    async def post_async():
+        client = http_client.AsyncChatHTTPClient(config(server), http2=False)
+        try:
+            await client.post(payload())
+        finally:
+            await client.aclose()
+
+    client = http_client.ChatHTTPClient(config(server))
+    try:
+        with pytest.raises(requests.HTTPError) as sync_error:
+            client.post(payload())
+        with pytest.raises(httpx.HTTPStatusError) as async_error:
+            asyncio.run(post_async())
+    finally:
+        client.close()
+        server.shutdown()
+    assert classify_error(sync_error.value) == Outcome.OVERLOAD
+    assert classify_error(async_error.value) == Outcome.OVERLOAD
+
+
+def test_engine_retries_overload_errors():
+    server = start_server(error_429_rate=0.2, error_5xx_rate=0.2, seed=1)
+    written: list[dict] = []
+
+    async def main():
+        client = http_client.AsyncChatHTTPClient(config(server), http2=False)
+
+        async def process(example: dict) -> dict:
+            response = await http_client.apost_with_cache(client, payload())
+            result = ChatResult.from_response(response)
+            return dict(index=example["index"], content=result.content)
+
+        try:
+            return await GenerationEngine(
+                concurrency=4, max_attempts=10, retry_delay=0.001
+            ).run(
+                examples=(dict(index=index) for index in range(20)),
+                process=process,
+                sink=written.append,
+            )
+        finally:
+            await client.aclose()
+
+    try:
+        stats = asyncio.run(main())
+    finally:
+        server.shutdown()
+    assert stats.n_succeeded == 20 and stats.n_failed == 0
+    assert stats.n_retries > 0
+    assert [record["index"] for record in written] == list(range(20))
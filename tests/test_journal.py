@@ -0,0 +1,30 @@
+from magicoder.journal import GenerationJournal
+
+
+def test_missing_tracks_outstanding_indices(tmp_path):
+    path = tmp_path / "out.jsonl.journal"
+    journal = GenerationJournal(path, window=(10, 20))
+    assert journal.missing() == list(range(10, 20))
+    journal.mark_in_flight(12)
+    journal.mark_done(12)
+    journal.mark_skipped(15, "Duplicate seed")
+    journal.mark_in_flight(17)
+    journal.mark_failed(17, "timeout")
+    expected = [10, 11, 13, 14, 16, 17, 18, 19]
+    assert journal.missing() == expected
+    assert journal.missing([12, 13, 17]) == [13, 17]
+    journal.close()
+
+    # 重放后得到相同的结果
+    journal = GenerationJournal(path, window=(10, 20))
+    assert journal.missing() == expected
+    journal.mark_in_flight(17)
+    journal.mark_done(17)
+    assert 17 not in journal.missing()
+    assert journal.counts()["done"] == 2
+    # 窗口里每个 index 都有记录之后只剩未完成的
+    for index in journal.missing():
+        journal.mark_skipped(index, "Duplicate seed")
+    journal.mark_failed(11, "timeout")
+    assert journal.missing() == [11]
+    journal.close()
@@ -0,0 +1,163 @@
+import asyncio
+
+import pytest
+
+from magicoder.local_generation import length_batches
+
+CHAT_TEMPLATE = (
+    "{{ bos_token }}{% for message in messages %}"
+    "{{ message['role'] }}: {{ message['content'] }}\n{% endfor %}"
+    "{% if add_generation_prompt %}assistant: {% endif %}"
+)
+
+
+def test_length_batches_longest_first():
+    lengths = [5, 40, 12, 41, 13, 44, 120]
+    batches = length_batches(
+        lengths, batch_size=3, max_batch_tokens=200, max_new_tokens=10
+    )
+    # 120 加上任何一个都超过上限，自成一批；其余按长度降序，每批最多 3 个
+    assert batches == [[6], [5, 3, 1], [4, 2, 0]]
+    for batch in batches:
+        assert [lengths[i] for i in batch] == sorted(
+            (lengths[i] for i in batch), reverse=True
+        )
+        if len(batch) > 1:
+            assert len(batch) * (lengths[batch[0]] + 10) <= 200
+    assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+
+
+def test_length_batches_oversized_prompt_alone():
+    assert length_batches([500, 3, 4], 8, 100, 10) == [[0], [2, 1]]
+
+
+@pytest.fixture(scope="module")
+def tiny_model_dir(tmp_path_factory):
+    """用配置构造一个随机权重的小 Llama 和一个现场训练的 BPE 分词器，不需要联网。"""
+    pytest.importorskip("torch")
+    transformers = pytest.importorskip("transformers")
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+
+    tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    tokenizer.train_from_iterator(
+        [
+            "def add(a, b):\n    return a + b\n",
+            "[Problem Description] [Solution] system user assistant",
+        ],
+        trainers.BpeTrainer(
+            vocab_size=400,
+            special_tokens=["<unk>", "<s>", "</s>"],
+            initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+        ),
+    )
+    hf_tokenizer = transformers.PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token="<s>",
+        eos_token="</s>",
+        unk_token="<unk>",
+    )
+    hf_tokenizer.chat_template = CHAT_TEMPLATE
+    config = transformers.LlamaConfig(
+        vocab_size=hf_tokenizer.vocab_size,
+        hidden_size=16,
+        intermediate_size=32,
+        num_hidden_layers=1,
+        num_attention_heads=2,
+        num_key_value_heads=2,
+        max_position_embeddings=256,
+        bos_token_id=hf_tokenizer.bos_token_id,
+        eos_token_id=hf_tokenizer.eos_token_id,
+    )
+    model_dir = tmp_path_factory.mktemp("tiny-llama")
+    transformers.LlamaForCausalLM(config).save_pretrained(model_dir)
+    hf_tokenizer.save_pretrained(model_dir)
+    return model_dir
+
+
+@pytest.fixture(scope="module")
+def generator(tiny_model_dir):
+    from magicoder.local_generation import LocalGenerator, load_model_context
+
+    return LocalGenerator(
+        load_model_context(str(tiny_model_dir), "float32"),
+        batch_size=2,
+        max_batch_tokens=4096,
+    )
+
+
+def test_render_strips_bos(generator):
+    messages = [
+        dict(role="system", content="You are helpful."),
+        dict(role="user", content="def add(a, b):"),
+    ]
+    prompt = generator.render(messages)
+    assert not prompt.startswith("<s>")
+    assert prompt.startswith("system: You are helpful.")
+    assert prompt.endswith("assistant: ")
+
+    from magicoder.llm_wrapper import EncodingConfig
+
+    # `ModelContext.complete` 编码时只加一个 BOS
+    context = generator.model_context.tokenization_context
+    input_ids = context.encode_with_padding(
+        "left", EncodingConfig(add_bos=True, add_eos=False), [prompt, "x"]
+    )
+    bos_token_id = context.tokenizer.bos_token_id
+    assert input_ids.eq(bos_token_id).sum(dim=1).tolist() == [1, 1]
+
+
+def test_complete_reports_usage(generator):
+    results = generator.complete(["system: a\n", "system: def add(a, b)\n"], 4, 0.0)
+    assert len(results) == 2
+    for result in results:
+        assert result.finish_reason in ("stop", "length")
+        assert result.usage["completion_tokens"] <= 4
+        assert result.endpoint == "local"
+
+
+def test_generate_local_rejects_over_context_seeds(generator, tmp_path, monkeypatch):
+    pytest.importorskip("datasets")
+    from magicoder import generate_data, local_generation, token_counter
+    from magicoder.dead_letter import DeadLetterStore
+    from magicoder.journal import GenerationJournal, IndexState
+
+    class CharCounter:
+        def count_batch(self, texts):
+            return [len(text) // 4 for text in texts]
+
+    monkeypatch.setattr(token_counter, "get_token_counter", lambda name: CharCounter())
+    monkeypatch.setattr(local_generation, "_LOCAL_GENERATOR", generator)
+    args = generate_data.Args(
+        seed_code_start_index=0,
+        max_new_data=4,
+        seed=1,
+        mode="local",
+        max_new_tokens=8,
+        seed_filter=False,
+    )
+    examples = [
+        dict(index=i, raw_index=i, seed=seed)
+        for i, seed in enumerate(
+            ["def add(a, b):", "add(a, b) " * 200, "return a + b", "b " * 300]
+        )
+    ]
+    journal = GenerationJournal(tmp_path / "out.jsonl.journal", window=(0, 4))
+    dead_letters = DeadLetterStore(tmp_path / "out.jsonl.dead")
+    written: list[dict] = []
+    stats = asyncio.run(
+        generate_data.generate_local(
+            args, examples, "{code}", written.append, journal, dead_letters
+        )
+    )
+    # 放不下的提示不派发，直接记为 no_room，之后也不会重试
+    assert stats.n_dispatched == 2
+    assert {index for index, entry in dead_letters.entries.items()} >= {1, 3}
+    assert dead_letters.entries[1]["error_class"] == "no_room"
+    assert dead_letters.entries[3]["error_class"] == "no_room"
+    assert journal.status(1).state == IndexState.FAILED
+    for index in (0, 2):
+        assert journal.status(index).state in (IndexState.DONE, IndexState.FAILED)
+    journal.close()
+    dead_letters.close()
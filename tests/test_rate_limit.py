@@ -0,0 +1,43 @@
+import asyncio
+import fcntl
+import os
+import threading
+
+from magicoder import rate_limit
+
+
+def test_default_state_file_per_endpoint_and_key():
+    path = rate_limit.default_state_file("https://a.example/v1", "key-1")
+    assert path == rate_limit.default_state_file("https://a.example/v1", "key-1")
+    assert path != rate_limit.default_state_file("https://a.example/v1", "key-2")
+    assert path != rate_limit.default_state_file("https://b.example/v1", "key-1")
+    assert "key-1" not in path.name
+
+
+def test_async_acquire_does_not_block_event_loop(tmp_path):
+    state_file = tmp_path / "state.json"
+    limiter = rate_limit.RateLimiter(rpm=60, state_file=state_file)
+    # 另一个进程持有文件锁
+    fd = os.open(state_file, os.O_RDWR | os.O_CREAT, 0o644)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    threading.Timer(0.3, lambda: fcntl.flock(fd, fcntl.LOCK_UN)).start()
+    ticks = 0
+
+    async def tick():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.01)
+            ticks += 1
+
+    async def main():
+        ticker = asyncio.create_task(tick())
+        reservation = await limiter.async_acquire(10)
+        await reservation.async_settle(None)
+        ticker.cancel()
+        return reservation
+
+    reservation = asyncio.run(main())
+    os.close(fd)
+    assert reservation.settled
+    # 等锁的 0.3 秒里事件循环仍在运行
+    assert ticks >= 10
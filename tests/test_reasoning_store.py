@@ -0,0 +1,34 @@
+from magicoder.reasoning_store import ReasoningReader, ReasoningStore, load_reasoning
+
+
+def test_interleaved_writers_get_correct_offsets(tmp_path):
+    path = tmp_path / "data.jsonl.reasoning"
+    # 两个写入方（例如被接手的分片的新旧 worker）交替追加同一个存储
+    first = ReasoningStore(path, codec="zlib")
+    second = ReasoningStore(path, codec="zlib")
+    refs = {}
+    for index in range(20):
+        store = first if index % 2 == 0 else second
+        refs[index] = store.put(index, f"thinking about {index} " * (index + 1))
+    first.close()
+    second.close()
+
+    for index, ref in refs.items():
+        data = dict(index=index, reasoning_ref=ref)
+        assert load_reasoning(data, tmp_path / "data.jsonl") == (
+            f"thinking about {index} " * (index + 1)
+        )
+    reader = ReasoningReader(path)
+    assert reader.get(7) == "thinking about 7 " * 8
+    with (tmp_path / "data.jsonl.reasoning.idx").open() as f:
+        assert sum(1 for line in f if "codec" in line) == 1
+
+
+def test_sub_index_and_inline(tmp_path):
+    store = ReasoningStore(tmp_path / "data.jsonl.reasoning", codec="zlib")
+    store.put(3, "first choice", sub_index=0)
+    store.put(3, "second choice", sub_index=1)
+    store.close()
+    reader = ReasoningReader(tmp_path / "data.jsonl.reasoning")
+    assert reader.get(3, 1) == "second choice"
+    assert load_reasoning(dict(reasoning_content="inline"), tmp_path) == "inline"
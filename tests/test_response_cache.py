@@ -0,0 +1,125 @@
+import asyncio
+
+import pytest
+
+from magicoder import http_client, response_cache
+
+
+class FakeClient:
+    """按请求的 n 返回对应个数的 choice。"""
+
+    def __init__(self):
+        self.n_posts = 0
+
+    async def post(self, payload: dict) -> dict:
+        self.n_posts += 1
+        return dict(
+            choices=[
+                dict(index=i, message=dict(content=f"choice {i}"))
+                for i in range(payload.get("n") or 1)
+            ]
+        )
+
+
+def test_http_cache_key_includes_n_and_stream(tmp_path):
+    response_cache.configure(tmp_path / "cache.sqlite")
+    try:
+        client = FakeClient()
+        payload = dict(model="m", messages=[dict(role="user", content="hi")])
+
+        async def post(**extra) -> dict:
+            return await http_client.apost_with_cache(client, dict(payload, **extra))
+
+        assert len(asyncio.run(post())["choices"]) == 1
+        assert len(asyncio.run(post(n=3))["choices"]) == 3
+        assert len(asyncio.run(post(n=3))["choices"]) == 3
+        assert client.n_posts == 2
+        asyncio.run(post(n=3, stream=True))
+        assert client.n_posts == 3
+    finally:
+        response_cache.configure(None)
+
+
+def test_sdk_and_http_keys_agree():
+    request = dict(
+        model="m",
+        messages=[dict(role="user", content="hi")],
+        temperature=0.6,
+        max_tokens=100,
+        n=2,
+    )
+    assert response_cache.request_key(request) == response_cache.cache_key(
+        model="m",
+        messages=request["messages"],
+        temperature=0.6,
+        max_tokens=100,
+        n=2,
+        stream=False,
+    )
+    assert response_cache.request_key(request) != response_cache.request_key(
+        dict(request, n=1)
+    )
+
+
+def test_evict_tracked_keys(tmp_path):
+    cache = response_cache.configure(tmp_path / "cache.sqlite")
+    try:
+        client = FakeClient()
+        payload = dict(model="m", messages=[dict(role="user", content="hi")])
+
+        async def post() -> list[str]:
+            with response_cache.track_keys() as keys:
+                await http_client.apost_with_cache(client, payload)
+            return keys
+
+        keys = asyncio.run(post())
+        assert keys == [response_cache.request_key(payload)] and len(cache) == 1
+        # 命中缓存时同样记下键
+        assert asyncio.run(post()) == keys and client.n_posts == 1
+        response_cache.evict(keys)
+        assert len(cache) == 0
+        asyncio.run(post())
+        assert client.n_posts == 2
+    finally:
+        response_cache.configure(None)
+
+
+def test_rejected_responses_are_not_cached(tmp_path, monkeypatch):
+    pytest.importorskip("datasets")
+    pytest.importorskip("transformers")
+    from magicoder import http_generate_data, token_counter
+    from magicoder.dead_letter import GenerationError
+    from magicoder.mock_openai_server import Args, MockOpenAIServer
+
+    class CharCounter:
+        def count_batch(self, texts):
+            return [len(text) // 4 for text in texts]
+
+    monkeypatch.setattr(token_counter, "get_token_counter", lambda name: CharCounter())
+    server = MockOpenAIServer(
+        Args(port=0, ttft=0.0, tokens_per_second=1e6, malformed_rate=1.0)
+    ).start()
+    monkeypatch.setenv("XIRANG_BASE_URL", f"{server.url}/chat/completions")
+    monkeypatch.setenv("XIRANG_API_KEY", "mock")
+    monkeypatch.setenv("MODEL_CODE", "mock-model")
+    http_client.configure_async_http_client(http2=False)
+    cache = response_cache.configure(tmp_path / "cache.sqlite")
+    args = http_generate_data.Args(seed_code_start_index=0, max_new_data=1)
+    example = dict(index=0, raw_index=0, seed="def f(x):\n    return x\n")
+
+    async def generate() -> dict:
+        try:
+            return await http_generate_data.generate_one(example, args, "{code}")
+        finally:
+            await http_client.get_async_http_client().aclose()
+
+    try:
+        for _ in range(2):
+            with pytest.raises(GenerationError):
+                asyncio.run(generate())
+            http_client.configure_async_http_client(http2=False)
+        # 两次都真正发出了请求，坏回复没有被回放
+        assert len(cache) == 0 and server.n_requests == 2
+    finally:
+        response_cache.configure(None)
+        server.shutdown()
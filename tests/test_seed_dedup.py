@@ -0,0 +1,36 @@
+from magicoder.seed_dedup import SeedIndex
+
+SEED = "def area(width, height):\n    return width * height  # rectangle area\n"
+NEAR = "def area(width, height):\n    return width * height  # rectangle areas\n"
+OTHER = "import os\nfor name in os.listdir(path):\n    print(name.upper())\n"
+
+
+def test_find_duplicates_does_not_register(tmp_path):
+    index = SeedIndex(tmp_path / "seeds.sqlite")
+    # 同一批里后出现的重复种子也会被找出
+    assert index.find_duplicates([SEED, " " + SEED, OTHER], [0, 1, 2], "a") == [
+        None,
+        ("a", 0),
+        None,
+    ]
+    assert len(index) == 0
+    index.add([SEED], [0], "a")
+    assert len(index) == 1
+    # 续跑时自己登记过的种子不算重复，另一份语料的同一个 raw_index 算重复
+    assert index.find_duplicates([SEED, SEED, OTHER], [0, 0, 2], "a") == [
+        None,
+        None,
+        None,
+    ]
+    assert index.find_duplicates([SEED], [0], "b") == [("a", 0)]
+    index.close()
+
+
+def test_near_duplicates(tmp_path):
+    index = SeedIndex(tmp_path / "seeds.sqlite", threshold=0.5)
+    index.add([SEED], [3], "a")
+    assert index.find_duplicates([NEAR, OTHER], [4, 5], "a") == [("a", 3), None]
+    # 已经登记过的代码不会换成新的来源
+    index.add([SEED], [7], "b")
+    assert index.find_duplicates([SEED], [7], "b") == [("a", 3)]
+    index.close()
@@ -0,0 +1,33 @@
+from magicoder.seed_filter import SeedFilter
+
+GOOD = "def add(a, b):\n    total = a + b\n    return total\n"
+BLANK = "\n    \n"
+LICENSE = "# Copyright 2020 Example\n# Licensed under the MIT License\n"
+
+
+def test_refine_does_not_count():
+    seed_filter = SeedFilter(max_resamples=2)
+    replacements = {1: GOOD, 2: BLANK}
+    seeds, rejections, resamples = seed_filter.refine(
+        [GOOD, BLANK, LICENSE], lambda i: replacements.get(i, LICENSE)
+    )
+    assert seeds == [GOOD, GOOD, BLANK]
+    assert rejections[:2] == ["", ""]
+    assert rejections[2] == "too short"
+    assert resamples == [0, 1, 2]
+    # 映射可能命中缓存而不执行，计数只来自 `observe`
+    assert seed_filter.report()["seeds"] == 0
+
+
+def test_observe_counts_selected_window():
+    seed_filter = SeedFilter()
+    seed_filter.observe(["", "", "too short", "license text", ""], [0, 2, 3, 3, 0])
+    report = seed_filter.report()
+    assert report["seeds"] == 5
+    assert report["accepted_first_try"] == 2
+    assert report["accepted_after_resampling"] == 1
+    assert report["rejected"] == 2
+    assert report["acceptance_rate"] == 0.6
+    assert report["rejections"] == {"too short": 1, "license text": 1}
+    seed_filter.observe([], [])
+    assert seed_filter.report()["seeds"] == 5
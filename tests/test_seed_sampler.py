@@ -0,0 +1,23 @@
+import pytest
+
+pytest.importorskip("datasets")
+
+from magicoder.seed_sampler import FeistelPermutation  # noqa: E402
+
+
+@pytest.mark.parametrize("n", [1, 2, 3, 17, 256, 1000, 4099])
+def test_feistel_permutation_is_a_bijection(n):
+    permutation = FeistelPermutation(n, key=42)
+    assert sorted(permutation(position) for position in range(n)) == list(range(n))
+    with pytest.raises(AssertionError):
+        permutation(n)
+
+
+def test_feistel_permutation_is_stable_per_key():
+    n = 1000
+    first = [FeistelPermutation(n, key=7)(position) for position in range(n)]
+    assert first == [FeistelPermutation(n, key=7)(position) for position in range(n)]
+    # 排列只由密钥决定，不随进程或版本变化，续跑和分片才能取到同样的种子
+    assert first[:8] == [944, 734, 657, 274, 686, 108, 898, 923]
+    assert first != [FeistelPermutation(n, key=8)(position) for position in range(n)]
+    assert first != list(range(n))
@@ -0,0 +1,54 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("transformers")
+
+from magicoder import sharding  # noqa: E402
+from magicoder.sharding import Shard, ShardCoordinator  # noqa: E402
+
+
+def test_expired_lease_is_taken_over(tmp_path):
+    ShardCoordinator.init_plan(tmp_path, 0, 20, 10)
+    a = ShardCoordinator(tmp_path, "a", lease_ttl=0.2)
+    b = ShardCoordinator(tmp_path, "b", lease_ttl=0.2)
+    c = ShardCoordinator(tmp_path, "c", lease_ttl=0.2)
+    assert a.claim() == Shard(0, 10)
+    assert b.claim() == Shard(10, 20)
+    assert c.claim() is None
+    assert b.renew(Shard(10, 20))
+    time.sleep(0.3)
+    # a 的租约过期，c 接手；a 续约失败，b 的租约虽然也过期了但没有人接手，仍可续上
+    assert c.claim() == Shard(0, 10)
+    assert not a.renew(Shard(0, 10))
+    assert b.renew(Shard(10, 20))
+    assert c.status() == dict(done=0, leased=2, pending=0)
+    # a 释放时不会删掉 c 的租约
+    a.release(Shard(0, 10))
+    assert c.renew(Shard(0, 10))
+
+
+def test_renew_and_takeover_do_not_interleave(tmp_path, monkeypatch):
+    ShardCoordinator.init_plan(tmp_path, 0, 10, 10)
+    a = ShardCoordinator(tmp_path, "a", lease_ttl=0.2)
+    b = ShardCoordinator(tmp_path, "b", lease_ttl=0.2)
+    assert a.claim() == Shard(0, 10)
+    time.sleep(0.3)
+    a.lease_ttl = 60.0
+    claimed: list[Shard | None] = []
+    thread = threading.Thread(target=lambda: claimed.append(b.claim()))
+    write_json_atomic = sharding._write_json_atomic
+
+    def write_after_takeover_attempt(path, data):
+        # a 已经读出并检查了租约，b 此时尝试接手过期的租约
+        thread.start()
+        thread.join(0.2)
+        write_json_atomic(path, data)
+
+    monkeypatch.setattr(sharding, "_write_json_atomic", write_after_takeover_attempt)
+    assert a.renew(Shard(0, 10))
+    thread.join()
+    # b 等到续约完成后才检查租约，看到的是续上的租约，不会和 a 同时持有分片
+    assert claimed == [None]
+    assert sharding._read_json(a._lease_path(Shard(0, 10)))["worker"] == "a"
@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+
+from magicoder.chat import collect_stream
+from magicoder.stream_watchdog import StreamDeadlines, StreamStalled, StreamWatchdog
+
+
+class FakeStream:
+    """按给定的间隔逐个返回内容 chunk，记录是否被关闭。"""
+
+    def __init__(self, delays: list[float]):
+        self.delays = delays
+        self.closed = False
+
+    async def __aiter__(self):
+        for i, delay in enumerate(self.delays):
+            await asyncio.sleep(delay)
+            yield dict(choices=[dict(index=0, delta=dict(content=f"{i} "))])
+
+    async def aclose(self):
+        self.closed = True
+
+
+def collect(delays: list[float], **deadlines: float | None):
+    stream = FakeStream(delays)
+    watchdog = StreamWatchdog(StreamDeadlines(**deadlines))
+    with pytest.raises(StreamStalled) as stalled:
+        asyncio.run(collect_stream(stream, watchdog=watchdog))
+    assert stream.closed
+    return stalled.value
+
+
+def test_first_token_deadline():
+    error = collect([0.5], first_token=0.05, inter_chunk=None, total=None)
+    assert error.reason == "first_token" and error.n_chunks == 0
+    assert error.elapsed < 0.5
+
+
+def test_inter_chunk_deadline():
+    # 首 token 之后才按 chunk 间隔计时，首 token 本身可以慢于这个间隔
+    error = collect(
+        [0.1, 0.01, 0.01, 0.5], first_token=1.0, inter_chunk=0.05, total=None
+    )
+    assert error.reason == "inter_chunk" and error.n_chunks == 3
+    # 部分输出保留在异常里
+    assert error.partial_content == "0 1 2 "
+
+
+def test_total_deadline():
+    error = collect([0.03] * 20, first_token=1.0, inter_chunk=1.0, total=0.2)
+    assert error.reason == "total"
+    assert 0 < error.n_chunks < 20
+
+
+def test_stream_within_deadlines():
+    stream = FakeStream([0.01] * 3)
+    watchdog = StreamWatchdog(StreamDeadlines(first_token=1.0, inter_chunk=1.0))
+    result = asyncio.run(collect_stream(stream, watchdog=watchdog))
+    assert result.content == "0 1 2 "
+    assert watchdog.n_chunks == 3 and not stream.closed
+
+
+def test_start_waits_for_headers_under_first_token_deadline():
+    async def slow_headers():
+        await asyncio.sleep(0.5)
+
+    watchdog = StreamWatchdog(StreamDeadlines(first_token=0.05))
+    with pytest.raises(StreamStalled) as stalled:
+        asyncio.run(watchdog.start(slow_headers()))
+    assert stalled.value.reason == "first_token"
@@ -0,0 +1,64 @@
+import pytest
+
+from magicoder.telemetry import RequestMetrics, Reservoir, Telemetry
+
+
+def test_reservoir_is_bounded():
+    reservoir = Reservoir(size=100)
+    for value in range(10_000):
+        reservoir.add(float(value))
+    assert len(reservoir.samples) == 100
+    assert reservoir.count == 10_000
+    assert reservoir.sum == sum(range(10_000))
+    # 均匀抽样，中位数接近真实值
+    assert 3_000 < sorted(reservoir.samples)[50] < 7_000
+
+
+def test_prometheus_counts_all_requests(tmp_path):
+    telemetry = Telemetry(prometheus_file=tmp_path / "magicoder.prom")
+    telemetry.latencies.size = 10
+    for i in range(50):
+        telemetry.record(RequestMetrics(index=i, latency=1.0, outcome="success"))
+    telemetry.close()
+    text = (tmp_path / "magicoder.prom").read_text()
+    assert "magicoder_request_latency_seconds_count 50" in text
+    assert "magicoder_request_latency_seconds_sum 50.0" in text
+    assert telemetry.summary()["latency"]["p99"] == 1.0
+
+
+def test_failed_streams_are_recorded(monkeypatch):
+    from types import SimpleNamespace
+
+    from magicoder import telemetry, utils
+    from magicoder.stream_validator import StreamAborted
+
+    monkeypatch.setattr(telemetry, "_CONFIGURED", False)
+    monkeypatch.setattr(telemetry, "_TELEMETRY", None)
+    shared = telemetry.configure()
+    chunk = SimpleNamespace(usage=None, choices=[SimpleNamespace(finish_reason=None)])
+
+    def stream(error: Exception | None = None):
+        yield chunk
+        if error is not None:
+            raise error
+        yield chunk
+
+    assert len(list(utils._observe_stream(stream(), telemetry.start_request()))) == 2
+    with pytest.raises(TimeoutError):
+        list(utils._observe_stream(stream(TimeoutError()), telemetry.start_request()))
+    with pytest.raises(StreamAborted):
+        list(
+            utils._observe_stream(
+                stream(StreamAborted("no [Solution]")), telemetry.start_request()
+            )
+        )
+    # 调用方提前关闭（卡住检测中止、取消）
+    observed = utils._observe_stream(stream(), telemetry.start_request())
+    next(observed)
+    observed.close()
+    assert shared.outcomes == {
+        ("", "success"): 1,
+        ("", "overload"): 1,
+        ("", "aborted"): 2,
+    }
+    assert shared.latencies.count == 4